@@ -0,0 +1,108 @@
+"""
+History pagination benchmark.
+
+Fills one channel of a scratch database with many messages and times a page
+near the newest end, the middle and the very beginning of the channel, for
+the keyset query behind GET /channel/{id}/messages and for the previous query
+(`id < ?` filter but ORDER BY timestamp). The keyset page is an index range
+scan that stops after `limit + 1` rows wherever it starts; the old one has to
+sort everything older than the boundary.
+
+    python bench_pagination.py                    # 1,000,000 messages
+    python bench_pagination.py --messages 200000 --runs 20
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASE_DIR)
+
+import database  # noqa: E402
+from pagination import keyset_page  # noqa: E402
+
+CHANNEL = "bench-channel"
+PAGE = 50
+SELECT = '''
+    SELECT cm.id, cm.content, cm.timestamp, cm.attachment_url, cm.attachment_type,
+           cm.attachment_name, cm.edited_at, cm.reply_to_id, cm.is_pinned, u.username as sender
+    FROM channel_messages cm
+    JOIN users u ON cm.sender_id = u.id
+'''
+
+
+def seed(count: int):
+    conn = database.get_db_connection()
+    c = conn.cursor()
+    c.execute("INSERT INTO users (username, discriminator, password_hash, display_name) "
+              "VALUES ('bench', '0001', 'x', 'bench')")
+    user_id = c.lastrowid
+    c.execute("INSERT INTO servers (id, name, owner_id, invite_code) VALUES ('s', 'S', ?, 'bench1')", (user_id,))
+    c.execute("INSERT INTO channels (id, server_id, name, type, position) VALUES (?, 's', 'genel', 'text', 0)",
+              (CHANNEL,))
+    batch = 50000
+    for start in range(0, count, batch):
+        rows = [(CHANNEL, user_id, f"mesaj {i}", f"2024-01-01 00:00:{i % 60:02d}")
+                for i in range(start, min(start + batch, count))]
+        c.executemany("INSERT INTO channel_messages (channel_id, sender_id, content, timestamp) "
+                      "VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def legacy_page(c, before):
+    c.execute(SELECT + '''
+        WHERE cm.channel_id = ? AND cm.id < ?
+        ORDER BY cm.timestamp DESC
+        LIMIT ?
+    ''', (CHANNEL, before, PAGE))
+    return c.fetchall()
+
+
+def new_page(c, before):
+    return keyset_page(c, SELECT, [("cm.channel_id = ?", (CHANNEL,))], f"channel:{CHANNEL}", PAGE,
+                       before_id=before, id_column="cm.id")["items"]
+
+
+def timed(fn, c, before, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        rows = fn(c, before)
+        samples.append((time.perf_counter() - start) * 1000)
+        assert len(rows) == PAGE
+    return statistics.median(samples)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, "bench.db")
+        database.init_db()
+        print(f"seeding {args.messages} messages ...")
+        seed(args.messages)
+
+        conn = database.get_db_connection()
+        c = conn.cursor()
+        print(f"page of {PAGE}, median of {args.runs} runs, ms")
+        print(f"{'position':>10} | {'keyset (id)':>12} | {'old (timestamp sort)':>20}")
+        print("-" * 50)
+        for label, before in (("newest", args.messages + 1),
+                              ("middle", args.messages // 2),
+                              ("oldest", PAGE + 1)):
+            new_ms = timed(new_page, c, before, args.runs)
+            old_ms = timed(legacy_page, c, before, args.runs)
+            print(f"{label:>10} | {new_ms:12.2f} | {old_ms:20.2f}")
+        conn.close()
+        database.close_pool()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
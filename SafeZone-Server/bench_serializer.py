@@ -0,0 +1,105 @@
+"""
+WebSocket serializer microbenchmark.
+
+Builds a lobby snapshot for a synthetic 5,000-user lobby and compares:
+  * encode cost of stdlib json vs utils.encode_frame (orjson if installed),
+    and of a frame's escaped text view, built for text-mode sockets
+  * fan-out cost of the old path (stdlib json.dumps into a str frame, which the
+    socket layer UTF-8 encodes again for every recipient) against encoding
+    once into a utils.Frame and sharing its text / bytes view
+
+    python bench_serializer.py                  # 5000 users, 200 recipients
+    python bench_serializer.py --users 20000 --recipients 1000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASE_DIR)
+
+import utils  # noqa: E402
+
+STATUSES = ["online", "idle", "dnd", "online", "online"]
+
+
+def build_snapshot(users: int, rooms: int = 300) -> dict:
+    rnd = random.Random(42)
+    online = []
+    for i in range(users):
+        online.append({
+            "username": f"kullanici_{i}",
+            "status": rnd.choice(STATUSES),
+            "preferred_status": "online",
+            "custom_status": "Oyunda 🎮" if i % 7 == 0 else None,
+            "display_name": f"Kullanıcı {i}",
+            "avatar_url": f"/uploads/{i}_{rnd.getrandbits(32):08x}.png" if i % 3 else None,
+            "avatar_color": "#5865F2",
+            "discriminator": f"{i % 10000:04d}",
+        })
+    room_details = {
+        f"{rnd.getrandbits(128):032x}": [f"kullanici_{rnd.randrange(users)}" for _ in range(rnd.randint(1, 8))]
+        for _ in range(rooms)
+    }
+    return {"type": "lobby_update", "seq": 1, "total_online": users,
+            "online_users": online, "room_details": room_details}
+
+
+def timed(fn, runs: int) -> float:
+    """Median wall time of fn() in milliseconds."""
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--recipients", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=15)
+    args = parser.parse_args(argv)
+
+    snapshot = build_snapshot(args.users)
+    size = len(utils.json_bytes(snapshot))
+    print(f"snapshot: {args.users} users, {size / 1024:.0f} KiB, backend={utils.JSON_BACKEND}, "
+          f"{args.recipients} recipients, median of {args.runs} runs")
+    print()
+
+    print("encode once")
+    print(f"  json.dumps (stdlib, old default)  {timed(lambda: json.dumps(snapshot), args.runs):8.2f} ms")
+    print(f"  encode_frame                      {timed(lambda: utils.encode_frame(snapshot), args.runs):8.2f} ms")
+    print(f"  encode_frame + text view          {timed(lambda: utils.encode_frame(snapshot).text, args.runs):8.2f} ms")
+    print()
+
+    # What the socket layer does per send: a str frame is UTF-8 encoded for
+    # every recipient, a bytes frame is written as is.
+    def old_fanout():
+        message = json.dumps(snapshot)
+        for _ in range(args.recipients):
+            message.encode("utf-8")
+
+    def once_text():
+        frame = utils.encode_frame(snapshot)
+        for _ in range(args.recipients):
+            frame.text.encode("utf-8")
+
+    def once_bytes():
+        frame = utils.encode_frame(snapshot)
+        for _ in range(args.recipients):
+            frame.data
+
+    print(f"fan-out to {args.recipients} recipients")
+    print(f"  json.dumps, text frames (old)     {timed(old_fanout, args.runs):8.2f} ms")
+    print(f"  encode once, text frames          {timed(once_text, args.runs):8.2f} ms")
+    print(f"  encode once, binary frames        {timed(once_bytes, args.runs):8.2f} ms")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,143 @@
+"""
+/server/list benchmark.
+
+Builds a scratch database, puts one user into a growing number of servers (each
+with a few channels and roles) and times the /server/list handler against the
+old per-server query loop. The statement count per request stays flat for the
+set-based version while the old loop issues two more statements per server; the
+remaining latency growth is the cost of building the (larger) response itself.
+
+    python bench_server_list.py                 # 1, 10, 50, 100, 250 servers
+    python bench_server_list.py 10 500 --runs 50
+"""
+import os
+import sys
+import time
+import uuid
+import tempfile
+import statistics
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASE_DIR)
+
+import database  # noqa: E402
+
+CHANNELS_PER_SERVER = 6
+ROLES_PER_SERVER = 3
+DEFAULT_COUNTS = [1, 10, 50, 100, 250]
+
+# Count every statement run on pooled connections.
+_statements = [0]
+_open_raw = database._open_raw_connection
+
+
+def _counting_connection():
+    conn = _open_raw()
+    conn.set_trace_callback(lambda _sql: _statements.__setitem__(0, _statements[0] + 1))
+    return conn
+
+
+database._open_raw_connection = _counting_connection
+
+
+def seed(user_id: int, count: int):
+    """Add the user to `count` new servers, each with channels, roles and assignments."""
+    conn = database.get_db_connection()
+    c = conn.cursor()
+    for i in range(count):
+        server_id = str(uuid.uuid4())
+        c.execute("INSERT INTO servers (id, name, owner_id, invite_code) VALUES (?, ?, ?, ?)",
+                  (server_id, f"Server {i}", user_id + 1, uuid.uuid4().hex[:6]))
+        c.execute("INSERT INTO members (server_id, user_id, role) VALUES (?, ?, 'member')",
+                  (server_id, user_id))
+        for pos in range(CHANNELS_PER_SERVER):
+            c.execute("INSERT INTO channels (id, server_id, name, type, position) VALUES (?, ?, ?, ?, ?)",
+                      (str(uuid.uuid4()), server_id, f"kanal-{pos}", "text" if pos % 2 else "voice", pos))
+        for pos in range(ROLES_PER_SERVER):
+            c.execute("INSERT INTO roles (server_id, name, color, position, permissions) VALUES (?, ?, ?, ?, ?)",
+                      (server_id, f"Rol {pos}", "#99AAB5", pos, 1 << pos))
+            if pos % 2 == 0:
+                c.execute("INSERT INTO user_roles (user_id, role_id, server_id) VALUES (?, ?, ?)",
+                          (user_id, c.lastrowid, server_id))
+    conn.commit()
+    conn.close()
+
+
+def legacy_list(token: str):
+    """The previous implementation: one channel query + one permission resolve per server."""
+    from utils import get_session_user, get_user_permissions
+    conn = database.get_db_connection()
+    c = conn.cursor()
+    user = get_session_user(token)
+    c.execute('''
+        SELECT s.id, s.name, s.invite_code, s.owner_id
+        FROM servers s
+        JOIN members m ON s.id = m.server_id
+        WHERE m.user_id = ?
+    ''', (user['id'],))
+    servers = [dict(row) for row in c.fetchall()]
+    for s in servers:
+        c.execute("SELECT id, name, type FROM channels WHERE server_id = ?", (s['id'],))
+        s['channels'] = [dict(row) for row in c.fetchall()]
+        s['my_permissions'] = get_user_permissions(user['id'], s['id'])
+    conn.close()
+    return {"status": "success", "servers": servers}
+
+
+def measure(fn, token: str, user_id: int, runs: int, cold: bool):
+    from utils import invalidate_permissions
+    timings, statements = [], []
+    for _ in range(runs):
+        if cold:
+            invalidate_permissions(user_id=user_id)
+        _statements[0] = 0
+        start = time.perf_counter()
+        result = fn(token)
+        timings.append((time.perf_counter() - start) * 1000)
+        statements.append(_statements[0])
+        assert result["status"] == "success", result
+    return statistics.median(timings), max(statements)
+
+
+def main(argv):
+    runs = 30
+    if "--runs" in argv:
+        i = argv.index("--runs")
+        runs = int(argv[i + 1])
+        del argv[i:i + 2]
+    counts = sorted(int(a) for a in argv) if argv else DEFAULT_COUNTS
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, "bench.db")
+        database.init_db()
+
+        from routers.server import list_user_servers
+        handler = list_user_servers.__wrapped__  # time the DB work, not the executor hop
+
+        conn = database.get_db_connection()
+        token = uuid.uuid4().hex
+        c = conn.cursor()
+        c.execute("INSERT INTO users (username, discriminator, password_hash, display_name, token) "
+                  "VALUES ('bench', '0001', 'x', 'bench', ?)", (token,))
+        user_id = c.lastrowid
+        conn.commit()
+        conn.close()
+
+        print(f"{runs} runs per size, median latency in ms (statements per request)")
+        print(f"{'servers':>8} | {'set-based cold':>16} | {'set-based warm':>16} | {'per-server loop':>16}")
+        print("-" * 66)
+        seeded = 0
+        for count in counts:
+            seed(user_id, count - seeded)
+            seeded = count
+            new_cold = measure(handler, token, user_id, runs, cold=True)
+            new_warm = measure(handler, token, user_id, runs, cold=False)
+            old_cold = measure(legacy_list, token, user_id, runs, cold=True)
+            row = [f"{ms:8.2f} ({n:>4})" for ms, n in (new_cold, new_warm, old_cold)]
+            print(f"{count:>8} | {row[0]:>16} | {row[1]:>16} | {row[2]:>16}")
+
+        database.close_pool()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
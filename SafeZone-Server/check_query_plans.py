@@ -0,0 +1,177 @@
+"""
+Query plan checker.
+
+Collects every SQL statement passed to `.execute(...)` / `enqueue_write(...)` /
+`write_async(...)` in the server sources, runs `EXPLAIN QUERY PLAN` for each one
+against a fresh, fully migrated scratch database and reports any statement that
+falls back to a full table scan.
+
+    python check_query_plans.py            # exit code 1 if an unexpected scan is found
+    python check_query_plans.py --verbose  # print the plan of every statement
+
+f-string queries are checked with every interpolation replaced by `?`, which is
+what the code interpolates in practice (IN-list placeholders). `keyset_page(...)`
+calls are expanded into the page query they run (see pagination.py) and must
+not need a sort ("USE TEMP B-TREE") either. Statements that
+only make sense as scans (admin listings, one-off maintenance) are listed in
+ALLOWED_SCANS together with the reason.
+"""
+import ast
+import os
+import re
+import sys
+import sqlite3
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCES = ["database.py", "utils.py", "state.py", "message_cache.py", "search.py", "uploads.py", "thumbnails.py", "upload_gc.py", "link_preview.py", "routers"]
+SQL_CALLS = {"execute", "executemany", "enqueue_write", "write_async"}
+
+# (file, function) -> reason. Scans inside these are expected.
+ALLOWED_SCANS = {
+    ("routers/admin.py", "get_users"): "admin user listing reads the whole table",
+    ("routers/admin.py", "get_servers"): "admin server listing reads the whole table",
+    ("routers/admin.py", "get_stats"): "admin dashboard counts",
+    ("database.py", "_get_applied_versions"): "migration bookkeeping",
+    ("search.py", "_load_progress"): "one row per indexed table",
+    ("search.py", "search_dms"): "LIKE fallback while the DM search backfill runs",
+}
+
+# "SCAN t" is a full table scan; "SCAN t USING [COVERING] INDEX" walks an index,
+# "SCAN t VIRTUAL TABLE INDEX ..." is an FTS5 lookup and "SCAN CONSTANT ROW" is
+# a FROM-less SELECT.
+_SCAN_RE = re.compile(r"^SCAN (?!CONSTANT ROW)(\w+)\b(?! USING| VIRTUAL TABLE)")
+
+
+def _sql_from_node(node):
+    """Return the SQL text of a string / f-string AST node, or None."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.JoinedStr):
+        parts = []
+        for value in node.values:
+            if isinstance(value, ast.Constant):
+                parts.append(value.value)
+            else:
+                parts.append("?")
+        return "".join(parts)
+    return None
+
+
+def collect_queries():
+    """Yield (relative_path, function_name, lineno, sql) for every literal query."""
+    files = []
+    for entry in SOURCES:
+        path = os.path.join(BASE_DIR, entry)
+        if os.path.isdir(path):
+            files += [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(".py")]
+        else:
+            files.append(path)
+
+    for path in files:
+        rel = os.path.relpath(path, BASE_DIR).replace(os.sep, "/")
+        with open(path, encoding="utf-8") as f:
+            tree = ast.parse(f.read(), filename=rel)
+        for func in ast.walk(tree):
+            if not isinstance(func, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                continue
+            for node in ast.walk(func):
+                if not isinstance(node, ast.Call) or not node.args:
+                    continue
+                name = getattr(node.func, "attr", None) or getattr(node.func, "id", None)
+                if name == "keyset_page":
+                    for stmt in _keyset_queries(node):
+                        yield rel, func.name, node.lineno, stmt
+                    continue
+                if name not in SQL_CALLS:
+                    continue
+                sql = _sql_from_node(node.args[0])
+                if sql is None:
+                    continue
+                stmt = sql.strip().rstrip(";").strip()
+                if not re.match(r"(?is)^(SELECT|UPDATE|DELETE|INSERT|WITH|REPLACE)\b", stmt):
+                    continue  # DDL / PRAGMA / transaction control
+                yield rel, func.name, node.lineno, stmt
+
+
+def _keyset_queries(node):
+    """The per-partition page queries of a keyset_page(c, select, [(where, params), ...]) call."""
+    if len(node.args) < 3 or not isinstance(node.args[2], ast.List):
+        return
+    select = _sql_from_node(node.args[1])
+    id_column = "id"
+    for kw in node.keywords:
+        if kw.arg == "id_column" and isinstance(kw.value, ast.Constant):
+            id_column = kw.value.value
+    for part in node.args[2].elts:
+        where = _sql_from_node(part.elts[0]) if isinstance(part, ast.Tuple) else None
+        if select is None or where is None:
+            continue
+        yield (f"{select.strip()} WHERE {where} AND {id_column} < ? "
+               f"ORDER BY {id_column} DESC LIMIT ?  /* keyset */")
+
+
+def build_scratch_db(path):
+    """Create an empty database with the full migrated schema at `path`."""
+    sys.path.insert(0, BASE_DIR)
+    import database
+    database.DB_NAME = path
+    database.init_db()
+    database.close_pool()
+
+
+def explain(conn, sql):
+    params = (None,) * sql.count("?")
+    rows = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    return [row[3] for row in rows]
+
+
+def main(argv):
+    verbose = "--verbose" in argv
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "plan_check.db")
+        build_scratch_db(db_path)
+        conn = sqlite3.connect(db_path)
+
+        seen = set()
+        failures, allowed, errors, checked = [], [], [], 0
+        for rel, func, lineno, sql in collect_queries():
+            key = (rel, func, " ".join(sql.split()))
+            if key in seen:
+                continue
+            seen.add(key)
+            try:
+                plan = explain(conn, sql)
+            except sqlite3.Error as e:
+                errors.append((rel, func, lineno, str(e)))
+                continue
+            checked += 1
+            scans = [line for line in plan if _SCAN_RE.match(line)]
+            if sql.endswith("/* keyset */"):
+                scans += [line for line in plan if line.startswith("USE TEMP B-TREE")]
+            if verbose:
+                print(f"{rel}:{lineno} {func}")
+                for line in plan:
+                    print(f"    {line}")
+            if not scans:
+                continue
+            if (rel, func) in ALLOWED_SCANS:
+                allowed.append((rel, func, lineno, scans))
+            else:
+                failures.append((rel, func, lineno, scans, sql))
+        conn.close()
+
+    print(f"Checked {checked} statements: {len(failures)} table scan(s), "
+          f"{len(allowed)} allowed, {len(errors)} not explainable")
+    for rel, func, lineno, msg in errors:
+        print(f"  SKIP  {rel}:{lineno} {func}: {msg}")
+    for rel, func, lineno, scans in allowed:
+        print(f"  ALLOW {rel}:{lineno} {func}: {', '.join(scans)} ({ALLOWED_SCANS[(rel, func)]})")
+    for rel, func, lineno, scans, sql in failures:
+        print(f"  FAIL  {rel}:{lineno} {func}: {', '.join(scans)}")
+        print("        " + " ".join(sql.split())[:200])
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,35 +1,241 @@
 import sqlite3
 import os
 import secrets
+import threading
+import time
+import asyncio
+import functools
+import queue
 import bcrypt
+from loguru import logger
+from concurrent.futures import ThreadPoolExecutor, Future
 from contextlib import contextmanager
 
 DB_NAME = "safezone.db"
 
+# ─────────────────────────────────────────────────────────────────────────────
+#  Connection Pool
+#
+#  Opening a connection and running the PRAGMAs (journal_mode=WAL in particular)
+#  used to dominate per-request latency. Connections are now opened once, kept
+#  in a bounded pool and handed out one caller at a time:
+#   - get_db_connection() checks a connection out; conn.close() returns it.
+#   - PRAGMAs are applied once, when the underlying connection is created.
+#   - A connection that sat idle for a while is health-checked (SELECT 1)
+#     before reuse; broken ones are discarded and replaced.
+#   - On return, any open transaction is rolled back and row_factory is reset,
+#     so a caller can never leak state into the next checkout.
+#  Pool size and wait timeout can be tuned via environment variables.
+# ─────────────────────────────────────────────────────────────────────────────
+
+DB_POOL_MAX_SIZE = int(os.environ.get("SAFEZONE_DB_POOL_SIZE", "16"))
+DB_POOL_TIMEOUT = float(os.environ.get("SAFEZONE_DB_POOL_TIMEOUT", "10"))
+_HEALTH_CHECK_IDLE_SECONDS = 30.0
+
+
+def _open_raw_connection() -> sqlite3.Connection:
+    """Open a new SQLite connection and apply the standard PRAGMA settings."""
+    # check_same_thread=False: a pooled connection may be checked out by a
+    # different thread than the one that created it (never by two at once).
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # WAL mode: prevents "database is locked" errors under concurrent WebSocket writes
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")  # Safe performance boost with WAL
+    conn.execute("PRAGMA foreign_keys = ON;")
+    return conn
+
+
+class ConnectionPool:
+    """Bounded pool of reusable SQLite connections."""
+
+    def __init__(self, max_size: int = DB_POOL_MAX_SIZE, timeout: float = DB_POOL_TIMEOUT):
+        self.max_size = max_size
+        self.timeout = timeout
+        # RLock: release() may run from PooledConnection.__del__ while this
+        # thread is already inside the pool.
+        self._cond = threading.Condition(threading.RLock())
+        self._idle: list[tuple[sqlite3.Connection, float]] = []  # (conn, returned_at)
+        self._size = 0  # open connections, idle + checked out
+        self._stats = {"checkouts": 0, "waits": 0, "timeouts": 0, "created": 0, "discarded": 0}
+
+    def acquire(self) -> sqlite3.Connection:
+        """Check out a connection, waiting up to `timeout` if the pool is exhausted."""
+        deadline = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    raw, returned_at = self._idle.pop()  # LIFO: reuse the warmest connection
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    raw = None
+                    break
+                if deadline is None:
+                    self._stats["waits"] += 1
+                    deadline = time.monotonic() + self.timeout
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise sqlite3.OperationalError("Database connection pool exhausted")
+                self._cond.wait(remaining)
+            self._stats["checkouts"] += 1
+
+        if raw is not None and time.monotonic() - returned_at > _HEALTH_CHECK_IDLE_SECONDS:
+            if not self._is_healthy(raw):
+                # Keep the slot, replace the connection
+                self._close_quietly(raw)
+                raw = None
+                with self._cond:
+                    self._stats["discarded"] += 1
+
+        if raw is None:
+            try:
+                raw = _open_raw_connection()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._stats["created"] += 1
+        return raw
+
+    def release(self, raw: sqlite3.Connection):
+        """Return a connection to the pool, resetting any per-checkout state."""
+        try:
+            if raw.in_transaction:
+                raw.rollback()
+            raw.row_factory = sqlite3.Row
+        except sqlite3.Error:
+            self._discard(raw)
+            return
+        with self._cond:
+            self._idle.append((raw, time.monotonic()))
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(raw: sqlite3.Connection):
+        try:
+            raw.close()
+        except sqlite3.Error:
+            pass
+
+    def _discard(self, raw: sqlite3.Connection):
+        self._close_quietly(raw)
+        with self._cond:
+            self._size -= 1
+            self._stats["discarded"] += 1
+            self._cond.notify()
+
+    @staticmethod
+    def _is_healthy(raw: sqlite3.Connection) -> bool:
+        try:
+            raw.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def close_all(self):
+        """Close every idle connection (checked-out ones are closed on return)."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for raw, _ in idle:
+            self._discard(raw)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                **self._stats,
+            }
+
+
+class PooledConnection:
+    """
+    Thin proxy around a pooled sqlite3.Connection.
+    Behaves like the real connection, except that close() hands it back to the
+    pool instead of closing it. A proxy that is dropped without close() (e.g.
+    an early return) is returned to the pool when it is garbage-collected.
+    """
+
+    __slots__ = ("_pool", "_raw")
+
+    def __init__(self, pool: ConnectionPool, raw: sqlite3.Connection):
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_raw", raw)
+
+    def __getattr__(self, name):
+        raw = object.__getattribute__(self, "_raw")
+        if raw is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(raw, name)
+
+    def __setattr__(self, name, value):
+        # e.g. conn.row_factory = ... — applied to the real connection, reset on release
+        setattr(self._raw, name, value)
+
+    def close(self):
+        raw = self._raw
+        if raw is None:
+            return
+        object.__setattr__(self, "_raw", None)
+        self._pool.release(raw)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self._raw.commit()
+            else:
+                self._raw.rollback()
+        finally:
+            self.close()
+        return False
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+_pool = ConnectionPool()
+
+
 def get_db_connection():
     """
-    Get a database connection with standard PRAGMA settings.
+    Get a pooled database connection with standard PRAGMA settings.
     Can be used as a regular call or as a context manager:
 
         # Traditional (still works):
         conn = get_db_connection()
         c = conn.cursor()
         ...
-        conn.close()
+        conn.close()   # returns the connection to the pool
 
-        # Context manager (recommended — auto-close on exception):
+        # Context manager (recommended — commit/rollback + auto-close):
         with get_db_connection() as conn:
             c = conn.cursor()
             ...
-            # conn.close() is called automatically
+            # committed (or rolled back on exception) and returned automatically
     """
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    # WAL mode: prevents "database is locked" errors under concurrent WebSocket writes
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA synchronous=NORMAL;")  # Safe performance boost with WAL
-    conn.execute("PRAGMA foreign_keys = ON;")
-    return conn
+    return PooledConnection(_pool, _pool.acquire())
+
+
+def pool_stats() -> dict:
+    """Connection pool counters: size, idle, in_use, checkouts, waits, ..."""
+    return _pool.stats()
+
+
+def close_pool():
+    """Close all idle pooled connections (called on server shutdown)."""
+    _pool.close_all()
 
 
 @contextmanager
@@ -55,6 +261,317 @@ def db_connection():
         conn.close()
 
 
+# ─────────────────────────────────────────────────────────────────────────────
+#  Async Database Executor
+#
+#  sqlite3 is blocking. Calling it from an `async def` handler stalls the
+#  event loop — and with it every lobby/room WebSocket in the process — for
+#  the duration of the query. Blocking DB work is therefore shipped to a
+#  dedicated thread pool and awaited:
+#
+#      user = await run_db(get_user_by_token, token)
+#
+#      @router.get("/something")
+#      @db_offload              # whole handler body runs on the DB executor
+#      def something(token: str): ...
+#
+#  Keep DB_EXECUTOR_WORKERS below DB_POOL_MAX_SIZE: a job may hold more than
+#  one pooled connection at a time (e.g. a handler plus check_permission).
+# ─────────────────────────────────────────────────────────────────────────────
+
+DB_EXECUTOR_WORKERS = int(os.environ.get("SAFEZONE_DB_WORKERS", "6"))
+
+
+class DatabaseExecutor:
+    """Thread pool for blocking DB work, with queue-depth metrics."""
+
+    def __init__(self, max_workers: int = DB_EXECUTOR_WORKERS):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="safezone-db")
+        self._lock = threading.Lock()
+        self._queued = 0   # submitted, waiting for a worker
+        self._active = 0   # currently running on a worker
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "max_queue_depth": 0,
+                       "total_wait_ms": 0.0, "total_run_ms": 0.0}
+
+    async def run(self, fn, *args, **kwargs):
+        """Run `fn(*args, **kwargs)` on a worker thread and await its result."""
+        submitted_at = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+            self._stats["submitted"] += 1
+            if self._queued > self._stats["max_queue_depth"]:
+                self._stats["max_queue_depth"] = self._queued
+
+        def job():
+            started_at = time.perf_counter()
+            with self._lock:
+                self._queued -= 1
+                self._active += 1
+                self._stats["total_wait_ms"] += (started_at - submitted_at) * 1000
+            failed = False
+            try:
+                return fn(*args, **kwargs)
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._stats["total_run_ms"] += (time.perf_counter() - started_at) * 1000
+                    self._stats["failed" if failed else "completed"] += 1
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, job)
+
+    def stats(self) -> dict:
+        with self._lock:
+            done = self._stats["completed"] + self._stats["failed"]
+            return {
+                "workers": self.max_workers,
+                "queue_depth": self._queued,
+                "active": self._active,
+                **{k: v for k, v in self._stats.items() if not k.startswith("total_")},
+                "avg_wait_ms": round(self._stats["total_wait_ms"] / done, 3) if done else 0.0,
+                "avg_run_ms": round(self._stats["total_run_ms"] / done, 3) if done else 0.0,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+_db_executor = DatabaseExecutor()
+
+
+async def run_db(fn, *args, **kwargs):
+    """Await a blocking DB function without blocking the event loop."""
+    return await _db_executor.run(fn, *args, **kwargs)
+
+
+def db_offload(fn):
+    """
+    Decorator for route handlers whose body is plain blocking DB work.
+    Turns a sync `def` into an awaitable that runs on the DB executor;
+    FastAPI still sees the original signature through functools.wraps.
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await _db_executor.run(fn, *args, **kwargs)
+    return wrapper
+
+
+def db_executor_stats() -> dict:
+    """DB executor counters: workers, queue_depth, active, avg wait/run time, ..."""
+    return _db_executor.stats()
+
+
+def shutdown_db_executor():
+    """Wait for in-flight DB jobs to finish (called on server shutdown)."""
+    _db_executor.shutdown()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  Batched Write Queue
+#
+#  High-frequency small writes (chat messages, voice logs, presence status,
+#  audit entries) used to each open a connection and commit on their own: one
+#  fsync per event, and every writer fighting for the WAL write lock. They now
+#  go through a single writer thread that group-commits:
+#   - enqueue_write(sql, params) returns a concurrent Future resolved with the
+#     statement's lastrowid once its batch has committed.
+#   - await write_async(sql, params) is the same thing for async callers.
+#   - The writer waits at most DB_WRITE_FLUSH_MS after the first queued op, or
+#     until DB_WRITE_BATCH_SIZE ops are queued, then commits them together.
+#   - Each op runs inside its own SAVEPOINT, so one failing statement only
+#     fails its own future — the rest of the batch still commits.
+#  Fire-and-forget callers can ignore the returned future; failures are logged.
+#  An op whose future was cancelled before the writer reached it (an awaiting
+#  coroutine was cancelled) is skipped; once running it can't be cancelled.
+# ─────────────────────────────────────────────────────────────────────────────
+
+DB_WRITE_FLUSH_MS = float(os.environ.get("SAFEZONE_DB_WRITE_FLUSH_MS", "5"))
+DB_WRITE_BATCH_SIZE = int(os.environ.get("SAFEZONE_DB_WRITE_BATCH_SIZE", "200"))
+
+_STOP = object()
+
+
+class WriteQueue:
+    """Single-writer queue that group-commits small write statements."""
+
+    def __init__(self, flush_ms: float = DB_WRITE_FLUSH_MS, max_batch: int = DB_WRITE_BATCH_SIZE):
+        self.flush_interval = flush_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: threading.Thread = None
+        self._lock = threading.Lock()
+        self._stats = {"enqueued": 0, "written": 0, "failed": 0, "cancelled": 0, "batches": 0,
+                       "commit_failures": 0, "max_batch": 0, "total_commit_ms": 0.0}
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="safezone-db-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, sql: str, params=()) -> Future:
+        """Queue one write statement; the future resolves to its lastrowid."""
+        fut = Future()
+        with self._lock:
+            self._stats["enqueued"] += 1
+        self._ensure_started()
+        self._queue.put((sql, tuple(params), fut))
+        return fut
+
+    def _run(self):
+        conn = None
+        batch = []
+        try:
+            conn = _open_raw_connection()
+            conn.isolation_level = None  # explicit BEGIN/COMMIT below
+            stopping = False
+            while not stopping:
+                op = self._queue.get()
+                if op is _STOP:
+                    break
+                batch = [op]
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    try:
+                        op = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if op is _STOP:
+                        stopping = True
+                        break
+                    batch.append(op)
+                self._write_batch(conn, batch)
+                batch = []
+        except Exception as e:
+            # Don't strand anyone: fail the batch in hand and everything queued
+            # behind it; the next submit() starts a fresh writer
+            logger.exception("DB writer stopped")
+            self._fail_pending(batch, e)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _fail_pending(self, batch: list, exc: Exception):
+        while True:
+            try:
+                op = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if op is not _STOP:
+                batch.append(op)
+        failed = 0
+        for _, _, fut in batch:
+            if fut.done():
+                continue
+            # running: this writer claimed it; pending: claim it unless it was cancelled
+            if fut.running() or fut.set_running_or_notify_cancel():
+                fut.set_exception(exc)
+                failed += 1
+        with self._lock:
+            self._stats["failed"] += failed
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: list):
+        started_at = time.perf_counter()
+        # Claim each future; one cancelled meanwhile is dropped instead of written
+        claimed = [op for op in batch if op[2].set_running_or_notify_cancel()]
+        if len(claimed) < len(batch):
+            with self._lock:
+                self._stats["cancelled"] += len(batch) - len(claimed)
+        batch = claimed
+        if not batch:
+            return
+        results = []  # (future, lastrowid | exception)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for sql, params, fut in batch:
+                conn.execute("SAVEPOINT op")
+                try:
+                    cur = conn.execute(sql, params)
+                    conn.execute("RELEASE op")
+                    results.append((fut, cur.lastrowid))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    results.append((fut, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            # The whole transaction is gone: fail every op that hasn't failed already.
+            logger.exception(f"Write batch of {len(batch)} ops failed to commit")
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            with self._lock:
+                self._stats["commit_failures"] += 1
+                self._stats["failed"] += len(batch)
+            for _, _, fut in batch:
+                fut.set_exception(e)
+            return
+
+        failed = 0
+        for fut, outcome in results:
+            if isinstance(outcome, Exception):
+                failed += 1
+                logger.error(f"Queued write failed: {outcome}")
+                fut.set_exception(outcome)
+            else:
+                fut.set_result(outcome)
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["written"] += len(batch) - failed
+            self._stats["failed"] += failed
+            self._stats["max_batch"] = max(self._stats["max_batch"], len(batch))
+            self._stats["total_commit_ms"] += (time.perf_counter() - started_at) * 1000
+
+    def stats(self) -> dict:
+        with self._lock:
+            batches = self._stats["batches"]
+            return {
+                "flush_ms": self.flush_interval * 1000,
+                "max_batch_size": self.max_batch,
+                "queue_depth": self._queue.qsize(),
+                **{k: v for k, v in self._stats.items() if not k.startswith("total_")},
+                "avg_batch": round(self._stats["written"] / batches, 2) if batches else 0.0,
+                "avg_commit_ms": round(self._stats["total_commit_ms"] / batches, 3) if batches else 0.0,
+            }
+
+    def shutdown(self):
+        """Flush everything already queued, then stop the writer thread."""
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join()
+        self._thread = None
+
+
+_write_queue = WriteQueue()
+
+
+def enqueue_write(sql: str, params=()) -> Future:
+    """Queue a write for the next group commit. Future result: lastrowid."""
+    return _write_queue.submit(sql, params)
+
+
+async def write_async(sql: str, params=()):
+    """Queue a write and await its commit; returns lastrowid."""
+    return await asyncio.wrap_future(_write_queue.submit(sql, params))
+
+
+def write_queue_stats() -> dict:
+    """Writer counters: queue_depth, batches, avg_batch, avg_commit_ms, ..."""
+    return _write_queue.stats()
+
+
+def shutdown_write_queue():
+    """Commit pending queued writes and stop the writer (called on shutdown)."""
+    _write_queue.shutdown()
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 #  Versioned Migration System
 #
@@ -286,6 +803,252 @@ MIGRATIONS = [
          FOREIGN KEY(blocked_id) REFERENCES users(id) ON DELETE CASCADE
      );
      """),
+
+    # ── v5: secondary indexes for hot lookups (verify with check_query_plans.py)
+    #    users.username / message_reactions.message_id / members(server_id, …)
+    #    are already served by the UNIQUE / PRIMARY KEY autoindexes.
+    (5, "Add indexes for hot query paths",
+     """
+     CREATE INDEX IF NOT EXISTS idx_users_token ON users(token);
+     CREATE INDEX IF NOT EXISTS idx_members_user ON members(user_id, server_id);
+     CREATE INDEX IF NOT EXISTS idx_channels_server ON channels(server_id, position);
+     CREATE INDEX IF NOT EXISTS idx_categories_server ON categories(server_id, position);
+     CREATE INDEX IF NOT EXISTS idx_roles_server ON roles(server_id, position);
+     CREATE INDEX IF NOT EXISTS idx_user_roles_server_user ON user_roles(server_id, user_id);
+     CREATE INDEX IF NOT EXISTS idx_user_roles_role ON user_roles(role_id);
+     CREATE INDEX IF NOT EXISTS idx_channel_messages_channel_ts ON channel_messages(channel_id, timestamp);
+     CREATE INDEX IF NOT EXISTS idx_channel_messages_pinned ON channel_messages(channel_id, timestamp) WHERE is_pinned = 1;
+     CREATE INDEX IF NOT EXISTS idx_channel_messages_sender ON channel_messages(sender_id);
+     CREATE INDEX IF NOT EXISTS idx_messages_pair_ts ON messages(sender_id, receiver_id, timestamp);
+     CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages(receiver_id);
+     CREATE INDEX IF NOT EXISTS idx_voice_logs_channel_ts ON voice_logs(channel_id, timestamp);
+     CREATE INDEX IF NOT EXISTS idx_audit_log_server_created ON audit_log(server_id, created_at);
+     CREATE INDEX IF NOT EXISTS idx_invites_server ON invites(server_id, created_at);
+     CREATE INDEX IF NOT EXISTS idx_friends_friend ON friends(friend_id);
+     CREATE INDEX IF NOT EXISTS idx_friend_requests_receiver ON friend_requests(receiver_id);
+     CREATE INDEX IF NOT EXISTS idx_block_list_blocked ON block_list(blocked_id);
+     CREATE INDEX IF NOT EXISTS idx_message_edit_history_message ON message_edit_history(message_id);
+     CREATE INDEX IF NOT EXISTS idx_users_sysadmin ON users(id) WHERE is_sysadmin = 1;
+     CREATE INDEX IF NOT EXISTS idx_channels_category ON channels(category_id);
+
+     -- message_edits used to be created lazily by /message/edit; make it part of the schema
+     CREATE TABLE IF NOT EXISTS message_edits (
+         id INTEGER PRIMARY KEY AUTOINCREMENT,
+         message_id INTEGER NOT NULL,
+         content TEXT NOT NULL,
+         edited_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+         FOREIGN KEY(message_id) REFERENCES channel_messages(id) ON DELETE CASCADE
+     );
+     CREATE INDEX IF NOT EXISTS idx_message_edits_message ON message_edits(message_id, edited_at);
+     """),
+
+    # ── v6: make (server_id, user_id) covering for role_id. Without it the
+    #    planner prefers the (user_id, role_id, server_id) PK autoindex in the
+    #    bulk permission resolve and walks every assignment of the user per server.
+    (6, "Cover role_id in user_roles(server_id, user_id) index",
+     """
+     DROP INDEX IF EXISTS idx_user_roles_server_user;
+     CREATE INDEX IF NOT EXISTS idx_user_roles_server_user ON user_roles(server_id, user_id, role_id);
+     """),
+
+    # ── v7: keyset pagination (see pagination.py). History pages walk
+    #    (scope, id) ranges, so each paged table gets a (scope, id) index; the
+    #    timestamp-ordered ones they replace have no other readers.
+    #    channel_messages(channel_id, timestamp) stays for search and pins.
+    (7, "Add (scope, id) indexes for keyset-paginated history",
+     """
+     CREATE INDEX IF NOT EXISTS idx_channel_messages_channel_id ON channel_messages(channel_id, id);
+     DROP INDEX IF EXISTS idx_messages_pair_ts;
+     CREATE INDEX IF NOT EXISTS idx_messages_pair_id ON messages(sender_id, receiver_id, id);
+     DROP INDEX IF EXISTS idx_voice_logs_channel_ts;
+     CREATE INDEX IF NOT EXISTS idx_voice_logs_channel_id ON voice_logs(channel_id, id);
+     DROP INDEX IF EXISTS idx_audit_log_server_created;
+     CREATE INDEX IF NOT EXISTS idx_audit_log_server_id ON audit_log(server_id, id);
+     """),
+
+    # ── v8: full-text search (see search.py). FTS rowid = message id; triggers
+    #    index every new / edited / deleted message. Rows older than this
+    #    migration are indexed by the background backfill up to high_id.
+    (8, "Add FTS5 search indexes for channel and direct messages",
+     """
+     CREATE VIRTUAL TABLE IF NOT EXISTS channel_messages_fts USING fts5(
+         content, tokenize = 'unicode61 remove_diacritics 2'
+     );
+     CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+         content, tokenize = 'unicode61 remove_diacritics 2'
+     );
+
+     CREATE TRIGGER IF NOT EXISTS channel_messages_fts_insert AFTER INSERT ON channel_messages BEGIN
+         INSERT INTO channel_messages_fts (rowid, content) VALUES (new.id, new.content);
+     END;
+     CREATE TRIGGER IF NOT EXISTS channel_messages_fts_update AFTER UPDATE OF content ON channel_messages BEGIN
+         DELETE FROM channel_messages_fts WHERE rowid = old.id;
+         INSERT INTO channel_messages_fts (rowid, content) VALUES (new.id, new.content);
+     END;
+     CREATE TRIGGER IF NOT EXISTS channel_messages_fts_delete AFTER DELETE ON channel_messages BEGIN
+         DELETE FROM channel_messages_fts WHERE rowid = old.id;
+     END;
+
+     CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+         INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+     END;
+     CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+         DELETE FROM messages_fts WHERE rowid = old.id;
+         INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+     END;
+     CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+         DELETE FROM messages_fts WHERE rowid = old.id;
+     END;
+
+     CREATE TABLE IF NOT EXISTS search_backfill (
+         source TEXT PRIMARY KEY,
+         next_id INTEGER NOT NULL,
+         high_id INTEGER NOT NULL
+     );
+     INSERT OR IGNORE INTO search_backfill (source, next_id, high_id)
+         SELECT 'channel_messages', 0, COALESCE(MAX(id), 0) FROM channel_messages;
+     INSERT OR IGNORE INTO search_backfill (source, next_id, high_id)
+         SELECT 'messages', 0, COALESCE(MAX(id), 0) FROM messages;
+     """),
+
+    # ── v9: materialized reaction aggregates. One row per (message, emoji) with
+    #    the count and the first 20 reactors' usernames (REACTION_USERS_SHOWN in
+    #    message_cache.py), kept by triggers so cascades and renames are covered.
+    #    History and reaction broadcasts read these rows instead of every reaction.
+    (9, "Add materialized reaction counts",
+     """
+     CREATE INDEX IF NOT EXISTS idx_message_reactions_emoji ON message_reactions(message_id, emoji);
+     CREATE INDEX IF NOT EXISTS idx_message_reactions_user ON message_reactions(user_id);
+
+     CREATE TABLE IF NOT EXISTS message_reaction_counts (
+         message_id INTEGER NOT NULL,
+         emoji TEXT NOT NULL,
+         count INTEGER NOT NULL,
+         users TEXT NOT NULL,
+         PRIMARY KEY (message_id, emoji),
+         FOREIGN KEY(message_id) REFERENCES channel_messages(id) ON DELETE CASCADE
+     );
+
+     INSERT OR IGNORE INTO message_reaction_counts (message_id, emoji, count, users)
+         SELECT g.message_id, g.emoji, COUNT(*),
+                (SELECT json_group_array(username) FROM (
+                     SELECT u.username FROM message_reactions mr JOIN users u ON u.id = mr.user_id
+                     WHERE mr.message_id = g.message_id AND mr.emoji = g.emoji
+                     ORDER BY mr.id LIMIT 20))
+         FROM message_reactions g
+         GROUP BY g.message_id, g.emoji;
+
+     CREATE TRIGGER IF NOT EXISTS message_reaction_counts_insert AFTER INSERT ON message_reactions BEGIN
+         INSERT INTO message_reaction_counts (message_id, emoji, count, users)
+         VALUES (new.message_id, new.emoji, 1,
+                 json_array((SELECT username FROM users WHERE id = new.user_id)))
+         ON CONFLICT(message_id, emoji) DO UPDATE SET
+             count = count + 1,
+             users = CASE WHEN json_array_length(users) < 20
+                          THEN json_insert(users, '$[#]', (SELECT username FROM users WHERE id = new.user_id))
+                          ELSE users END;
+     END;
+     CREATE TRIGGER IF NOT EXISTS message_reaction_counts_delete AFTER DELETE ON message_reactions BEGIN
+         UPDATE message_reaction_counts SET
+             count = count - 1,
+             users = (SELECT json_group_array(username) FROM (
+                          SELECT u.username FROM message_reactions mr JOIN users u ON u.id = mr.user_id
+                          WHERE mr.message_id = old.message_id AND mr.emoji = old.emoji
+                          ORDER BY mr.id LIMIT 20))
+         WHERE message_id = old.message_id AND emoji = old.emoji;
+         DELETE FROM message_reaction_counts
+         WHERE message_id = old.message_id AND emoji = old.emoji AND count <= 0;
+     END;
+     CREATE TRIGGER IF NOT EXISTS message_reaction_counts_rename AFTER UPDATE OF username ON users BEGIN
+         UPDATE message_reaction_counts SET
+             users = (SELECT json_group_array(username) FROM (
+                          SELECT u.username FROM message_reactions mr JOIN users u ON u.id = mr.user_id
+                          WHERE mr.message_id = message_reaction_counts.message_id
+                            AND mr.emoji = message_reaction_counts.emoji
+                          ORDER BY mr.id LIMIT 20))
+         WHERE (message_id, emoji) IN (SELECT message_id, emoji FROM message_reactions WHERE user_id = new.id);
+     END;
+     """),
+
+    # ── v10: content-addressed uploads (see uploads.py). One row per distinct
+    #    file content; ref_count is kept by triggers on every column that can
+    #    point at an upload (message attachments, avatars, server icons), so
+    #    cascading deletes are counted too. URLs that predate v10 match no row.
+    (10, "Add content-addressed attachment store with reference counts",
+     """
+     CREATE TABLE IF NOT EXISTS attachments (
+         hash TEXT PRIMARY KEY,
+         url TEXT NOT NULL UNIQUE,
+         size INTEGER NOT NULL,
+         ref_count INTEGER NOT NULL DEFAULT 0,
+         uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+     );
+
+     CREATE TRIGGER IF NOT EXISTS attachments_ref_message_insert AFTER INSERT ON channel_messages
+     WHEN new.attachment_url IS NOT NULL BEGIN
+         UPDATE attachments SET ref_count = ref_count + 1 WHERE url = new.attachment_url;
+     END;
+     CREATE TRIGGER IF NOT EXISTS attachments_ref_message_delete AFTER DELETE ON channel_messages
+     WHEN old.attachment_url IS NOT NULL BEGIN
+         UPDATE attachments SET ref_count = ref_count - 1 WHERE url = old.attachment_url;
+     END;
+     CREATE TRIGGER IF NOT EXISTS attachments_ref_message_update AFTER UPDATE OF attachment_url ON channel_messages
+     WHEN old.attachment_url IS NOT new.attachment_url BEGIN
+         UPDATE attachments SET ref_count = ref_count - 1 WHERE url = old.attachment_url;
+         UPDATE attachments SET ref_count = ref_count + 1 WHERE url = new.attachment_url;
+     END;
+
+     CREATE TRIGGER IF NOT EXISTS attachments_ref_avatar_update AFTER UPDATE OF avatar_url ON users
+     WHEN old.avatar_url IS NOT new.avatar_url BEGIN
+         UPDATE attachments SET ref_count = ref_count - 1 WHERE url = old.avatar_url;
+         UPDATE attachments SET ref_count = ref_count + 1 WHERE url = new.avatar_url;
+     END;
+     CREATE TRIGGER IF NOT EXISTS attachments_ref_avatar_delete AFTER DELETE ON users
+     WHEN old.avatar_url IS NOT NULL BEGIN
+         UPDATE attachments SET ref_count = ref_count - 1 WHERE url = old.avatar_url;
+     END;
+
+     CREATE TRIGGER IF NOT EXISTS attachments_ref_icon_update AFTER UPDATE OF icon_url ON servers
+     WHEN old.icon_url IS NOT new.icon_url BEGIN
+         UPDATE attachments SET ref_count = ref_count - 1 WHERE url = old.icon_url;
+         UPDATE attachments SET ref_count = ref_count + 1 WHERE url = new.icon_url;
+     END;
+     CREATE TRIGGER IF NOT EXISTS attachments_ref_icon_delete AFTER DELETE ON servers
+     WHEN old.icon_url IS NOT NULL BEGIN
+         UPDATE attachments SET ref_count = ref_count - 1 WHERE url = old.icon_url;
+     END;
+     """),
+
+    # ── v11: generated image variants (see thumbnails.py), as JSON
+    #    {variant: {url, width, height}} next to the original they belong to.
+    (11, "Add image variants (thumbnails, avatar sizes) to attachments",
+     """
+     ALTER TABLE attachments ADD COLUMN variants TEXT;
+     """),
+
+    # ── v12: lookups for the orphaned-upload collector (see upload_gc.py):
+    #    unreferenced attachments oldest first, and "is this pre-v10 upload
+    #    still used anywhere" per URL column. Partial, so they stay small.
+    (12, "Add indexes for orphaned-upload collection",
+     """
+     CREATE INDEX IF NOT EXISTS idx_attachments_orphaned ON attachments(uploaded_at, hash) WHERE ref_count <= 0;
+     CREATE INDEX IF NOT EXISTS idx_users_avatar_url ON users(avatar_url) WHERE avatar_url IS NOT NULL;
+     CREATE INDEX IF NOT EXISTS idx_servers_icon_url ON servers(icon_url) WHERE icon_url IS NOT NULL;
+     CREATE INDEX IF NOT EXISTS idx_channel_messages_attachment_url ON channel_messages(attachment_url)
+         WHERE attachment_url IS NOT NULL;
+     """),
+
+    # ── v13: link preview cache (see link_preview.py). Failed lookups are
+    #    stored too, with a shorter expiry.
+    (13, "Add link preview cache",
+     """
+     CREATE TABLE IF NOT EXISTS link_previews (
+         url TEXT PRIMARY KEY,
+         result TEXT NOT NULL,
+         expires_at INTEGER NOT NULL
+     );
+     CREATE INDEX IF NOT EXISTS idx_link_previews_expires ON link_previews(expires_at);
+     """),
 ]
 
 
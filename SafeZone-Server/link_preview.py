@@ -0,0 +1,235 @@
+"""
+Link previews (title, og:image, og:description of a shared URL).
+
+get_link_preview() never blocks the event loop:
+  - the hostname is resolved with the loop's getaddrinfo and every address it
+    resolves to must be public (SSRF guard; redirects are re-checked), unless
+    SAFEZONE_LINK_PREVIEW_ALLOW_PRIVATE is set (local test servers)
+  - the page is fetched on a small thread pool; at most
+    LINK_PREVIEW_CONCURRENCY fetches run at once, further ones wait
+  - concurrent requests for the same URL share one fetch
+
+Results are cached in a bounded in-memory LRU and in the link_previews table
+(migration v13), so a URL is fetched once per LINK_PREVIEW_TTL across restarts.
+Failures (not HTML, unreachable, internal address) are cached as well, for
+LINK_PREVIEW_NEGATIVE_TTL, so a broken link in a busy channel isn't re-fetched
+by every client that renders it.
+"""
+import os
+import re
+import json
+import time
+import socket
+import asyncio
+import ipaddress
+import threading
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, urldefrag
+
+from database import run_db, get_db_connection, write_async
+from utils import logger
+
+LINK_PREVIEW_TIMEOUT = float(os.environ.get("SAFEZONE_LINK_PREVIEW_TIMEOUT", "5"))
+LINK_PREVIEW_CONCURRENCY = int(os.environ.get("SAFEZONE_LINK_PREVIEW_CONCURRENCY", "8"))
+LINK_PREVIEW_TTL = int(os.environ.get("SAFEZONE_LINK_PREVIEW_TTL", str(24 * 3600)))
+LINK_PREVIEW_NEGATIVE_TTL = int(os.environ.get("SAFEZONE_LINK_PREVIEW_NEGATIVE_TTL", "3600"))
+LINK_PREVIEW_CACHE_SIZE = int(os.environ.get("SAFEZONE_LINK_PREVIEW_CACHE_SIZE", "2048"))
+LINK_PREVIEW_ALLOW_PRIVATE = os.environ.get("SAFEZONE_LINK_PREVIEW_ALLOW_PRIVATE", "0") == "1"
+LINK_PREVIEW_MAX_BYTES = 512_000
+LINK_PREVIEW_PURGE_EVERY = 500  # stores between deletions of expired rows
+USER_AGENT = "Mozilla/5.0 (compatible; SafeZone/1.0)"
+
+_executor = ThreadPoolExecutor(max_workers=LINK_PREVIEW_CONCURRENCY, thread_name_prefix="safezone-preview")
+_fetch_slots = asyncio.Semaphore(LINK_PREVIEW_CONCURRENCY)
+_lock = threading.Lock()
+_cache: "OrderedDict[str, tuple]" = OrderedDict()  # url -> (expires_at, result)
+_inflight: dict = {}                                 # url -> asyncio.Task of the shared fetch
+_stores = 0
+_stats = {"memory_hits": 0, "db_hits": 0, "fetches": 0, "coalesced": 0, "failures": 0, "blocked": 0}
+
+_TITLE_RE = re.compile(r'<title[^>]*>(.*?)</title>', re.IGNORECASE | re.DOTALL)
+_OG_IMAGE_RE = re.compile(r'<meta\s+property=["\']og:image["\']\s+content=["\'](.*?)["\']', re.IGNORECASE)
+_OG_DESC_RE = re.compile(r'<meta\s+property=["\']og:description["\']\s+content=["\'](.*?)["\']', re.IGNORECASE)
+
+NOT_ALLOWED = {"status": "error", "message": "Access to internal addresses is not allowed."}
+NOT_RESOLVED = {"status": "error", "message": "Could not resolve hostname."}
+NOT_HTML = {"status": "error", "message": "Not HTML"}
+NOT_FETCHED = {"status": "error", "message": "Could not fetch URL."}
+
+
+class _BlockedAddress(Exception):
+    pass
+
+
+# ── Address checks ───────────────────────────────────────────────────────────
+
+def _is_public(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    return not (ip.is_private or ip.is_loopback or ip.is_reserved or ip.is_link_local
+                or ip.is_multicast or ip.is_unspecified)
+
+
+def _check_addresses(infos):
+    if not LINK_PREVIEW_ALLOW_PRIVATE and not all(_is_public(info[4][0]) for info in infos):
+        raise _BlockedAddress()
+
+
+class _CheckedRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Applies the scheme and address checks to every redirect target (runs on the fetch pool)."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        parsed = urlparse(newurl)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            raise _BlockedAddress()
+        _check_addresses(socket.getaddrinfo(parsed.hostname, None, type=socket.SOCK_STREAM))
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+_opener = urllib.request.build_opener(_CheckedRedirectHandler)
+
+
+# ── Fetch ────────────────────────────────────────────────────────────────────
+
+def _fetch_page(url: str) -> dict:
+    """Download and scrape one page (blocking; runs on the fetch pool)."""
+    req = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+    with _opener.open(req, timeout=LINK_PREVIEW_TIMEOUT) as response:
+        if "text/html" not in response.headers.get("Content-Type", ""):
+            return NOT_HTML
+        html = response.read(LINK_PREVIEW_MAX_BYTES).decode("utf-8", errors="ignore")
+
+    title_match = _TITLE_RE.search(html)
+    image_match = _OG_IMAGE_RE.search(html)
+    desc_match = _OG_DESC_RE.search(html)
+    return {
+        "status": "success",
+        "title": title_match.group(1).strip() if title_match else url,
+        "image": image_match.group(1) if image_match else None,
+        "description": (desc_match.group(1) if desc_match else "")[:200],
+        "url": url,
+    }
+
+
+async def _fetch(url: str) -> dict:
+    parsed = urlparse(url)
+    loop = asyncio.get_running_loop()
+    async with _fetch_slots:
+        with _lock:
+            _stats["fetches"] += 1
+        try:
+            infos = await loop.getaddrinfo(parsed.hostname, None, type=socket.SOCK_STREAM)
+            _check_addresses(infos)
+            return await loop.run_in_executor(_executor, _fetch_page, url)
+        except _BlockedAddress:
+            with _lock:
+                _stats["blocked"] += 1
+            return NOT_ALLOWED
+        except socket.gaierror:
+            return NOT_RESOLVED
+        except (OSError, ValueError) as e:
+            # Timeouts, refused connections, HTTP errors (URLError is an OSError), bad URLs
+            logger.debug(f"Link preview fetch failed for {url}: {e}")
+            return NOT_FETCHED
+
+
+# ── Cache ────────────────────────────────────────────────────────────────────
+
+def _remember(url: str, expires_at: float, result: dict):
+    with _lock:
+        _cache[url] = (expires_at, result)
+        _cache.move_to_end(url)
+        while len(_cache) > LINK_PREVIEW_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _cached(url: str):
+    with _lock:
+        entry = _cache.get(url)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del _cache[url]
+            return None
+        _cache.move_to_end(url)
+        _stats["memory_hits"] += 1
+        return entry[1]
+
+
+def _load_stored(url: str):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT result, expires_at FROM link_previews WHERE url = ? AND expires_at > ?",
+              (url, int(time.time())))
+    row = c.fetchone()
+    conn.close()
+    return (row['expires_at'], json.loads(row['result'])) if row else None
+
+
+async def _store(url: str, expires_at: int, result: dict):
+    global _stores
+    await write_async("INSERT OR REPLACE INTO link_previews (url, result, expires_at) VALUES (?, ?, ?)",
+                      (url, json.dumps(result), expires_at))
+    with _lock:
+        _stores += 1
+        purge = _stores % LINK_PREVIEW_PURGE_EVERY == 0
+    if purge:
+        await write_async("DELETE FROM link_previews WHERE expires_at <= ?", (int(time.time()),))
+
+
+async def _load(url: str) -> dict:
+    stored = await run_db(_load_stored, url)
+    if stored is not None:
+        with _lock:
+            _stats["db_hits"] += 1
+        _remember(url, *stored)
+        return stored[1]
+
+    result = await _fetch(url)
+    failed = result.get("status") != "success"
+    if failed:
+        with _lock:
+            _stats["failures"] += 1
+    expires_at = int(time.time()) + (LINK_PREVIEW_NEGATIVE_TTL if failed else LINK_PREVIEW_TTL)
+    _remember(url, expires_at, result)
+    try:
+        await _store(url, expires_at, result)
+    except Exception as e:
+        logger.warning(f"Link preview not persisted for {url}: {e}")
+    return result
+
+
+async def get_link_preview(url: str) -> dict:
+    """Preview of `url` as the /utils/link-preview payload ({"status": ...})."""
+    url = urldefrag(url.strip())[0]
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https"):
+        return {"status": "error", "message": "Only HTTP(S) URLs are allowed."}
+    if not parsed.hostname:
+        return {"status": "error", "message": "Invalid URL"}
+
+    cached = _cached(url)
+    if cached is not None:
+        return cached
+
+    task = _inflight.get(url)
+    if task is None:
+        task = asyncio.ensure_future(_load(url))
+        _inflight[url] = task
+        task.add_done_callback(lambda _t: _inflight.pop(url, None))
+    else:
+        with _lock:
+            _stats["coalesced"] += 1
+    # shield: a client going away doesn't cancel the fetch others are waiting on
+    return await asyncio.shield(task)
+
+
+def link_preview_stats() -> dict:
+    with _lock:
+        return {**_stats, "cached": len(_cache), "in_flight": len(_inflight),
+                "concurrency": LINK_PREVIEW_CONCURRENCY, "allow_private": LINK_PREVIEW_ALLOW_PRIVATE}
+
+
+def shutdown_link_preview_executor():
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -1,8 +1,13 @@
 from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from database import init_db
+from contextlib import asynccontextmanager
+from database import init_db, close_pool, shutdown_db_executor, shutdown_write_queue
 from utils import log_event, LOG_FILE, logger
+from search import start_search_backfill
+from uploads import UploadFiles, UploadSizeLimitMiddleware, UploadTooLarge, upload_too_large_handler, shutdown_upload_executor
+from thumbnails import shutdown_thumbnail_executor
+from upload_gc import start_upload_gc, stop_upload_gc
+from link_preview import shutdown_link_preview_executor
 import uvicorn
 import os
 import datetime
@@ -10,12 +15,26 @@ import datetime
 # Routers
 from routers import auth, server, channel, friends, chat, user, admin
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Shutdown: stop the upload collector, finish file writes and thumbnails,
+    # drain DB worker threads, commit queued writes, then release pooled
+    # SQLite connections
+    stop_upload_gc()
+    shutdown_upload_executor()
+    shutdown_thumbnail_executor()
+    shutdown_link_preview_executor()
+    shutdown_db_executor()
+    shutdown_write_queue()
+    close_pool()
+
 # App Init
-app = FastAPI(title="SafeZone Backend", version="1.0.3")
+app = FastAPI(title="SafeZone Backend", version="1.0.3", lifespan=lifespan)
 
 # Setup
 os.makedirs("uploads", exist_ok=True)
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+app.mount("/uploads", UploadFiles(directory="uploads"), name="uploads")  # ETag / immutable / Range
 
 
 # CORS: read from env for production hardening
@@ -33,6 +52,11 @@ ALLOWED_ORIGINS = (
     ]
 )
 
+# Multipart bodies over MAX_UPLOAD_SIZE are refused before they are spooled
+# (added before CORS so the 413 still carries CORS headers)
+app.add_middleware(UploadSizeLimitMiddleware)
+app.add_exception_handler(UploadTooLarge, upload_too_large_handler)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=ALLOWED_ORIGINS,
@@ -46,6 +70,8 @@ app.add_middleware(
 init_db()
 from database import init_admin
 init_admin()
+start_search_backfill()  # indexes pre-existing messages in the background
+start_upload_gc()  # deletes unreferenced uploads past their grace period
 
 # Include Routers
 app.include_router(auth.router)
@@ -67,4 +93,5 @@ if __name__ == "__main__":
     logger.info("   (Loglar server_log.txt dosyasına kaydediliyor)")
     logger.info("============================================")
 
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, log_level="warning", reload=False)
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, log_level="warning", reload=False,
+                ws="ws_compression:CompressedWebSocketProtocol")
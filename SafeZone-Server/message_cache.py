@@ -0,0 +1,463 @@
+"""
+Hot message cache.
+
+Keeps the newest MESSAGE_CACHE_PER_CHANNEL fully hydrated messages (reactions
+and reply previews included) of recently used text channels in memory, so room
+joins and first-page history are served without touching SQLite.
+
+Every write path that changes what a cached message looks like updates the
+cache in place after its commit:
+  - new chat message              message_added()
+  - edit                          message_edited()
+  - delete                        message_deleted()
+  - pin / unpin                   message_pinned()
+  - reaction toggle               reactions_changed()
+  - image thumbnail generated     attachment_variants_ready()
+  - channel or server delete      drop_channel()
+Updates are idempotent and bump a per-channel generation, so a load that read
+the DB while a write was landing is simply not installed (same idea as the
+session cache in utils.py). Reaction counts are not idempotent under reordering
+(two toggles' reads could land in either order), so reactions_changed() does
+the read itself, under the cache lock: reads install in the order they were
+made and the last toggle's read wins. Cached message dicts are never mutated
+in place; an update swaps in a new dict, so a page handed out earlier stays
+consistent.
+Cached messages are the same for every reader; the caller's own reactions
+(`my_reactions`) are looked up per request (with_my_reactions, room_my_reactions).
+
+Channels are evicted least-recently-used first once the total number of
+cached messages exceeds MESSAGE_CACHE_MAX_MESSAGES.
+"""
+import os
+import json
+import datetime
+import threading
+from collections import OrderedDict
+
+from database import get_db_connection
+from utils import encode_frame, Frame
+from thumbnails import parse_variants, attachment_thumb, on_variants_ready
+
+MESSAGE_CACHE_PER_CHANNEL = int(os.environ.get("SAFEZONE_MESSAGE_CACHE_PER_CHANNEL", "100"))
+MESSAGE_CACHE_MAX_MESSAGES = int(os.environ.get("SAFEZONE_MESSAGE_CACHE_MAX_MESSAGES", "50000"))
+ROOM_HISTORY_SIZE = 50  # messages sent to a client when it joins a room
+REACTION_USERS_SHOWN = 20  # usernames kept per (message, emoji); baked into migration v9
+REPLY_PREVIEW_CHARS = 100
+
+
+# ── Hydration (shared by the cache loader and the uncached HTTP path) ────────
+
+def hydrate_messages(c, rows) -> list:
+    """
+    Turn channel_messages rows (joined with the sender's username) into the
+    message dicts clients receive: reactions (see load_reactions), image
+    thumbnails and the replied-to message as a short preview. At most three
+    extra queries, whatever the page size.
+    """
+    reactions_map = load_reactions(c, [row['id'] for row in rows])
+    thumb_map = load_attachment_thumbs(c, [row['attachment_url'] for row in rows
+                                           if row['attachment_type'] == 'image'])
+
+    reply_ids = list({row['reply_to_id'] for row in rows if row['reply_to_id']})
+    reply_map = {}
+    if reply_ids:
+        placeholders = ','.join(['?'] * len(reply_ids))
+        c.execute(f'''
+            SELECT cm.id, cm.content, u.username as sender
+            FROM channel_messages cm
+            JOIN users u ON cm.sender_id = u.id
+            WHERE cm.id IN ({placeholders})
+        ''', reply_ids)
+        for r in c.fetchall():
+            reply_map[r['id']] = reply_preview(r['id'], r['sender'], r['content'])
+
+    return [{
+        "id": row['id'],
+        "sender": row['sender'],
+        "text": row['content'],
+        "timestamp": row['timestamp'],
+        "attachment_url": row['attachment_url'],
+        "attachment_type": row['attachment_type'],
+        "attachment_name": row['attachment_name'],
+        "attachment_thumb": thumb_map.get(row['attachment_url']),
+        "edited_at": row['edited_at'],
+        "is_pinned": bool(row['is_pinned']),
+        **reactions_map.get(row['id'], NO_REACTIONS),
+        "reply_to": reply_map.get(row['reply_to_id'])
+    } for row in rows]
+
+
+NO_REACTIONS = {"reactions": {}, "reaction_counts": {}}
+
+
+def load_reactions(c, message_ids: list) -> dict:
+    """
+    {message_id: {"reactions": {emoji: [first usernames]}, "reaction_counts": {emoji: n}}}
+    from the materialized aggregate (migration v9): one row per emoji, so the
+    cost doesn't grow with the number of people who reacted. `reactions` lists
+    at most REACTION_USERS_SHOWN names per emoji; `reaction_counts` has the total.
+    Emojis keep the order they were first used in.
+    """
+    result = {}
+    if not message_ids:
+        return result
+    placeholders = ','.join(['?'] * len(message_ids))
+    c.execute(f'''
+        SELECT rowid, message_id, emoji, count, users
+        FROM message_reaction_counts
+        WHERE message_id IN ({placeholders})
+    ''', message_ids)
+    for r in sorted(c.fetchall(), key=lambda r: r['rowid']):
+        entry = result.setdefault(r['message_id'], {"reactions": {}, "reaction_counts": {}})
+        entry["reactions"][r['emoji']] = json.loads(r['users'])
+        entry["reaction_counts"][r['emoji']] = r['count']
+    return result
+
+
+def load_my_reactions(c, user_id: int, message_ids: list) -> dict:
+    """
+    {message_id: [emojis]} the user reacted with. `reactions` is truncated, so
+    it can't tell whether the caller reacted; this can. Served by the
+    UNIQUE(message_id, user_id, emoji) index.
+    """
+    result = {}
+    if not message_ids:
+        return result
+    placeholders = ','.join(['?'] * len(message_ids))
+    c.execute(f'''
+        SELECT message_id, emoji FROM message_reactions
+        WHERE message_id IN ({placeholders}) AND user_id = ?
+        ORDER BY id
+    ''', (*message_ids, user_id))
+    for r in c.fetchall():
+        result.setdefault(r['message_id'], []).append(r['emoji'])
+    return result
+
+
+def with_my_reactions(c, user_id: int, messages: list) -> list:
+    """
+    Copies of `messages` carrying the caller's own emojis as `my_reactions`
+    (cached dicts are shared, so they aren't touched). Only messages with
+    reactions are looked up.
+    """
+    mine = load_my_reactions(c, user_id, [m["id"] for m in messages if m["reaction_counts"]])
+    return [{**m, "my_reactions": mine.get(m["id"], [])} for m in messages]
+
+
+def load_attachment_thumbs(c, urls: list) -> dict:
+    """{attachment_url: attachment_thumb} for the given URLs that have a thumbnail."""
+    urls = list(set(urls))
+    if not urls:
+        return {}
+    placeholders = ','.join(['?'] * len(urls))
+    c.execute(f"SELECT url, variants FROM attachments WHERE url IN ({placeholders})", urls)
+    return {r['url']: attachment_thumb(parse_variants(r['variants'])) for r in c.fetchall()}
+
+
+def reply_preview(message_id: int, sender: str, content: str) -> dict:
+    return {"id": message_id, "sender": sender, "text": (content or "")[:REPLY_PREVIEW_CHARS]}
+
+
+def _history_frame(messages: list) -> Frame:
+    # Room history has always carried the text under `content` as well
+    return encode_frame({"type": "history", "messages": [{**m, "content": m["text"]} for m in messages]})
+
+
+def _load_newest(channel_id: str, limit: int) -> list:
+    """The newest `limit` messages of a channel, hydrated, in chronological order."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''
+        SELECT cm.id, cm.content, cm.timestamp, cm.attachment_url, cm.attachment_type,
+               cm.attachment_name, cm.edited_at, cm.reply_to_id, cm.is_pinned,
+               u.username as sender
+        FROM channel_messages cm
+        JOIN users u ON cm.sender_id = u.id
+        WHERE cm.channel_id = ?
+        ORDER BY cm.id DESC
+        LIMIT ?
+    ''', (channel_id, limit))
+    rows = c.fetchall()
+    rows.reverse()
+    messages = hydrate_messages(c, rows)
+    conn.close()
+    return messages
+
+
+# ── Cache ────────────────────────────────────────────────────────────────────
+
+class _ChannelBuffer:
+    __slots__ = ("messages", "exhausted", "history")
+
+    def __init__(self, messages: list, exhausted: bool):
+        # id -> message, oldest first; at most MESSAGE_CACHE_PER_CHANNEL entries
+        self.messages: "OrderedDict[int, dict]" = OrderedDict((m["id"], m) for m in messages)
+        self.exhausted = exhausted  # True while the channel has nothing older than the buffer
+        self.history: Frame = None  # encoded room-join history, built on demand
+
+
+class MessageCache:
+    """LRU of channel_id -> newest hydrated messages, updated in place by writers."""
+
+    def __init__(self, per_channel: int = MESSAGE_CACHE_PER_CHANNEL, max_messages: int = MESSAGE_CACHE_MAX_MESSAGES):
+        self.per_channel = per_channel
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._channels: "OrderedDict[str, _ChannelBuffer]" = OrderedDict()
+        self._where: dict = {}   # message_id -> channel_id, for cached messages
+        self._gen: dict = {}     # channel_id -> generation, bumped on every change
+        self._size = 0
+        self._stats = {"hits": 0, "misses": 0, "loads": 0, "stale_loads": 0, "evictions": 0, "updates": 0}
+
+    # -- reads --
+
+    def page(self, channel_id: str, limit: int, before: int = None):
+        """
+        (messages, more_older): up to `limit` messages older than `before`
+        (newest page if None), oldest first, and whether anything older exists.
+        None when the cache can't answer (not loaded / not enough).
+        """
+        with self._lock:
+            buf = self._channels.get(channel_id)
+            if buf is None:
+                self._stats["misses"] += 1
+                return None
+            messages = list(buf.messages.values())
+            if before is not None:
+                messages = [m for m in messages if m["id"] < before]
+            if len(messages) < limit and not buf.exhausted:
+                self._stats["misses"] += 1
+                return None
+            self._channels.move_to_end(channel_id)
+            self._stats["hits"] += 1
+            more_older = len(messages) > limit or not buf.exhausted
+            return (messages[-limit:] if limit > 0 else []), more_older
+
+    def history_frame(self, channel_id: str) -> tuple:
+        """
+        (cached, frame): the encoded room-join `history` payload, None for an
+        empty channel. `cached` is False when the channel isn't loaded.
+        """
+        with self._lock:
+            buf = self._channels.get(channel_id)
+            if buf is None:
+                self._stats["misses"] += 1
+                return False, None
+            if buf.history is None and buf.messages:
+                buf.history = _history_frame(list(buf.messages.values())[-ROOM_HISTORY_SIZE:])
+            self._channels.move_to_end(channel_id)
+            self._stats["hits"] += 1
+            return True, buf.history
+
+    # -- loading --
+
+    def generation(self, channel_id: str) -> int:
+        with self._lock:
+            return self._gen.get(channel_id, 0)
+
+    def load(self, channel_id: str):
+        """Read the channel's newest messages from the DB and cache them (sync; call via run_db)."""
+        gen = self.generation(channel_id)
+        messages = _load_newest(channel_id, self.per_channel)
+        with self._lock:
+            self._stats["loads"] += 1
+            if gen != self._gen.get(channel_id, 0):
+                self._stats["stale_loads"] += 1  # a write landed meanwhile; next read reloads
+                return
+            if channel_id in self._channels:
+                return
+            self._channels[channel_id] = _ChannelBuffer(messages, len(messages) < self.per_channel)
+            for m in messages:
+                self._where[m["id"]] = channel_id
+            self._size += len(messages)
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_messages and len(self._channels) > 1:
+            channel_id, buf = self._channels.popitem(last=False)
+            self._forget(buf)
+            self._stats["evictions"] += 1
+
+    def _forget(self, buf: _ChannelBuffer):
+        for mid in buf.messages:
+            self._where.pop(mid, None)
+        self._size -= len(buf.messages)
+
+    # -- updates (all idempotent) --
+
+    def _touch(self, channel_id: str):
+        """Bump the channel generation; returns its buffer if cached. Caller holds the lock."""
+        self._gen[channel_id] = self._gen.get(channel_id, 0) + 1
+        self._stats["updates"] += 1
+        buf = self._channels.get(channel_id)
+        if buf is not None:
+            buf.history = None
+        return buf
+
+    def _replace(self, message_id: int, fn):
+        """Swap a cached message for fn(old); returns its channel buffer if it was cached."""
+        channel_id = self._where.get(message_id)
+        if channel_id is None:
+            return None
+        buf = self._touch(channel_id)
+        old = buf.messages.get(message_id)
+        if old is None:
+            return None
+        new = fn(old)
+        buf.messages[message_id] = new
+        return buf
+
+    def message_added(self, channel_id: str, message: dict):
+        with self._lock:
+            buf = self._touch(channel_id)
+            if buf is None or message["id"] in buf.messages:
+                return
+            buf.messages[message["id"]] = message
+            self._where[message["id"]] = channel_id
+            self._size += 1
+            if len(buf.messages) > self.per_channel:
+                mid, _ = buf.messages.popitem(last=False)
+                self._where.pop(mid, None)
+                self._size -= 1
+                buf.exhausted = False
+            self._evict()
+
+    def message_edited(self, message_id: int, content: str, edited_at: str):
+        with self._lock:
+            buf = self._replace(message_id, lambda m: {**m, "text": content, "edited_at": edited_at})
+            if buf is None:
+                return
+            sender = buf.messages[message_id]["sender"]
+            self._update_replies(buf, message_id, reply_preview(message_id, sender, content))
+
+    def message_deleted(self, message_id: int, channel_id: str = None):
+        with self._lock:
+            channel_id = self._where.pop(message_id, None) or channel_id
+            if channel_id is None:
+                return
+            buf = self._touch(channel_id)
+            if buf is None or buf.messages.pop(message_id, None) is None:
+                return
+            self._size -= 1
+            self._update_replies(buf, message_id, None)
+
+    def message_pinned(self, message_id: int, is_pinned: bool):
+        with self._lock:
+            self._replace(message_id, lambda m: {**m, "is_pinned": bool(is_pinned)})
+
+    def reactions_changed(self, c, message_id: int) -> dict:
+        """
+        Re-read a message's reaction fields ({"reactions", "reaction_counts"})
+        through `c`, after the caller's commit, and install them. Reading under
+        the lock orders the installs, so an older read never replaces a newer
+        one (one indexed aggregate query). Returns what was read.
+        """
+        with self._lock:
+            reactions = load_reactions(c, [message_id]).get(message_id, NO_REACTIONS)
+            self._replace(message_id, lambda m: {**m, **reactions})
+        return reactions
+
+    def attachment_variants_ready(self, url: str, variants: dict):
+        """A thumbnail finished after messages using `url` were cached (thumbnails worker)."""
+        thumb = attachment_thumb(variants)
+        if thumb is None:
+            return
+        with self._lock:
+            for channel_id, buf in self._channels.items():
+                stale = [mid for mid, m in buf.messages.items()
+                         if m["attachment_url"] == url and m["attachment_thumb"] != thumb]
+                for mid in stale:
+                    buf.messages[mid] = {**buf.messages[mid], "attachment_thumb": thumb}
+                if stale:
+                    self._gen[channel_id] = self._gen.get(channel_id, 0) + 1
+                    buf.history = None
+
+    def _update_replies(self, buf: _ChannelBuffer, message_id: int, preview):
+        for mid, m in buf.messages.items():
+            if m["reply_to"] and m["reply_to"]["id"] == message_id:
+                buf.messages[mid] = {**m, "reply_to": preview}
+
+    def drop_channel(self, channel_id: str):
+        with self._lock:
+            self._touch(channel_id)
+            buf = self._channels.pop(channel_id, None)
+            if buf is not None:
+                self._forget(buf)
+
+    def clear(self):
+        with self._lock:
+            for channel_id in self._channels:
+                self._gen[channel_id] = self._gen.get(channel_id, 0) + 1
+            self._channels.clear()
+            self._where.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                "channels": len(self._channels),
+                "messages": self._size,
+                "per_channel": self.per_channel,
+                "max_messages": self.max_messages,
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+            }
+
+
+message_cache = MessageCache()
+on_variants_ready(message_cache.attachment_variants_ready)
+
+
+def recent_messages(channel_id: str, limit: int, before: int = None):
+    """
+    A history page served from the cache as (messages, more_older), loading
+    the channel first if needed. Returns None when the page reaches past what
+    the cache holds. Sync: call from DB worker threads (db_offload / run_db).
+    """
+    if limit > message_cache.per_channel:
+        return None
+    page = message_cache.page(channel_id, limit, before)
+    if page is None and before is None:
+        message_cache.load(channel_id)
+        page = message_cache.page(channel_id, limit, before)
+    return page
+
+
+def room_history_frame(channel_id: str):
+    """Encoded `history` for a room join, or None for an empty channel. Sync."""
+    cached, frame = message_cache.history_frame(channel_id)
+    if not cached:
+        message_cache.load(channel_id)
+        cached, frame = message_cache.history_frame(channel_id)
+    if not cached:
+        # A write raced the load, so it wasn't installed: answer uncached
+        recent = _load_newest(channel_id, ROOM_HISTORY_SIZE)
+        frame = _history_frame(recent) if recent else None
+    return frame
+
+
+def room_my_reactions(channel_id: str, user_id: int) -> dict:
+    """
+    The joining user's own reactions on the room-join history, which is one
+    frame shared by everyone ({} when there are none). Sync.
+    """
+    cached = message_cache.page(channel_id, ROOM_HISTORY_SIZE)
+    if cached is not None:
+        message_ids = [m["id"] for m in cached[0] if m["reaction_counts"]]
+        if not message_ids:
+            return {}
+    conn = get_db_connection()
+    c = conn.cursor()
+    if cached is None:
+        c.execute("SELECT id FROM channel_messages WHERE channel_id = ? ORDER BY id DESC LIMIT ?",
+                  (channel_id, ROOM_HISTORY_SIZE))
+        message_ids = [r['id'] for r in c.fetchall()]
+    mine = load_my_reactions(c, user_id, message_ids)
+    conn.close()
+    return mine
+
+
+def db_timestamp() -> str:
+    """utcnow in the format SQLite's CURRENT_TIMESTAMP stores."""
+    return datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
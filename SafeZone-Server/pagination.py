@@ -0,0 +1,104 @@
+"""
+Keyset pagination on `id`.
+
+History endpoints (channel messages, DMs, voice logs, audit log) page by the
+row id instead of OFFSET or a timestamp sort: every page is an index range
+scan on (scope, id) that stops after `limit + 1` rows, so the 10,000th page
+costs the same as the first. Ids are monotonic per table, so id order is
+insertion order.
+
+Clients get opaque cursors back and pass one as `cursor` to continue:
+  - older_cursor   the page before the oldest item returned (None at the start)
+  - newer_cursor   the page after the newest item returned (None when the
+                   page already reaches the newest row)
+A cursor is bound to the scope it was issued for (channel, DM pair, server),
+so one can't be replayed against another channel.
+"""
+import base64
+import hashlib
+import heapq
+
+PAGE_OLDER = "o"
+PAGE_NEWER = "n"
+
+
+class CursorError(ValueError):
+    """Raised for a malformed cursor or one issued for another scope."""
+
+
+def _scope_tag(scope: str) -> str:
+    return hashlib.blake2s(scope.encode(), digest_size=4).hexdigest()
+
+
+def encode_cursor(scope: str, direction: str, key: int) -> str:
+    raw = f"{_scope_tag(scope)}:{direction}:{key}".encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def decode_cursor(scope: str, cursor: str) -> tuple:
+    """Return (direction, key) for a cursor issued by encode_cursor for `scope`."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        tag, direction, key = base64.urlsafe_b64decode(padded.encode()).decode().split(":")
+        key = int(key)
+    except Exception:
+        raise CursorError("Geçersiz sayfa imleci")
+    if tag != _scope_tag(scope) or direction not in (PAGE_OLDER, PAGE_NEWER):
+        raise CursorError("Geçersiz sayfa imleci")
+    return direction, key
+
+
+def keyset_page(c, select_sql: str, partitions: list, scope: str, limit: int,
+                cursor: str = None, before_id: int = None, id_column: str = "id") -> dict:
+    """
+    Fetch one page of rows, oldest first.
+
+    select_sql  "SELECT ... FROM ... JOIN ..." without WHERE / ORDER / LIMIT
+    partitions  [(where_sql, params), ...]; each must be served by an index
+                ending in the id column. Several partitions (e.g. both
+                directions of a DM conversation) are read separately and merged,
+                which keeps each one an index range scan instead of an OR.
+    before_id   legacy raw-id "older than" parameter, used when no cursor is given
+
+    Returns {"items", "older_cursor", "newer_cursor", "has_more"}; `has_more`
+    refers to the direction that was paged (older by default).
+    """
+    direction, key = PAGE_OLDER, before_id
+    if cursor:
+        direction, key = decode_cursor(scope, cursor)
+
+    newer = direction == PAGE_NEWER
+    order = "ASC" if newer else "DESC"
+    rows = []
+    for where_sql, params in partitions:
+        sql = f"{select_sql} WHERE {where_sql}"
+        args = list(params)
+        if key is not None:
+            sql += f" AND {id_column} {'>' if newer else '<'} ?"
+            args.append(key)
+        sql += f" ORDER BY {id_column} {order} LIMIT ?"
+        args.append(limit + 1)
+        c.execute(sql, args)
+        rows.append(c.fetchall())
+
+    if len(rows) == 1:
+        merged = rows[0]
+    else:
+        merged = list(heapq.merge(*rows, key=lambda r: r['id'], reverse=not newer))
+    has_more = len(merged) > limit
+    page = merged[:limit]
+    if not newer:
+        page.reverse()
+
+    # The far side is known to exist whenever we came from a cursor
+    more_older = has_more if not newer else key is not None
+    more_newer = has_more if newer else key is not None
+    return {"items": page, **page_cursors(scope, page, more_older, more_newer), "has_more": has_more}
+
+
+def page_cursors(scope: str, items: list, more_older: bool, more_newer: bool = False) -> dict:
+    """older_cursor / newer_cursor for a page of items (oldest first)."""
+    return {
+        "older_cursor": encode_cursor(scope, PAGE_OLDER, items[0]['id']) if items and more_older else None,
+        "newer_cursor": encode_cursor(scope, PAGE_NEWER, items[-1]['id']) if items and more_newer else None,
+    }
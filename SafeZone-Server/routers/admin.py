@@ -1,16 +1,24 @@
 from fastapi import APIRouter, Depends, HTTPException, Header
 from pydantic import BaseModel
-from database import get_db_connection
-from utils import get_user_by_token
+from database import get_db_connection, pool_stats, db_executor_stats, write_queue_stats, db_offload, run_db
+from utils import session_user, invalidate_user_sessions, session_cache_stats, invalidate_permissions, permission_cache_stats
+from state import presence_stats, membership_changed, outbox_stats, voice_relay_stats
+from ws_compression import compression_stats
+from message_cache import message_cache
+from search import search_stats
+from uploads import upload_stats
+from thumbnails import thumbnail_stats
+from upload_gc import collect_orphaned_uploads, upload_gc_stats
+from link_preview import link_preview_stats
 import datetime
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
-def get_current_sysadmin(authorization: str = Header(None)):
+async def get_current_sysadmin(authorization: str = Header(None)):
     if not authorization:
         raise HTTPException(status_code=401, detail="Missing Token")
     token = authorization.replace("Bearer ", "")
-    user = get_user_by_token(token)
+    user = await session_user(token)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid Token")
     if not user.get('is_sysadmin'):
@@ -18,6 +26,7 @@ def get_current_sysadmin(authorization: str = Header(None)):
     return user
 
 @router.get("/stats")
+@db_offload
 def get_stats(admin = Depends(get_current_sysadmin)):
     conn = get_db_connection()
     c = conn.cursor()
@@ -33,7 +42,40 @@ def get_stats(admin = Depends(get_current_sysadmin)):
     conn.close()
     return {"users": user_count, "servers": active_servers, "total_servers": total_servers}
 
+@router.get("/metrics")
+async def get_metrics(admin = Depends(get_current_sysadmin)):
+    """Runtime performance counters for the server internals."""
+    return {
+        "db_pool": pool_stats(),
+        "db_executor": db_executor_stats(),
+        "db_writer": write_queue_stats(),
+        "session_cache": session_cache_stats(),
+        "permission_cache": permission_cache_stats(),
+        "presence": presence_stats(),
+        "ws_outbox": outbox_stats(),
+        "ws_compression": compression_stats(),
+        "voice_relay": voice_relay_stats(),
+        "message_cache": message_cache.stats(),
+        "search": search_stats(),
+        "uploads": upload_stats(),
+        "thumbnails": thumbnail_stats(),
+        "upload_gc": upload_gc_stats(),
+        "link_preview": link_preview_stats(),
+    }
+
+class UploadGcRequest(BaseModel):
+    dry_run: bool = True
+
+@router.post("/uploads/gc")
+async def run_upload_gc(request: UploadGcRequest, admin = Depends(get_current_sysadmin)):
+    """Run one orphaned-upload collection pass now; a dry run unless dry_run is false."""
+    report = await run_db(collect_orphaned_uploads, request.dry_run)
+    if report is None:
+        return {"status": "error", "message": "Upload temizliği zaten çalışıyor."}
+    return {"status": "success", "report": report}
+
 @router.get("/users")
+@db_offload
 def get_users(admin = Depends(get_current_sysadmin)):
     conn = get_db_connection()
     conn.row_factory = lambda c, r: dict(zip([col[0] for col in c.description], r))
@@ -45,6 +87,7 @@ def get_users(admin = Depends(get_current_sysadmin)):
     return users
 
 @router.get("/servers")
+@db_offload
 def get_servers(admin = Depends(get_current_sysadmin)):
     conn = get_db_connection()
     conn.row_factory = lambda c, r: dict(zip([col[0] for col in c.description], r))
@@ -63,6 +106,7 @@ class ServerJoinRequest(BaseModel):
     server_id: str
 
 @router.post("/join-server")
+@db_offload
 def join_server(request: ServerJoinRequest, admin = Depends(get_current_sysadmin)):
     conn = get_db_connection()
     c = conn.cursor()
@@ -83,9 +127,12 @@ def join_server(request: ServerJoinRequest, admin = Depends(get_current_sysadmin
     c.execute("INSERT INTO members (server_id, user_id) VALUES (?, ?)", (request.server_id, admin['id']))
     conn.commit()
     conn.close()
+    invalidate_permissions(user_id=admin['id'], server_id=request.server_id)
+    membership_changed(request.server_id, admin['id'], joined=True)
     return {"status": "success", "message": "Joined server"}
 
 @router.delete("/server/{server_id}")
+@db_offload
 def delete_server(server_id: str, admin = Depends(get_current_sysadmin)):
     conn = get_db_connection()
     c = conn.cursor()
@@ -115,6 +162,7 @@ import bcrypt
 from models import AdminUserUpdate, AdminServerUpdate
 
 @router.put("/user/{user_id}")
+@db_offload
 def update_user(user_id: int, data: AdminUserUpdate, admin = Depends(get_current_sysadmin)):
     try:
         conn = get_db_connection()
@@ -158,12 +206,15 @@ def update_user(user_id: int, data: AdminUserUpdate, admin = Depends(get_current
         c.execute(query, tuple(values))
         conn.commit()
         conn.close()
+        invalidate_user_sessions(user_id)  # username / sysadmin flag may have changed
+        invalidate_permissions(user_id=user_id)
         
         return {"status": "success", "message": "User updated"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
 @router.put("/server/{server_id}")
+@db_offload
 def update_server(server_id: str, data: AdminServerUpdate, admin = Depends(get_current_sysadmin)):
     try:
         conn = get_db_connection()
@@ -207,6 +258,9 @@ def update_server(server_id: str, data: AdminServerUpdate, admin = Depends(get_c
         c.execute(query, tuple(values))
         conn.commit()
         conn.close()
+        if data.owner_id is not None:
+            invalidate_permissions(server_id=server_id)  # ownership transfer
+            membership_changed(server_id, data.owner_id, joined=True)  # may have been inserted above
         
         return {"status": "success", "message": "Server updated"}
     except Exception as e:
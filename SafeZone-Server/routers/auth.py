@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Request
 from models import UserRegister, UserLogin, UserReset, AdminLogin
-from database import get_db_connection
-from utils import log_event, rate_limit_check, safe_error
+from database import get_db_connection, db_offload
+from utils import log_event, rate_limit_check, safe_error, get_session_user, invalidate_user_sessions
 from config import ADMIN_SECRET
 import bcrypt
 import secrets
@@ -11,7 +11,8 @@ import random
 router = APIRouter(prefix="/auth", tags=["auth"])
 
 @router.post("/register")
-async def register(user: UserRegister, request: Request):
+@db_offload
+def register(user: UserRegister, request: Request):
     # Rate limit: max 5 registrations per IP per 10 minutes
     client_ip = request.client.host
     allowed, err = rate_limit_check(client_ip, "register", max_attempts=5, window_seconds=600)
@@ -71,7 +72,8 @@ async def register(user: UserRegister, request: Request):
         return safe_error(e, "register")
 
 @router.post("/login")
-async def login(user: UserLogin, request: Request):
+@db_offload
+def login(user: UserLogin, request: Request):
     # Rate limit: max 10 login attempts per IP per minute
     client_ip = request.client.host
     allowed, err = rate_limit_check(client_ip, "login", max_attempts=10, window_seconds=60)
@@ -100,6 +102,7 @@ async def login(user: UserLogin, request: Request):
         c.execute("UPDATE users SET token = ? WHERE id = ?", (new_token, db_user['id']))
         conn.commit()
         conn.close()
+        invalidate_user_sessions(db_user['id'])  # old token is dead
         
         return {
             "status": "success", 
@@ -116,7 +119,8 @@ async def login(user: UserLogin, request: Request):
         return safe_error(e, "login")
 
 @router.post("/admin-login")
-async def admin_login(data: AdminLogin):
+@db_offload
+def admin_login(data: AdminLogin):
     try:
         # Check Master Key
         if data.secret != ADMIN_SECRET:
@@ -138,6 +142,7 @@ async def admin_login(data: AdminLogin):
         c.execute("UPDATE users SET token = ? WHERE id = ?", (new_token, admin_user['id']))
         conn.commit()
         conn.close()
+        invalidate_user_sessions(admin_user['id'])  # old token is dead
         
         log_event("AUTH", f"Admin Auto-Login: {admin_user['username']}")
         
@@ -157,7 +162,8 @@ async def admin_login(data: AdminLogin):
         return safe_error(e, "admin-login")
 
 @router.post("/verify")
-async def verify_token(data: dict):
+@db_offload
+def verify_token(data: dict):
     try:
         # Simple token check
         token = data.get("token")
@@ -190,7 +196,8 @@ async def verify_token(data: dict):
         return safe_error(e, "verify")
 
 @router.post("/reset")
-async def reset_password(data: UserReset):
+@db_offload
+def reset_password(data: UserReset):
     try:
         conn = get_db_connection()
         c = conn.cursor()
@@ -220,6 +227,7 @@ async def reset_password(data: UserReset):
         c.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_hashed, user['id']))
         conn.commit()
         conn.close()
+        invalidate_user_sessions(user['id'])
         
         log_event("AUTH", f"Password reset for: {data.email}")
         return {"status": "success", "message": "Şifre başarıyla değiştirildi. Şimdi giriş yapabilirsin."}
@@ -247,13 +255,14 @@ async def reset_password(data: UserReset):
 
 import time as _time
 
-# In-memory ticket store: { ticket_string: { "username": ..., "expires": ... } }
+# In-memory ticket store: { ticket_string: { "username": ..., "user_id": ..., "expires": ... } }
 _ws_tickets: dict[str, dict] = {}
 _ticket_cleanup_counter = 0
 
 
 @router.post("/ws-ticket")
-async def get_ws_ticket(data: dict):
+@db_offload
+def get_ws_ticket(data: dict):
     """
     Exchange a persistent auth token for a short-lived WebSocket ticket.
     The ticket can be used once in a WS URL within 30 seconds.
@@ -262,11 +271,7 @@ async def get_ws_ticket(data: dict):
     if not token:
         return {"status": "error", "message": "Token required"}
 
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT username FROM users WHERE token = ?", (token,))
-    user = c.fetchone()
-    conn.close()
+    user = get_session_user(token)
 
     if not user:
         return {"status": "error", "message": "Invalid token"}
@@ -275,6 +280,7 @@ async def get_ws_ticket(data: dict):
     ticket = secrets.token_urlsafe(32)
     _ws_tickets[ticket] = {
         "username": user["username"],
+        "user_id": user["id"],  # usernames are only unique with their discriminator
         "expires": _time.monotonic() + 30  # 30 second TTL
     }
 
@@ -297,10 +303,16 @@ def validate_ws_ticket(ticket: str) -> str | None:
     Returns the username if valid, None otherwise.
     Ticket is single-use: consumed on first call.
     """
+    entry = consume_ws_ticket(ticket)
+    return entry["username"] if entry else None
+
+
+def consume_ws_ticket(ticket: str) -> dict | None:
+    """Like validate_ws_ticket, but returns the whole entry ({"username", "user_id", ...})."""
     entry = _ws_tickets.pop(ticket, None)
     if not entry:
         return None
     if _time.monotonic() > entry["expires"]:
         return None  # Expired
-    return entry["username"]
+    return entry
 
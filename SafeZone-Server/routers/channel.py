@@ -1,8 +1,9 @@
 from fastapi import APIRouter
 from models import ChannelCreate, ChannelRename, ChannelDelete
-from database import get_db_connection
-from utils import log_event, check_permission, create_audit_log, PERM_MANAGE_CHANNELS, safe_error
+from database import get_db_connection, run_db
+from utils import log_event, check_permission, create_audit_log, PERM_MANAGE_CHANNELS, safe_error, get_session_user
 from state import broadcast_lobby_update, broadcast_room_update
+from message_cache import message_cache
 import uuid
 import sqlite3
 
@@ -10,13 +11,18 @@ router = APIRouter(prefix="/channel", tags=["channel"])
 
 @router.post("/create")
 async def create_channel(data: ChannelCreate):
+    result = await run_db(_create_channel, data)
+    if result.get("status") == "success":
+        await broadcast_lobby_update()
+    return result
+
+def _create_channel(data: ChannelCreate):
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
         # 1. Validate Token
-        c.execute("SELECT id FROM users WHERE token = ?", (data.token,))
-        user = c.fetchone()
+        user = get_session_user(data.token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -37,9 +43,6 @@ async def create_channel(data: ChannelCreate):
         
         log_event("CHANNEL", f"Channel created: {data.channel_name} ({channel_id}) in server {data.server_id}")
         
-        # Broadcast lobby update to all server members
-        await broadcast_lobby_update()
-        
         return {"status": "success", "channel_id": channel_id}
         
     except Exception as e:
@@ -49,13 +52,18 @@ async def create_channel(data: ChannelCreate):
 
 @router.post("/rename")
 async def rename_channel(data: ChannelRename):
+    result = await run_db(_rename_channel, data)
+    if result.get("status") == "success":
+        await broadcast_room_update()
+    return result
+
+def _rename_channel(data: ChannelRename):
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
         # 1. Validate Token
-        c.execute("SELECT id FROM users WHERE token = ?", (data.token,))
-        user = c.fetchone()
+        user = get_session_user(data.token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -76,19 +84,23 @@ async def rename_channel(data: ChannelRename):
         conn.commit()
         conn.close()
         
-        await broadcast_room_update()
         return {"status": "success"}
     except Exception as e:
         return safe_error(e)
 
 @router.post("/delete")
 async def delete_channel(data: ChannelDelete):
+    result = await run_db(_delete_channel, data)
+    if result.get("status") == "success":
+        await broadcast_lobby_update()
+    return result
+
+def _delete_channel(data: ChannelDelete):
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (data.token,))
-        user = c.fetchone()
+        user = get_session_user(data.token)
         if not user: conn.close(); return {"status":"error", "message":"Invalid token"}
         
         c.execute("SELECT server_id FROM channels WHERE id = ?", (data.channel_id,))
@@ -102,8 +114,8 @@ async def delete_channel(data: ChannelDelete):
         c.execute("DELETE FROM channels WHERE id = ?", (data.channel_id,))
         conn.commit()
         conn.close()
+        message_cache.drop_channel(data.channel_id)
         
-        await broadcast_lobby_update()
         return {"status":"success"}
     except Exception as e:
         return safe_error(e, "delete_channel")
@@ -113,6 +125,12 @@ async def delete_channel(data: ChannelDelete):
 @router.post("/category/create")
 async def create_category(data: dict):
     """Create a channel category."""
+    result = await run_db(_create_category, data)
+    if result.get("status") == "success":
+        await broadcast_lobby_update()
+    return result
+
+def _create_category(data: dict):
     try:
         token = data.get('token')
         server_id = data.get('server_id')
@@ -121,8 +139,7 @@ async def create_category(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -143,7 +160,6 @@ async def create_category(data: dict):
         conn.close()
         
         create_audit_log(server_id, user['id'], "CATEGORY_CREATE", "CATEGORY", cat_id, name)
-        await broadcast_lobby_update()
         
         return {"status": "success", "category_id": cat_id, "position": new_pos}
     except Exception as e:
@@ -152,6 +168,12 @@ async def create_category(data: dict):
 @router.post("/category/rename")
 async def rename_category(data: dict):
     """Rename a category."""
+    result = await run_db(_rename_category, data)
+    if result.get("status") == "success":
+        await broadcast_lobby_update()
+    return result
+
+def _rename_category(data: dict):
     try:
         token = data.get('token')
         category_id = data.get('category_id')
@@ -160,8 +182,7 @@ async def rename_category(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -180,7 +201,6 @@ async def rename_category(data: dict):
         conn.commit()
         conn.close()
         
-        await broadcast_lobby_update()
         return {"status": "success"}
     except Exception as e:
         return safe_error(e)
@@ -188,6 +208,12 @@ async def rename_category(data: dict):
 @router.post("/category/delete")
 async def delete_category(data: dict):
     """Delete a category (channels move to uncategorized)."""
+    result = await run_db(_delete_category, data)
+    if result.get("status") == "success":
+        await broadcast_lobby_update()
+    return result
+
+def _delete_category(data: dict):
     try:
         token = data.get('token')
         category_id = data.get('category_id')
@@ -195,8 +221,7 @@ async def delete_category(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -217,7 +242,6 @@ async def delete_category(data: dict):
         conn.commit()
         conn.close()
         
-        await broadcast_lobby_update()
         return {"status": "success"}
     except Exception as e:
         return safe_error(e)
@@ -225,6 +249,12 @@ async def delete_category(data: dict):
 @router.post("/reorder")
 async def reorder_channels(data: dict):
     """Reorder channels and categories. Expects {token, server_id, channels: [{id, position, category_id}]}"""
+    result = await run_db(_reorder_channels, data)
+    if result.get("status") == "success":
+        await broadcast_lobby_update()
+    return result
+
+def _reorder_channels(data: dict):
     try:
         token = data.get('token')
         server_id = data.get('server_id')
@@ -233,8 +263,7 @@ async def reorder_channels(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -250,7 +279,6 @@ async def reorder_channels(data: dict):
         conn.commit()
         conn.close()
         
-        await broadcast_lobby_update()
         return {"status": "success"}
     except Exception as e:
         return safe_error(e)
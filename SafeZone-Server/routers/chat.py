@@ -1,36 +1,44 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, UploadFile, File, Form, Query
-from database import get_db_connection, DB_NAME
-from utils import log_event, check_permission, create_audit_log, PERM_MANAGE_MESSAGES, PERM_VIEW_CHANNELS, PERM_SEND_MESSAGES, PERM_ATTACH_FILES, check_channel_membership, check_server_membership, validate_upload, ALLOWED_CHAT_EXTS, safe_error
-from state import lobby, rooms, VoiceRoom, broadcast_room_update, broadcast_user_list, cache_user_status, update_cached_status, remove_cached_user
+from database import get_db_connection, run_db, db_offload, enqueue_write, write_async
+from utils import log_event, check_permission, create_audit_log, PERM_MANAGE_MESSAGES, PERM_VIEW_CHANNELS, PERM_SEND_MESSAGES, PERM_ATTACH_FILES, check_channel_membership, check_server_membership, ALLOWED_CHAT_EXTS, safe_error, get_session_user, session_user, encode_frame, Frame
+from message_cache import message_cache, hydrate_messages, recent_messages, room_history_frame, room_my_reactions, db_timestamp, load_reactions, load_my_reactions, with_my_reactions, NO_REACTIONS
+from pagination import keyset_page, page_cursors, decode_cursor, CursorError, PAGE_OLDER
+from search import search_channels
+from uploads import save_upload, upload_extension, UploadRejected
+from link_preview import get_link_preview
+from thumbnails import schedule_variants, known_variants, parse_variants, attachment_thumb, with_avatar_thumbs, AVATAR_VARIANTS_SQL, KIND_ATTACHMENT
+from state import lobby, rooms, VoiceRoom, RoomConnection, broadcast_room_update, broadcast_user_list, cache_user_status, update_cached_status, remove_cached_user, send_presence_snapshot, load_membership, open_outbox, close_outbox, queue_send, presence_resync_frame, FRAME_DATA, FRAME_PRESENCE
 import sqlite3
 import json
-import uuid
-import os
-import re
-import urllib.request
 import datetime
-import asyncio
 
 router = APIRouter(tags=["chat"])
 
 # --- Helper ---
-async def broadcast(room, message: str):
-    for conn in room.active_connections:
-        try:
-            await conn['ws'].send_text(message)
-        except:
-            pass # Handle disconnected clients
+async def broadcast(room, message, kind: str = FRAME_DATA):
+    # Encoded once (see utils.encode_frame), queued per connection; a slow
+    # client never holds up the others
+    for conn in room.active_connections.values():
+        queue_send(conn.ws, message, kind)
 
 # --- HTTP Endpoints ---
 
+async def _broadcast_to_channel(event):
+    """Fan a (channel_id, payload) event out to the channel's room, if anyone is in it."""
+    if not event:
+        return
+    channel_id_str, payload = event
+    if channel_id_str in rooms:
+        await broadcast(rooms[channel_id_str], encode_frame(payload))
+
 @router.get("/channel/{channel_id}/voice-log")
-async def get_voice_log(channel_id: str, token: str, limit: int = 50):
+@db_offload
+def get_voice_log(channel_id: str, token: str, limit: int = 50, cursor: str = None):
     try:
         conn = get_db_connection()
         c = conn.cursor()
         # 1. Validate Token
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -41,26 +49,28 @@ async def get_voice_log(channel_id: str, token: str, limit: int = 50):
             conn.close()
             return {"status": "error", "message": "Odayı görüntüleme yetkiniz yok."}
         
-        # 3. Fetch logs
-        c.execute(
-            "SELECT user_id, action, timestamp FROM voice_logs WHERE channel_id = ? ORDER BY timestamp DESC LIMIT ?",
-            (channel_id, min(limit, 200))
-        )
-        rows = c.fetchall()
+        # 3. Fetch logs (newest first, keyset-paged on id)
+        page = keyset_page(c, "SELECT id, user_id, action, timestamp FROM voice_logs",
+                           [("channel_id = ?", (channel_id,))], f"voice:{channel_id}",
+                           max(1, min(limit, 200)), cursor=cursor)
         conn.close()
-        return {"status": "success", "logs": [dict(r) for r in rows]}
+        logs = [dict(r) for r in reversed(page.pop("items"))]
+        return {"status": "success", "logs": logs, **page}
+    except CursorError as e:
+        return {"status": "error", "message": str(e)}
     except Exception as e:
         return {"status": "error", "message": "Sunucu hatası"}
 
 @router.get("/channel/{channel_id}/messages")
-async def get_channel_messages(channel_id: str, token: str, before: int = None, limit: int = 100):
+@db_offload
+def get_channel_messages(channel_id: str, token: str, cursor: str = None, before: int = None,
+                         before_id: int = None, limit: int = 100):
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
         # 1. Validate Token
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -71,98 +81,57 @@ async def get_channel_messages(channel_id: str, token: str, before: int = None,
             conn.close()
             return {"status": "error", "message": "Odayı görüntüleme yetkiniz yok."}
         
-        # 3. Get Messages (with pagination)
-        if before:
-            c.execute('''
-                SELECT cm.id, cm.content, cm.timestamp, cm.attachment_url, cm.attachment_type, 
-                       cm.attachment_name, cm.edited_at, cm.reply_to_id, cm.is_pinned, u.username as sender
-                FROM channel_messages cm
-                JOIN users u ON cm.sender_id = u.id
-                WHERE cm.channel_id = ? AND cm.id < ?
-                ORDER BY cm.timestamp DESC
-                LIMIT ?
-            ''', (channel_id, before, min(limit, 100)))
-        else:
-            c.execute('''
+        conn.close()
+        
+        limit = max(1, min(limit, 100))
+        scope = f"channel:{channel_id}"
+        before = before or before_id  # raw-id paging from older clients
+        direction = PAGE_OLDER
+        if cursor:
+            direction, before = decode_cursor(scope, cursor)
+
+        # 3. Newest pages come from the hot message cache (see message_cache.py)
+        if direction == PAGE_OLDER:
+            cached = recent_messages(channel_id, limit, before)
+            if cached is not None:
+                messages, more_older = cached
+                conn = get_db_connection()
+                messages = with_my_reactions(conn.cursor(), user['id'], messages)
+                conn.close()
+                return {"status": "success", "messages": messages,
+                        **page_cursors(scope, messages, more_older, before is not None),
+                        "has_more": more_older}
+
+        # 4. Anything else: keyset page on (channel_id, id), then hydrate
+        conn = get_db_connection()
+        c = conn.cursor()
+        page = keyset_page(c, '''
                 SELECT cm.id, cm.content, cm.timestamp, cm.attachment_url, cm.attachment_type, 
                        cm.attachment_name, cm.edited_at, cm.reply_to_id, cm.is_pinned, u.username as sender
                 FROM channel_messages cm
                 JOIN users u ON cm.sender_id = u.id
-                WHERE cm.channel_id = ?
-                ORDER BY cm.timestamp DESC
-                LIMIT ?
-            ''', (channel_id, min(limit, 100)))
-        
-        rows = c.fetchall()
-        msg_ids = [row['id'] for row in rows]
-        
-        # 3. Fetch reactions for these messages
-        reactions_map = {}
-        if msg_ids:
-            placeholders = ','.join(['?'] * len(msg_ids))
-            c.execute(f'''
-                SELECT mr.message_id, mr.emoji, u.username
-                FROM message_reactions mr
-                JOIN users u ON mr.user_id = u.id
-                WHERE mr.message_id IN ({placeholders})
-            ''', msg_ids)
-            for r in c.fetchall():
-                mid = r['message_id']
-                if mid not in reactions_map:
-                    reactions_map[mid] = {}
-                emoji = r['emoji']
-                if emoji not in reactions_map[mid]:
-                    reactions_map[mid][emoji] = []
-                reactions_map[mid][emoji].append(r['username'])
-        
-        # 4. Fetch reply-to info
-        reply_ids = [row['reply_to_id'] for row in rows if row['reply_to_id']]
-        reply_map = {}
-        if reply_ids:
-            placeholders = ','.join(['?'] * len(reply_ids))
-            c.execute(f'''
-                SELECT cm.id, cm.content, u.username as sender
-                FROM channel_messages cm
-                JOIN users u ON cm.sender_id = u.id
-                WHERE cm.id IN ({placeholders})
-            ''', reply_ids)
-            for r in c.fetchall():
-                reply_map[r['id']] = {"id": r['id'], "sender": r['sender'], "text": r['content'][:100]}
-        
-        messages = []
-        for row in rows:
-            msg = {
-                "id": row['id'],
-                "sender": row['sender'],
-                "text": row['content'],
-                "timestamp": row['timestamp'],
-                "attachment_url": row['attachment_url'],
-                "attachment_type": row['attachment_type'],
-                "attachment_name": row['attachment_name'],
-                "edited_at": row['edited_at'],
-                "is_pinned": bool(row['is_pinned']),
-                "reactions": reactions_map.get(row['id'], {}),
-                "reply_to": reply_map.get(row['reply_to_id'])
-            }
-            messages.append(msg)
-        
-        messages.reverse()  # Back to chronological order
+            ''', [("cm.channel_id = ?", (channel_id,))], scope, limit,
+            cursor=cursor, before_id=before, id_column="cm.id")
+        messages = with_my_reactions(c, user['id'], hydrate_messages(c, page.pop("items")))
             
         conn.close()
-        return {"status": "success", "messages": messages}
+        return {"status": "success", "messages": messages, **page}
+    except CursorError as e:
+        return {"status": "error", "message": str(e)}
     except Exception as e:
         return safe_error(e)
 
 # --- SEARCH ---
 @router.get("/channel/{channel_id}/messages/search")
-async def search_channel_messages(channel_id: str, token: str, q: str, limit: int = 30):
+@db_offload
+def search_channel_messages(channel_id: str, token: str, q: str, limit: int = 30, scope: str = "channel"):
+    """Ranked full-text search in one channel, or (scope=server) every channel of its server."""
     try:
         if not q or len(q.strip()) < 2:
             return {"status": "error", "message": "Arama terimi en az 2 karakter olmalı"}
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -171,20 +140,16 @@ async def search_channel_messages(channel_id: str, token: str, q: str, limit: in
         if not channel or not check_permission(user['id'], channel['server_id'], PERM_VIEW_CHANNELS):
             conn.close()
             return {"status": "error", "message": "Erişim reddedildi"}
-        c.execute('''
-            SELECT cm.id, cm.content, cm.timestamp, cm.attachment_url, cm.attachment_type,
-                   cm.attachment_name, cm.edited_at, cm.reply_to_id, cm.is_pinned, u.username as sender
-            FROM channel_messages cm
-            JOIN users u ON cm.sender_id = u.id
-            WHERE cm.channel_id = ? AND cm.content LIKE ?
-            ORDER BY cm.timestamp DESC
-            LIMIT ?
-        ''', (channel_id, f'%{q.strip()}%', min(limit, 50)))
-        rows = c.fetchall()
+        channel_ids = [channel_id]
+        if scope == "server":
+            # VIEW_CHANNELS is granted per server, so it already covers all of them
+            c.execute("SELECT id FROM channels WHERE server_id = ?", (channel['server_id'],))
+            channel_ids = [r['id'] for r in c.fetchall()]
+        rows = search_channels(c, q, channel_ids, min(limit, 50))
         conn.close()
         results = [{
-            "id": r['id'], "sender": r['sender'], "text": r['content'],
-            "timestamp": r['timestamp'], "is_pinned": bool(r['is_pinned']),
+            "id": r['id'], "channel_id": r['channel_id'], "sender": r['sender'], "text": r['content'],
+            "snippet": r['snippet'], "timestamp": r['timestamp'], "is_pinned": bool(r['is_pinned']),
             "attachment_url": r['attachment_url'], "attachment_type": r['attachment_type']
         } for r in rows]
         return {"status": "success", "results": results, "query": q}
@@ -193,12 +158,12 @@ async def search_channel_messages(channel_id: str, token: str, q: str, limit: in
 
 # --- PIN / UNPIN ---
 @router.post("/message/{message_id}/pin")
-async def pin_message(message_id: int, token: str, channel_id: str):
+@db_offload
+def pin_message(message_id: int, token: str, channel_id: str):
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -215,17 +180,18 @@ async def pin_message(message_id: int, token: str, channel_id: str):
         c.execute("UPDATE channel_messages SET is_pinned = 1 WHERE id = ?", (message_id,))
         conn.commit()
         conn.close()
+        message_cache.message_pinned(message_id, True)
         return {"status": "success"}
     except Exception as e:
         return safe_error(e)
 
 @router.post("/message/{message_id}/unpin")
-async def unpin_message(message_id: int, token: str):
+@db_offload
+def unpin_message(message_id: int, token: str):
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -242,17 +208,18 @@ async def unpin_message(message_id: int, token: str):
         c.execute("UPDATE channel_messages SET is_pinned = 0 WHERE id = ?", (message_id,))
         conn.commit()
         conn.close()
+        message_cache.message_pinned(message_id, False)
         return {"status": "success"}
     except Exception as e:
         return safe_error(e)
 
 @router.get("/channel/{channel_id}/pins")
-async def get_pinned_messages(channel_id: str, token: str):
+@db_offload
+def get_pinned_messages(channel_id: str, token: str):
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -275,41 +242,50 @@ async def get_pinned_messages(channel_id: str, token: str):
 
 # --- REACTIONS ---
 @router.post("/message/{message_id}/react")
-async def add_reaction(message_id: int, token: str, emoji: str):
+@db_offload
+def add_reaction(message_id: int, token: str, emoji: str):
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
+        added = False
         try:
             c.execute("INSERT INTO message_reactions (message_id, user_id, emoji) VALUES (?, ?, ?)",
                      (message_id, user['id'], emoji))
             conn.commit()
+            added = True
         except Exception:
             pass  # Already reacted (UNIQUE constraint)
+        reactions = (message_cache.reactions_changed(c, message_id) if added
+                     else load_reactions(c, [message_id]).get(message_id, NO_REACTIONS))
+        my_reactions = load_my_reactions(c, user['id'], [message_id]).get(message_id, [])
         conn.close()
-        return {"status": "success"}
+        return {"status": "success", **reactions, "my_reactions": my_reactions}
     except Exception as e:
         return safe_error(e)
 
 @router.delete("/message/{message_id}/react")
-async def remove_reaction(message_id: int, token: str, emoji: str):
+@db_offload
+def remove_reaction(message_id: int, token: str, emoji: str):
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
         c.execute("DELETE FROM message_reactions WHERE message_id = ? AND user_id = ? AND emoji = ?",
                  (message_id, user['id'], emoji))
+        removed = c.rowcount
         conn.commit()
+        reactions = (message_cache.reactions_changed(c, message_id) if removed
+                     else load_reactions(c, [message_id]).get(message_id, NO_REACTIONS))
+        my_reactions = load_my_reactions(c, user['id'], [message_id]).get(message_id, [])
         conn.close()
-        return {"status": "success"}
+        return {"status": "success", **reactions, "my_reactions": my_reactions}
     except Exception as e:
         return safe_error(e)
 
@@ -318,51 +294,41 @@ async def remove_reaction(message_id: int, token: str, emoji: str):
 @router.post("/chat/upload")
 async def chat_upload(token: str = Form(...), file: UploadFile = File(...)):
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
         # 1. Validate Token
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = await session_user(token)
         if not user:
-            conn.close()
             return {"status": "error", "message": "Invalid token"}
-            
-        # 2. Read content + validate (size, extension, magic bytes)
-        content = await file.read()
-        is_valid, err_msg = validate_upload(content, file.filename, ALLOWED_CHAT_EXTS)
-        if not is_valid:
-            conn.close() # Close connection before returning
-            return {"status": "error", "message": err_msg}
-
-        # 3. Save File
-        ext = file.filename.rsplit('.', 1)[-1].lower()
-        filename = f"chat_{user['id']}_{uuid.uuid4().hex[:8]}.{ext}"
-        filepath = os.path.join("uploads", filename)
-        with open(filepath, "wb") as f:
-            f.write(content)
-            
-        url = f"/uploads/{filename}"
-        
+
+        # 2. Store (content-addressed); extension, magic bytes and size are checked on the way
+        ext = upload_extension(file.filename)
+        url = await save_upload(file, ALLOWED_CHAT_EXTS)
+
         # Determine type
         ftype = 'file'
         if ext in ['jpg', 'jpeg', 'png', 'gif', 'webp']:
             ftype = 'image'
+            schedule_variants(url, KIND_ATTACHMENT)  # thumbnail in the background
         elif ext in ['mp4', 'webm', 'mov']:
             ftype = 'video'
-            
-        conn.close()
+
         return {
-            "status": "success", 
-            "url": url, 
-            "type": ftype, 
+            "status": "success",
+            "url": url,
+            "type": ftype,
             "name": file.filename
         }
+    except UploadRejected as e:
+        return {"status": "error", "message": str(e)}
     except Exception as e:
         return safe_error(e)
 
 @router.post("/message/edit")
 async def edit_message(data: dict):
+    result = await run_db(_edit_message, data)
+    await _broadcast_to_channel(result.pop("_broadcast", None))
+    return result
+
+def _edit_message(data: dict):
     try:
         token = data.get('token')
         message_id = data.get('message_id')
@@ -371,8 +337,7 @@ async def edit_message(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id, is_sysadmin FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user: 
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -389,16 +354,11 @@ async def edit_message(data: dict):
             return {"status": "error", "message": "Unauthorized"}
 
         # --- Save old content to edit history BEFORE updating ---
-        try:
-            c.execute(
-                "CREATE TABLE IF NOT EXISTS message_edits (id INTEGER PRIMARY KEY AUTOINCREMENT, message_id INTEGER NOT NULL, content TEXT NOT NULL, edited_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY(message_id) REFERENCES channel_messages(id) ON DELETE CASCADE)"
-            )
-            c.execute(
-                "INSERT INTO message_edits (message_id, content) VALUES (?, ?)",
-                (message_id, msg['content'])
-            )
-        except Exception:
-            pass  # Table might already exist
+        # (message_edits is created by migration v5)
+        c.execute(
+            "INSERT INTO message_edits (message_id, content) VALUES (?, ?)",
+            (message_id, msg['content'])
+        )
 
         c.execute("UPDATE channel_messages SET content = ?, edited_at = CURRENT_TIMESTAMP WHERE id = ?", 
                  (new_content, message_id))
@@ -407,31 +367,28 @@ async def edit_message(data: dict):
         ch_row = c.fetchone()
         conn.commit()
         conn.close()
+        message_cache.message_edited(message_id, new_content, db_timestamp())
 
         # Broadcast edit to all clients in the channel room
+        result = {"status": "success"}
         if ch_row:
-            channel_id_str = str(ch_row['channel_id'])
-            from state import rooms
-            import asyncio, json
-            if channel_id_str in rooms:
-                asyncio.create_task(broadcast(rooms[channel_id_str], json.dumps({
-                    "type": "message_edited",
-                    "message_id": message_id,
-                    "content": new_content,
-                    "edited_at": str(datetime.datetime.utcnow().isoformat()) if hasattr(datetime, 'datetime') else ""
-                })))
-
-        return {"status": "success"}
+            result["_broadcast"] = (str(ch_row['channel_id']), {
+                "type": "message_edited",
+                "message_id": message_id,
+                "content": new_content,
+                "edited_at": str(datetime.datetime.utcnow().isoformat()) if hasattr(datetime, 'datetime') else ""
+            })
+        return result
     except Exception as e:
         return safe_error(e)
 
 @router.get("/message/{message_id}/edits")
-async def get_message_edits(message_id: int, token: str):
+@db_offload
+def get_message_edits(message_id: int, token: str):
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -451,6 +408,11 @@ async def get_message_edits(message_id: int, token: str):
 
 @router.post("/message/delete")
 async def delete_message(data: dict):
+    result = await run_db(_delete_message, data)
+    await _broadcast_to_channel(result.pop("_broadcast", None))
+    return result
+
+def _delete_message(data: dict):
     try:
         token = data.get('token')
         message_id = data.get('message_id')
@@ -458,8 +420,7 @@ async def delete_message(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user: return {"status": "error"}
             
         # Get the message details
@@ -485,34 +446,16 @@ async def delete_message(data: dict):
         conn.close()
         
         # Broadcast Deletion
-        from state import rooms
         channel_id_str = str(msg['channel_id'])
-        
-        # LOGGING
-        log_event("DEBUG", f"Attempting to broadcast delete for channel {channel_id_str}. Active rooms: {list(rooms.keys())}")
-        
-        if channel_id_str in rooms:
-            import json
-            deletion_event = json.dumps({
+        message_cache.message_deleted(message_id, channel_id_str)
+        return {
+            "status": "success",
+            "_broadcast": (channel_id_str, {
                 "type": "message_deleted",
                 "message_id": message_id,
                 "channel_id": channel_id_str
-            })
-            log_event("DEBUG", f"Broadcasting deletion to {len(rooms[channel_id_str].active_connections)} clients")
-            for connection in rooms[channel_id_str].active_connections:
-                try:
-                    await connection['ws'].send_text(deletion_event)
-                except Exception as e:
-                    log_event("ERROR", f"Failed to send delete event: {e}")
-        
-        # For Text Channels, we don't have a "Room" object in memory usually unless we have a specific websocket for it.
-        # SafeZone seems to use `lobby` for global updates, OR `room_endpoint` for specific rooms.
-        # If the user is in a textual channel, are they connected to a websocket?
-        # `useChat` connects to `chatWs`. Let's check `useChat` implementation.
-        # `useChat` connects to `/ws/room/${channelId}/${uuid}`.
-        # So yes, they are in `rooms`.
-        
-        return {"status": "success"}
+            }),
+        }
     except Exception as e:
         return safe_error(e)
 
@@ -520,58 +463,9 @@ async def delete_message(data: dict):
 async def link_preview(data: dict):
     url = data.get('url')
     if not url: return {"status": "error"}
-    
     try:
-        # --- SSRF Protection: Block private/internal IPs and non-HTTP schemes ---
-        from urllib.parse import urlparse
-        import ipaddress
-        import socket
-
-        parsed = urlparse(url)
-        if parsed.scheme not in ('http', 'https'):
-            return {"status": "error", "message": "Only HTTP(S) URLs are allowed."}
-        
-        hostname = parsed.hostname
-        if not hostname:
-            return {"status": "error", "message": "Invalid URL"}
-
-        # Resolve hostname to IP and check if it's a private/reserved address
-        try:
-            resolved_ip = socket.getaddrinfo(hostname, None, socket.AF_INET)[0][4][0]
-            ip_obj = ipaddress.ip_address(resolved_ip)
-            if ip_obj.is_private or ip_obj.is_loopback or ip_obj.is_reserved or ip_obj.is_link_local:
-                return {"status": "error", "message": "Access to internal addresses is not allowed."}
-        except (socket.gaierror, ValueError):
-            return {"status": "error", "message": "Could not resolve hostname."}
-        # --- End SSRF Protection ---
-
-        # Simple regex-based scraper (No external deps)
-        req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0 (compatible; SafeZone/1.0)'})
-        with urllib.request.urlopen(req, timeout=5) as response:
-            content_type = response.headers.get('Content-Type', '')
-            if 'text/html' not in content_type:
-                return {"status": "error", "message": "Not HTML"}
-                
-            html = response.read(512_000).decode('utf-8', errors='ignore')  # Max 512KB
-            
-            title_match = re.search(r'<title>(.*?)</title>', html, re.IGNORECASE | re.DOTALL)
-            title = title_match.group(1).strip() if title_match else url
-            
-            # OpenGraph Image
-            og_image = re.search(r'<meta\s+property=["\']og:image["\']\s+content=["\'](.*?)["\']', html, re.IGNORECASE)
-            image = og_image.group(1) if og_image else None
-            
-            # Description
-            desc_match = re.search(r'<meta\s+property=["\']og:description["\']\s+content=["\'](.*?)["\']', html, re.IGNORECASE)
-            description = desc_match.group(1) if desc_match else ""
-            
-            return {
-                "status": "success",
-                "title": title,
-                "image": image,
-                "description": description[:200], # Limit length
-                "url": url
-            }
+        # Cached and fetched off the event loop; see link_preview.py
+        return await get_link_preview(str(url))
     except Exception as e:
         return safe_error(e)
 
@@ -580,6 +474,11 @@ async def link_preview(data: dict):
 @router.post("/message/react")
 async def react_to_message(data: dict):
     """Add or toggle a reaction on a message."""
+    result = await run_db(_react_to_message, data)
+    await _broadcast_to_channel(result.pop("_broadcast", None))
+    return result
+
+def _react_to_message(data: dict):
     try:
         token = data.get('token')
         message_id = data.get('message_id')
@@ -591,8 +490,7 @@ async def react_to_message(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -622,38 +520,32 @@ async def react_to_message(data: dict):
         
         conn.commit()
         
-        # Get updated reactions for this message
-        c.execute('''
-            SELECT mr.emoji, u.username 
-            FROM message_reactions mr 
-            JOIN users u ON mr.user_id = u.id 
-            WHERE mr.message_id = ?
-        ''', (message_id,))
-        
-        reactions = {}
-        for r in c.fetchall():
-            if r['emoji'] not in reactions:
-                reactions[r['emoji']] = []
-            reactions[r['emoji']].append(r['username'])
-        
+        # Updated reactions for this message: one aggregate row per emoji
+        reactions = message_cache.reactions_changed(c, message_id)
+        my_reactions = load_my_reactions(c, user['id'], [message_id]).get(message_id, [])
         conn.close()
         
         # Broadcast reaction to room
-        channel_id_str = str(msg_row['channel_id'])
-        if channel_id_str in rooms:
-            asyncio.create_task(broadcast(rooms[channel_id_str], json.dumps({
+        return {
+            "status": "success", "action": action, **reactions, "my_reactions": my_reactions,
+            "message_id": message_id,
+            "_broadcast": (str(msg_row['channel_id']), {
                 "type": "message_react",
                 "message_id": message_id,
-                "reactions": reactions
-            })))
-
-        return {"status": "success", "action": action, "reactions": reactions, "message_id": message_id}
+                **reactions
+            }),
+        }
     except Exception as e:
         return safe_error(e)
 
 @router.post("/message/pin")
 async def pin_message(data: dict):
     """Pin or unpin a message."""
+    result = await run_db(_pin_message, data)
+    await _broadcast_to_channel(result.pop("_broadcast", None))
+    return result
+
+def _pin_message(data: dict):
     try:
         token = data.get('token')
         message_id = data.get('message_id')
@@ -661,8 +553,7 @@ async def pin_message(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -686,6 +577,7 @@ async def pin_message(data: dict):
         c.execute("UPDATE channel_messages SET is_pinned = ? WHERE id = ?", (new_pin, message_id))
         conn.commit()
         conn.close()
+        message_cache.message_pinned(message_id, bool(new_pin))
         
         action = "MESSAGE_PIN" if new_pin else "MESSAGE_UNPIN"
         if channel:
@@ -693,27 +585,29 @@ async def pin_message(data: dict):
 
         # Broadcast pin/unpin to all clients in the channel room
         channel_id_str = str(msg['channel_id'])
-        from state import rooms
-        import asyncio, json
-        if channel_id_str in rooms:
-            asyncio.create_task(broadcast(rooms[channel_id_str], json.dumps({
+        return {
+            "status": "success", "is_pinned": bool(new_pin),
+            "_broadcast": (channel_id_str, {
                 "type": "message_pinned" if new_pin else "message_unpinned",
                 "message_id": message_id,
                 "channel_id": channel_id_str
-            })))
-        
-        return {"status": "success", "is_pinned": bool(new_pin)}
+            }),
+        }
     except Exception as e:
         return safe_error(e)
 
 @router.post("/message/{message_id}/pin")
 async def pin_message_by_id(message_id: int, token: str, channel_id: str = None):
     """Pin a message by ID (token + channel_id as query params)."""
+    result = await run_db(_pin_message_by_id, message_id, token, channel_id)
+    await _broadcast_to_channel(result.pop("_broadcast", None))
+    return result
+
+def _pin_message_by_id(message_id: int, token: str, channel_id: str = None):
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -730,30 +624,34 @@ async def pin_message_by_id(message_id: int, token: str, channel_id: str = None)
         c.execute("UPDATE channel_messages SET is_pinned = 1 WHERE id = ?", (message_id,))
         conn.commit()
         conn.close()
+        message_cache.message_pinned(message_id, True)
         if channel:
             create_audit_log(channel['server_id'], user['id'], "MESSAGE_PIN", "MESSAGE", str(message_id))
         # Broadcast
         channel_id_str = str(msg['channel_id'])
-        from state import rooms
-        import asyncio, json
-        if channel_id_str in rooms:
-            asyncio.create_task(broadcast(rooms[channel_id_str], json.dumps({
+        return {
+            "status": "success", "is_pinned": True,
+            "_broadcast": (channel_id_str, {
                 "type": "message_pinned",
                 "message_id": message_id,
                 "channel_id": channel_id_str
-            })))
-        return {"status": "success", "is_pinned": True}
+            }),
+        }
     except Exception as e:
         return safe_error(e)
 
 @router.post("/message/{message_id}/unpin")
 async def unpin_message_by_id(message_id: int, token: str):
     """Unpin a message by ID (token as query param)."""
+    result = await run_db(_unpin_message_by_id, message_id, token)
+    await _broadcast_to_channel(result.pop("_broadcast", None))
+    return result
+
+def _unpin_message_by_id(message_id: int, token: str):
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -770,31 +668,31 @@ async def unpin_message_by_id(message_id: int, token: str):
         c.execute("UPDATE channel_messages SET is_pinned = 0 WHERE id = ?", (message_id,))
         conn.commit()
         conn.close()
+        message_cache.message_pinned(message_id, False)
         if channel:
             create_audit_log(channel['server_id'], user['id'], "MESSAGE_UNPIN", "MESSAGE", str(message_id))
         # Broadcast
         channel_id_str = str(msg['channel_id'])
-        from state import rooms
-        import asyncio, json
-        if channel_id_str in rooms:
-            asyncio.create_task(broadcast(rooms[channel_id_str], json.dumps({
+        return {
+            "status": "success", "is_pinned": False,
+            "_broadcast": (channel_id_str, {
                 "type": "message_unpinned",
                 "message_id": message_id,
                 "channel_id": channel_id_str
-            })))
-        return {"status": "success", "is_pinned": False}
+            }),
+        }
     except Exception as e:
         return safe_error(e)
 
 @router.get("/channel/{channel_id}/pins")
-async def get_pinned_messages(channel_id: str, token: str):
+@db_offload
+def get_pinned_messages(channel_id: str, token: str):
     """Get all pinned messages in a channel."""
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -821,14 +719,14 @@ async def get_pinned_messages(channel_id: str, token: str):
         return safe_error(e)
 
 @router.get("/channel/{channel_id}/search")
-async def search_messages(channel_id: str, token: str, q: str, limit: int = 25):
+@db_offload
+def search_messages(channel_id: str, token: str, q: str, limit: int = 25):
     """Search messages in a channel."""
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -843,16 +741,9 @@ async def search_messages(channel_id: str, token: str, q: str, limit: int = 25):
             conn.close()
             return {"status": "error", "message": "Arama en az 2 karakter olmalı"}
         
-        c.execute('''
-            SELECT cm.id, cm.content, cm.timestamp, u.username as sender
-            FROM channel_messages cm
-            JOIN users u ON cm.sender_id = u.id
-            WHERE cm.channel_id = ? AND cm.content LIKE ?
-            ORDER BY cm.timestamp DESC
-            LIMIT ?
-        ''', (channel_id, f'%{q}%', min(limit, 50)))
-        
-        results = [dict(row) for row in c.fetchall()]
+        rows = search_channels(c, q, [channel_id], min(limit, 50))
+        results = [{"id": r['id'], "content": r['content'], "snippet": r['snippet'],
+                    "timestamp": r['timestamp'], "sender": r['sender']} for r in rows]
         conn.close()
         
         return {"status": "success", "results": results, "count": len(results)}
@@ -873,11 +764,7 @@ async def lobby_endpoint(websocket: WebSocket, user_id: str, token: str = Query(
             authenticated = True
     # Fallback: raw token auth (backward compatibility)
     if not authenticated and token:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT username FROM users WHERE token = ?", (token,))
-        db_user = c.fetchone()
-        conn.close()
+        db_user = await session_user(token)
         if db_user and db_user['username'] == user_id:
             authenticated = True
     if not authenticated:
@@ -886,6 +773,7 @@ async def lobby_endpoint(websocket: WebSocket, user_id: str, token: str = Query(
         return
     # Auth passed — accept connection
     await websocket.accept()
+    open_outbox(websocket, f"lobby:{user_id}", resync=presence_resync_frame(user_id))
     
     # De-duplicate: If user already connected, remove old connection
     if user_id in lobby.active_connections:
@@ -898,28 +786,15 @@ async def lobby_endpoint(websocket: WebSocket, user_id: str, token: str = Query(
     lobby.active_connections[user_id] = websocket
     log_event("LOBBY", f"Lobby connection: {user_id}. Total: {len(lobby.active_connections)}")
 
-    # APPLY PREFERRED STATUS + POPULATE CACHE
+    # APPLY PREFERRED STATUS + POPULATE CACHE + INDEX MEMBERSHIP
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT preferred_status FROM users WHERE username = ?", (user_id,))
-        pref = c.fetchone()
-        if pref:
-            pref_status = pref['preferred_status']
-            # If invisible, keep them 'offline' in DB so they don't appear online to others
-            if pref_status == 'invisible':
-                new_status = 'offline'
-            else:
-                new_status = pref_status
-            c.execute("UPDATE users SET status = ? WHERE username = ?", (new_status, user_id))
-            conn.commit()
-        conn.close()
-        # Populate in-memory cache from DB (one-time per connect)
-        cache_user_status(user_id)
+        await run_db(_apply_preferred_status, user_id)
     except Exception as e:
         log_event("ERROR", f"Status update error: {e}")
     
-    await broadcast_room_update()
+    # Full state once; everything after this arrives as presence/room deltas
+    await send_presence_snapshot(user_id, websocket)
+    await broadcast_room_update(username=user_id)
     
     try:
         while True:
@@ -928,85 +803,83 @@ async def lobby_endpoint(websocket: WebSocket, user_id: str, token: str = Query(
                 msg = json.loads(data)
                 
                 if msg.get('type') == 'ping':
-                    await websocket.send_text(json.dumps({
+                    queue_send(websocket, encode_frame({
                         "type": "pong",
                         "timestamp": msg.get("timestamp")
                     }))
                     
+                elif msg.get('type') == 'presence_resync':
+                    # Client saw a sequence gap
+                    await send_presence_snapshot(user_id, websocket, resync=True)
+                    
                 elif msg.get('type') == 'status_update':
                     new_status = msg.get('status')
                     if new_status in ['online', 'idle', 'dnd', 'invisible']:
                         target_status = 'offline' if new_status == 'invisible' else new_status
                         # Update DB
-                        conn = get_db_connection()
-                        c = conn.cursor()
-                        c.execute("UPDATE users SET status = ?, preferred_status = ? WHERE username = ?", 
-                                 (target_status, new_status, user_id))
-                        conn.commit()
-                        conn.close()
+                        _set_user_status(user_id, target_status, new_status)
                         # Update in-memory cache (no DB query on next broadcast)
                         update_cached_status(user_id, target_status, new_status)
                         
                         # Broadcast update (debounced)
-                        await broadcast_room_update()
+                        await broadcast_room_update(username=user_id)
                         
             except Exception as e:
                 log_event("ERROR", f"Lobby msg error: {e}")
     except WebSocketDisconnect:
-        if user_id in lobby.active_connections and lobby.active_connections[user_id] == websocket:
-            del lobby.active_connections[user_id]
+        # A replaced connection (same user reconnected) must not take the new one offline
+        if lobby.active_connections.get(user_id) is not websocket:
+            return
+        del lobby.active_connections[user_id]
         
         # SET OFFLINE + clear cache
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("UPDATE users SET status = 'offline' WHERE username = ?", (user_id,))
-            conn.commit()
-            conn.close()
+            _set_user_status(user_id, 'offline')
         except: pass
         remove_cached_user(user_id)
 
-        await broadcast_room_update()
+        await broadcast_room_update(username=user_id)
+    finally:
+        close_outbox(websocket)
 
 
 @router.websocket("/ws/room/{room_id}/{user_id}")
 async def room_endpoint(websocket: WebSocket, room_id: str, user_id: str, token: str = Query(default=None)):
     # --- AUTH: Validate via ticket-first, then token fallback ---
-    from routers.auth import validate_ws_ticket
+    from routers.auth import consume_ws_ticket
     authenticated = False
+    account_id = None  # users.id; the username in the URL may be shared by several accounts
     if token:
-        ticket_user = validate_ws_ticket(token)
-        if ticket_user and ticket_user == user_id:
+        ticket = consume_ws_ticket(token)
+        if ticket and ticket["username"] == user_id:
             authenticated = True
+            account_id = ticket["user_id"]
     if not authenticated and token:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT username FROM users WHERE token = ?", (token,))
-        db_user = c.fetchone()
-        conn.close()
+        db_user = await session_user(token)
         if db_user and db_user['username'] == user_id:
             authenticated = True
+            account_id = db_user['id']
     if not authenticated:
         await websocket.close(code=4001)  # Unauthorized
         log_event("SECURITY", f"WS Room rejected: claimed user_id={user_id}")
         return
     # Auth passed — accept connection
     await websocket.accept()
+    open_outbox(websocket, f"room:{room_id}:{user_id}")
     
     # 1. Check if room exists in memory
     if room_id not in rooms:
         # 2. If not, check DB (is it a valid server channel?)
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute("SELECT name FROM channels WHERE id = ?", (room_id,))
-        channel = c.fetchone()
-        conn.close()
+        channel = await run_db(_channel_info, room_id)
         
-        if channel:
-            # Create dynamic room
-            rooms[room_id] = VoiceRoom(room_id, channel[0])
-            log_event("ROOM", f"Dynamic room created: {channel[0]} ({room_id})")
+        if channel is not None:
+            channel_name, server_id = channel
+            # Create dynamic room (unless a concurrent join created it while we queried)
+            if room_id not in rooms:
+                rooms[room_id] = VoiceRoom(room_id, channel_name, server_id)
+                log_event("ROOM", f"Dynamic room created: {channel_name} ({room_id})")
         else:
+            close_outbox(websocket)
             await websocket.close()
             log_event("ERROR", f"Invalid Room ID: {room_id}")
             return
@@ -1015,122 +888,45 @@ async def room_endpoint(websocket: WebSocket, room_id: str, user_id: str, token:
 
     # --- GHOST SESSION CLEANUP ---
     # If this user already has a connection in this room (e.g. reconnect after crash),
-    # forcibly close and remove the old one to prevent duplicate entries.
-    ghost_sessions = [c for c in room.active_connections if c['user_id'] == user_id]
-    for ghost in ghost_sessions:
+    # the new one replaces it and the old socket is closed.
+    conn_info = RoomConnection(websocket, user_id)  # default audio state
+    ghost = room.add_connection(conn_info)
+    if ghost is not None:
         try:
-            await ghost['ws'].close()
+            await ghost.ws.close()
         except:
             pass
-        room.active_connections.remove(ghost)
         log_event("CLEANUP", f"Ghost session removed for {user_id} in {room.name}")
-
-    # Initialize with default audio state
-    conn_info = {
-        'ws': websocket, 
-        'user_id': user_id,
-        'is_muted': False,
-        'is_deafened': False,
-        'is_screen_sharing': False
-    }
-    room.active_connections.append(conn_info)
     
     log_event("CONNECT", f"{user_id} --> {room.name}")
 
     # -- Voice Log: JOIN --
     try:
-        vconn = get_db_connection()
-        vconn.execute(
-            "INSERT INTO voice_logs (channel_id, channel_name, user_id, action) VALUES (?, ?, ?, ?)",
-            (room_id, room.name, user_id, 'join')
-        )
-        vconn.commit()
-        vconn.close()
+        _log_voice_event(room_id, room.name, user_id, 'join')
     except Exception as ve:
         log_event("WARN", f"Voice log join failed: {ve}")
     
-    await broadcast_room_update()
+    await broadcast_room_update(room_id=room_id)
     await broadcast_user_list(room_id)
     
-    if len(room.active_connections) > 1:
-        await websocket.send_text(json.dumps({
+    if len(room) > 1:
+        queue_send(websocket, encode_frame({
             "type": "system",
             "action": "please_offer" 
         }))
 
     # --- SEND CHAT HISTORY ---
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''
-        SELECT cm.id, cm.content, cm.timestamp, cm.attachment_url, cm.attachment_type,
-               cm.attachment_name, cm.edited_at, cm.reply_to_id, cm.is_pinned,
-               u.username as sender
-        FROM channel_messages cm
-        JOIN users u ON cm.sender_id = u.id
-        WHERE cm.channel_id = ?
-        ORDER BY cm.timestamp ASC
-        LIMIT 50
-    ''', (room_id,))
+    # Newest messages, pre-encoded by the hot message cache; SQLite only on a cold channel
+    cached, history = message_cache.history_frame(room_id)
+    if not cached:
+        history = await run_db(room_history_frame, room_id)
     
-    rows = c.fetchall()
-    msg_ids = [row['id'] for row in rows]
-
-    # Fetch reactions
-    reactions_map = {}
-    if msg_ids:
-        placeholders = ','.join(['?'] * len(msg_ids))
-        c.execute(f'''
-            SELECT mr.message_id, mr.emoji, u.username
-            FROM message_reactions mr
-            JOIN users u ON mr.user_id = u.id
-            WHERE mr.message_id IN ({placeholders})
-        ''', msg_ids)
-        for r in c.fetchall():
-            mid = r['message_id']
-            if mid not in reactions_map:
-                reactions_map[mid] = {}
-            emoji = r['emoji']
-            if emoji not in reactions_map[mid]:
-                reactions_map[mid][emoji] = []
-            reactions_map[mid][emoji].append(r['username'])
-
-    # Fetch reply_to context
-    reply_ids = [row['reply_to_id'] for row in rows if row['reply_to_id']]
-    reply_map = {}
-    if reply_ids:
-        placeholders = ','.join(['?'] * len(reply_ids))
-        c.execute(f'''
-            SELECT cm.id, cm.content, u.username as sender
-            FROM channel_messages cm
-            JOIN users u ON cm.sender_id = u.id
-            WHERE cm.id IN ({placeholders})
-        ''', reply_ids)
-        for r in c.fetchall():
-            reply_map[r['id']] = {"id": r['id'], "sender": r['sender'], "text": r['content'][:100]}
-
-    history_msgs = []
-    for row in rows:
-        history_msgs.append({
-            "id": row['id'],
-            "sender": row['sender'],
-            "text": row['content'],
-            "content": row['content'],
-            "timestamp": row['timestamp'],
-            "attachment_url": row['attachment_url'],
-            "attachment_type": row['attachment_type'],
-            "attachment_name": row['attachment_name'],
-            "edited_at": row['edited_at'],
-            "is_pinned": bool(row['is_pinned']),
-            "reactions": reactions_map.get(row['id'], {}),
-            "reply_to": reply_map.get(row['reply_to_id'])
-        })
-    conn.close()
-    
-    if history_msgs:
-        await websocket.send_text(json.dumps({
-            "type": "history",
-            "messages": history_msgs
-        }))
+    if history is not None:
+        queue_send(websocket, history)
+        # The shared history can't say which reactions are this user's; a small per-user follow-up does
+        mine = await run_db(room_my_reactions, room_id, account_id)
+        if mine:
+            queue_send(websocket, encode_frame({"type": "my_reactions", "reactions": mine}))
     # -------------------------
     
     try:
@@ -1148,119 +944,244 @@ async def room_endpoint(websocket: WebSocket, room_id: str, user_id: str, token:
                 await _handle_user_state(data, conn_info, room_id)
             else:
                 # WebRTC signaling (ICE, Offer, Answer) — relay to peers
-                await _relay_to_peers(data_str, room, websocket)
+                await _relay_to_peers(data_str, data, room, websocket)
             
     except WebSocketDisconnect:
-        if conn_info in room.active_connections:
-            room.active_connections.remove(conn_info)
+        room.remove_connection(conn_info)
         
         log_event("DISCONNECT", f"{user_id} <-- {room.name}")
 
         # -- Voice Log: LEAVE --
         try:
-            vconn = get_db_connection()
-            vconn.execute(
-                "INSERT INTO voice_logs (channel_id, channel_name, user_id, action) VALUES (?, ?, ?, ?)",
-                (room_id, room.name, user_id, 'leave')
-            )
-            vconn.commit()
-            vconn.close()
+            _log_voice_event(room_id, room.name, user_id, 'leave')
         except Exception as ve:
             log_event("WARN", f"Voice log leave failed: {ve}")
 
-        await broadcast_room_update()
+        await broadcast_room_update(room_id=room_id)
         await broadcast_user_list(room_id)
+    finally:
+        close_outbox(websocket)
 
 
 # ── Room Sub-Handlers ────────────────────────────────────────────────────────
 
 async def _handle_chat_message(data: dict, user_id: str, room_id: str, room, websocket):
     """Save a chat message to DB and broadcast it to the room."""
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT id, username FROM users WHERE username = ?", (user_id,))
-    user_row = c.fetchone()
-    full_msg = None
+    outcome, full_msg = await run_db(_prepare_chat_message, data, user_id, room_id)
+    if outcome == "denied":
+        queue_send(websocket, encode_frame({"type": "error", "message": "Mesaj göndermek için yetkiniz yok."}))
+        return
+    if outcome == "dropped":
+        return
 
-    if user_row:
-        c.execute("SELECT server_id FROM channels WHERE id = ?", (room_id,))
-        chan = c.fetchone()
-        if chan and not check_permission(user_row['id'], chan['server_id'], PERM_SEND_MESSAGES):
-            conn.close()
-            await websocket.send_text(json.dumps({"type": "error", "message": "Mesaj göndermek için yetkiniz yok."}))
+    if full_msg:
+        # Group-committed with other queued writes; we only need the new id
+        try:
+            full_msg["id"] = await write_async(
+                '''INSERT INTO channel_messages 
+                   (channel_id, sender_id, content, attachment_url, attachment_type, attachment_name, reply_to_id) 
+                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                (room_id, full_msg.pop("sender_id"), data.get('text', ""),
+                 data.get('attachment_url'), data.get('attachment_type'), data.get('attachment_name'),
+                 data.get('reply_to_id')))
+        except Exception as e:
+            log_event("ERROR", f"Chat message insert failed: {e}")
             return
-
-        if data.get('attachment_url'):
-            if chan and not check_permission(user_row['id'], chan['server_id'], PERM_ATTACH_FILES):
-                conn.close()
-                return
-
-        c.execute('''INSERT INTO channel_messages 
-                    (channel_id, sender_id, content, attachment_url, attachment_type, attachment_name, reply_to_id) 
-                    VALUES (?, ?, ?, ?, ?, ?, ?)''', 
-                  (room_id, user_row['id'], data.get('text', ""), 
-                   data.get('attachment_url'), data.get('attachment_type'), data.get('attachment_name'),
-                   data.get('reply_to_id')))
-        msg_id = c.lastrowid
-        conn.commit()
-
-        full_msg = {
-            "type": "chat",
-            "id": msg_id,
-            "sender": user_row['username'],
-            "text": data.get('text', ""),
-            "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-            "attachment_url": data.get('attachment_url'),
-            "attachment_type": data.get('attachment_type'),
-            "attachment_name": data.get('attachment_name'),
-            "reply_to_id": data.get('reply_to_id'),
+        message_cache.message_added(room_id, {
+            "id": full_msg["id"],
+            "sender": full_msg["sender"],
+            "text": full_msg["text"],
+            "timestamp": full_msg["timestamp"],
+            "attachment_url": full_msg["attachment_url"],
+            "attachment_type": full_msg["attachment_type"],
+            "attachment_name": full_msg["attachment_name"],
+            "attachment_thumb": full_msg["attachment_thumb"],
+            "edited_at": None,
+            "is_pinned": False,
             "reactions": {},
-            "is_pinned": False
-        }
-
-        # Fetch reply_to context
-        if data.get('reply_to_id'):
-            c.execute('''
-                SELECT cm.id, cm.content, u.username as sender
-                FROM channel_messages cm
-                JOIN users u ON cm.sender_id = u.id
-                WHERE cm.id = ?
-            ''', (data.get('reply_to_id'),))
-            reply_row = c.fetchone()
-            if reply_row:
-                full_msg["reply_to"] = {
-                    "id": reply_row['id'], 
-                    "sender": reply_row['sender'], 
-                    "text": reply_row['content'][:100]
-                }
-
-    conn.close()
+            "reaction_counts": {},
+            "reply_to": full_msg.get("reply_to")
+        })
 
     if full_msg:
-        await broadcast(room, json.dumps(full_msg))
+        await broadcast(room, encode_frame(full_msg))
     else:
-        await broadcast(room, json.dumps(data))
+        await broadcast(room, encode_frame(data))
 
 
 async def _handle_typing(data: dict, room):
     """Broadcast a typing indicator to the room."""
-    await broadcast(room, json.dumps(data))
+    await broadcast(room, encode_frame(data), FRAME_PRESENCE)
 
 
-async def _handle_user_state(data: dict, conn_info: dict, room_id: str):
+async def _handle_user_state(data: dict, conn_info: RoomConnection, room_id: str):
     """Update mute/deafen/screen-share state and notify room."""
-    conn_info['is_muted'] = data.get("is_muted", False)
-    conn_info['is_deafened'] = data.get("is_deafened", False)
-    conn_info['is_screen_sharing'] = data.get("is_screen_sharing", False)
-    await broadcast_user_list(room_id)
+    room = rooms.get(room_id)
+    if room is None:
+        return
+    changed = room.set_state(
+        conn_info,
+        data.get("is_muted", False),
+        data.get("is_deafened", False),
+        data.get("is_screen_sharing", False),
+    )
+    if changed:
+        await broadcast_user_list(room_id)
 
 
-async def _relay_to_peers(data_str: str, room, sender_ws):
-    """Relay WebRTC signaling messages (ICE, Offer, Answer) to peers."""
-    for conn in room.active_connections:
-        if conn['ws'] != sender_ws:
-            try:
-                await conn['ws'].send_text(data_str)
-            except Exception:
-                pass
+async def _relay_to_peers(data_str: str, data: dict, room, sender_ws):
+    """
+    Relay WebRTC signaling messages (ICE, Offer, Answer) to peers.
+    Messages with a `target` go to that user only; untargeted ones to everyone else.
+    """
+    frame = Frame.from_text(data_str)  # relayed verbatim, no re-encode
+    stats = room.relay_stats
+    target = data.get("target")
+    if target:
+        conn = room.active_connections.get(target)
+        if conn is None or conn.ws is sender_ws:
+            # Peer already left (or a self-target); its offer/candidate is stale
+            stats["unroutable"] += 1
+            return
+        stats["targeted"] += 1
+        stats["frames_sent"] += 1
+        queue_send(conn.ws, frame)
+        return
+
+    stats["broadcast"] += 1
+    for conn in room.active_connections.values():
+        if conn.ws is not sender_ws:
+            stats["frames_sent"] += 1
+            queue_send(conn.ws, frame)
+
+
+# ── WebSocket DB Helpers (run via run_db) ────────────────────────────────────
+
+def _apply_preferred_status(user_id: str):
+    """Apply a user's preferred status on lobby connect and warm the status cache."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(
+        "SELECT username, status, preferred_status, custom_status, "
+        f"display_name, avatar_url, avatar_color, discriminator, {AVATAR_VARIANTS_SQL} "
+        "FROM users u WHERE username = ?",
+        (user_id,)
+    )
+    row = c.fetchone()
+    conn.close()
+    if not row:
+        return
+    cached = with_avatar_thumbs(row)
+    pref_status = cached['preferred_status']
+    # If invisible, keep them 'offline' in DB so they don't appear online to others
+    if pref_status == 'invisible':
+        new_status = 'offline'
+    else:
+        new_status = pref_status
+    _set_user_status(user_id, new_status)
+    # Populate in-memory cache (one-time per connect) — from the row we already
+    # have, since the status write above is still sitting in the write queue
+    cached['status'] = new_status
+    cache_user_status(user_id, cached)
+    # Index servers / friends so presence only goes to users who may see it
+    load_membership(user_id)
+
+
+def _set_user_status(user_id: str, status: str, preferred_status: str = None):
+    """Queue a presence status write (non-blocking, group-committed)."""
+    if preferred_status is None:
+        enqueue_write("UPDATE users SET status = ? WHERE username = ?", (status, user_id))
+    else:
+        enqueue_write("UPDATE users SET status = ?, preferred_status = ? WHERE username = ?",
+                      (status, preferred_status, user_id))
+
+
+def _channel_info(room_id: str):
+    """(name, server_id) of a channel, or None."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT name, server_id FROM channels WHERE id = ?", (room_id,))
+    channel = c.fetchone()
+    conn.close()
+    return (channel[0], channel[1]) if channel else None
 
+
+def _log_voice_event(room_id: str, room_name: str, user_id: str, action: str):
+    """Queue a voice join/leave log entry (non-blocking, group-committed)."""
+    enqueue_write(
+        "INSERT INTO voice_logs (channel_id, channel_name, user_id, action) VALUES (?, ?, ?, ?)",
+        (room_id, room_name, user_id, action)
+    )
+
+
+def _attachment_variants(c, url: str):
+    c.execute("SELECT variants FROM attachments WHERE url = ?", (url,))
+    row = c.fetchone()
+    return row['variants'] if row else None
+
+
+def _prepare_chat_message(data: dict, user_id: str, room_id: str):
+    """Permission checks + reply context for an incoming chat message.
+    Returns (outcome, full_msg) where outcome is "ok", "denied" (no SEND_MESSAGES),
+    "dropped" (no ATTACH_FILES) or "unknown" (no such user). The insert itself
+    goes through the write queue (see _handle_chat_message)."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT id, username FROM users WHERE username = ?", (user_id,))
+    user_row = c.fetchone()
+    if not user_row:
+        conn.close()
+        return "unknown", None
+
+    c.execute("SELECT server_id FROM channels WHERE id = ?", (room_id,))
+    chan = c.fetchone()
+    if chan and not check_permission(user_row['id'], chan['server_id'], PERM_SEND_MESSAGES):
+        conn.close()
+        return "denied", None
+
+    if data.get('attachment_url'):
+        if chan and not check_permission(user_row['id'], chan['server_id'], PERM_ATTACH_FILES):
+            conn.close()
+            return "dropped", None
+
+    full_msg = {
+        "type": "chat",
+        "id": None,
+        "sender_id": user_row['id'],
+        "sender": user_row['username'],
+        "text": data.get('text', ""),
+        "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        "attachment_url": data.get('attachment_url'),
+        "attachment_type": data.get('attachment_type'),
+        "attachment_name": data.get('attachment_name'),
+        "attachment_thumb": None,
+        "reply_to_id": data.get('reply_to_id'),
+        "reactions": {},
+        "reaction_counts": {},
+        "is_pinned": False
+    }
+
+    # Thumbnail, if the image's was already generated (otherwise the cache picks it up later)
+    if full_msg["attachment_type"] == 'image' and full_msg["attachment_url"]:
+        full_msg["attachment_thumb"] = attachment_thumb(
+            known_variants(full_msg["attachment_url"])
+            or parse_variants(_attachment_variants(c, full_msg["attachment_url"])))
+
+    # Fetch reply_to context
+    if data.get('reply_to_id'):
+        c.execute('''
+            SELECT cm.id, cm.content, u.username as sender
+            FROM channel_messages cm
+            JOIN users u ON cm.sender_id = u.id
+            WHERE cm.id = ?
+        ''', (data.get('reply_to_id'),))
+        reply_row = c.fetchone()
+        if reply_row:
+            full_msg["reply_to"] = {
+                "id": reply_row['id'], 
+                "sender": reply_row['sender'], 
+                "text": reply_row['content'][:100]
+            }
+
+    conn.close()
+    return "ok", full_msg
@@ -1,18 +1,37 @@
 from fastapi import APIRouter
 from models import DMSend
-from database import get_db_connection
-from utils import log_event, safe_error, logger
-from state import lobby
+from database import get_db_connection, run_db, db_offload
+from utils import log_event, safe_error, logger, get_session_user, session_user, encode_frame
+from state import lobby, friendship_changed, queue_send, FRAME_DATA, FRAME_PRESENCE
+from pagination import keyset_page, CursorError
+from search import search_dms
 import sqlite3
 import datetime
-import json
 
 router = APIRouter(tags=["friends"])
 
+async def _notify_lobby(notify):
+    """Push a (username, payload) event to a user's lobby socket if they're online."""
+    if not notify:
+        return
+    username, payload = notify
+    ws = lobby.active_connections.get(username)
+    if not ws:
+        return
+    # Typing indicators may be dropped under back-pressure; everything else is queued
+    kind = FRAME_PRESENCE if payload.get("type") == "dm_typing" else FRAME_DATA
+    if not queue_send(ws, encode_frame(payload), kind):
+        logger.warning(f"Lobby push not queued for {payload.get('type')} ({username})")
+
 # --- Friends ---
 
 @router.post("/friends/add")
 async def add_friend(data: dict):
+    result = await run_db(_add_friend, data)
+    await _notify_lobby(result.pop("_notify", None))
+    return result
+
+def _add_friend(data: dict):
     try:
         token = data.get('token')
         friend_tag = data.get('friend_tag') # username#1234
@@ -66,28 +85,27 @@ async def add_friend(data: dict):
         conn.close()
         
         # Push notification via Lobby
-        if friend['username'] in lobby.active_connections:
-             try:
-                 await lobby.active_connections[friend['username']].send_text(json.dumps({
-                     "type": "friend_request",
-                     "sender": user['username'],
-                     "discriminator": user['discriminator'] or '0001', 
-                 }))
-             except: pass
-        
-        return {"status": "success", "message": "Arkadaşlık isteği gönderildi."}
+        return {
+            "status": "success",
+            "message": "Arkadaşlık isteği gönderildi.",
+            "_notify": (friend['username'], {
+                "type": "friend_request",
+                "sender": user['username'],
+                "discriminator": user['discriminator'] or '0001',
+            }),
+        }
     except Exception as e:
         return safe_error(e)
 
 @router.post("/friends/requests")
-async def get_friend_requests(data: dict):
+@db_offload
+def get_friend_requests(data: dict):
     try:
         token = data.get('token')
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user: return {"status": "error"}
         
         # Get incoming requests
@@ -108,7 +126,8 @@ async def get_friend_requests(data: dict):
         return safe_error(e)
 
 @router.post("/friends/respond")
-async def respond_friend_request(data: dict):
+@db_offload
+def respond_friend_request(data: dict):
     try:
         token = data.get('token')
         sender_username = data.get('sender_username')
@@ -120,8 +139,7 @@ async def respond_friend_request(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        me = c.fetchone()
+        me = get_session_user(token)
         
         sender = None
         if sender_username:
@@ -177,12 +195,15 @@ async def respond_friend_request(data: dict):
             
         conn.commit()
         conn.close()
+        if action == 'accept':
+            friendship_changed(me['id'], sender['id'], added=True)
         return {"status": "success", "message": msg}
     except Exception as e:
         return safe_error(e)
 
 @router.post("/friends/remove")
-async def remove_friend(data: dict):
+@db_offload
+def remove_friend(data: dict):
     try:
         token = data.get('token')
         friend_username = data.get('friend_username')
@@ -195,8 +216,7 @@ async def remove_friend(data: dict):
         c = conn.cursor()
         
         # 1. Validate token
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -219,6 +239,7 @@ async def remove_friend(data: dict):
         
         conn.commit()
         conn.close()
+        friendship_changed(user['id'], friend['id'], added=False)
         
         return {"status": "success", "message": "Arkadaş kaldırıldı."}
         
@@ -226,15 +247,15 @@ async def remove_friend(data: dict):
         return safe_error(e)
 
 @router.get("/friends")
-async def get_friends_data(token: str):
+@db_offload
+def get_friends_data(token: str):
     # This combines list friends and requests for the initial load
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
         # 1. Validate token
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -287,13 +308,17 @@ async def list_friends(data: dict):
 
 @router.post("/dm/send")
 async def send_dm(dm: DMSend):
+    result = await run_db(_send_dm, dm)
+    await _notify_lobby(result.pop("_notify", None))
+    return result
+
+def _send_dm(dm: DMSend):
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
         # 1. Validate sender
-        c.execute("SELECT id, username FROM users WHERE token = ?", (dm.token,))
-        sender = c.fetchone()
+        sender = get_session_user(dm.token)
         if not sender:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -322,68 +347,52 @@ async def send_dm(dm: DMSend):
         conn.close()
 
         
-        # 4. Real-time push via Lobby WebSocket
-        if dm.receiver_username in lobby.active_connections:
-            ws = lobby.active_connections[dm.receiver_username]
-            try:
-                await ws.send_text(json.dumps({
-                    "type": "dm_received",
-                    "sender": sender['username'],
-                    "content": dm.content,
-                    "timestamp": datetime.datetime.now().isoformat()
-                }))
-            except Exception:
-                logger.exception("send_dm WebSocket push failed")
-
-        return {"status": "success"}
+        # 5. Real-time push via Lobby WebSocket
+        return {
+            "status": "success",
+            "_notify": (dm.receiver_username, {
+                "type": "dm_received",
+                "sender": sender['username'],
+                "content": dm.content,
+                "timestamp": datetime.datetime.now().isoformat()
+            }),
+        }
     except Exception as e:
         return safe_error(e)
 
 @router.post("/dm/history")
-async def get_dm_history(data: dict):
+@db_offload
+def get_dm_history(data: dict):
     try:
         token = data.get('token')
         other_username = data.get('username')
-        before_id = data.get('before_id')  # pagination
-        limit = min(data.get('limit', 50), 100)
+        before_id = data.get('before_id')  # legacy raw-id pagination
+        cursor = data.get('cursor')
+        limit = max(1, min(data.get('limit', 50), 100))
         
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        me = c.fetchone()
+        me = get_session_user(token)
         if not me: return {"status": "error"}
         
         c.execute("SELECT id FROM users WHERE username = ?", (other_username,))
         other = c.fetchone()
         if not other: return {"status": "error"}
         
-        # Get history with pagination
-        if before_id:
-            c.execute('''
-                SELECT m.id, m.content, m.timestamp, m.edited_at, u.username as sender
-                FROM messages m
-                JOIN users u ON m.sender_id = u.id
-                WHERE ((m.sender_id = ? AND m.receiver_id = ?) 
-                   OR (m.sender_id = ? AND m.receiver_id = ?))
-                   AND m.id < ?
-                ORDER BY m.timestamp DESC
-                LIMIT ?
-            ''', (me['id'], other['id'], other['id'], me['id'], before_id, limit))
-        else:
-            c.execute('''
+        # Keyset page over both directions of the conversation; each direction is
+        # its own range scan on (sender_id, receiver_id, id), merged by id
+        pair = sorted((me['id'], other['id']))
+        page = keyset_page(c, '''
                 SELECT m.id, m.content, m.timestamp, m.edited_at, u.username as sender
                 FROM messages m
                 JOIN users u ON m.sender_id = u.id
-                WHERE (m.sender_id = ? AND m.receiver_id = ?) 
-                   OR (m.sender_id = ? AND m.receiver_id = ?)
-                ORDER BY m.timestamp DESC
-                LIMIT ?
-            ''', (me['id'], other['id'], other['id'], me['id'], limit))
+            ''', [("m.sender_id = ? AND m.receiver_id = ?", (me['id'], other['id'])),
+                  ("m.sender_id = ? AND m.receiver_id = ?", (other['id'], me['id']))],
+            f"dm:{pair[0]}:{pair[1]}", limit, cursor=cursor, before_id=before_id, id_column="m.id")
         
-        rows = c.fetchall()
         messages = []
-        for row in rows:
+        for row in page.pop("items"):
             messages.append({
                 "id": row['id'],
                 "sender": row['sender'],
@@ -391,17 +400,56 @@ async def get_dm_history(data: dict):
                 "timestamp": row['timestamp'],
                 "edited_at": row['edited_at']
             })
-        
-        messages.reverse()  # Back to chronological
             
         conn.close()
-        return {"status": "success", "messages": messages}
+        return {"status": "success", "messages": messages, **page}
+    except CursorError as e:
+        return {"status": "error", "message": str(e)}
+    except Exception as e:
+        return safe_error(e)
+
+@router.post("/dm/search")
+@db_offload
+def search_dms_route(data: dict):
+    """Ranked full-text search over the caller's DMs, optionally with one user."""
+    try:
+        q = (data.get('q') or '').strip()
+        if len(q) < 2:
+            return {"status": "error", "message": "Arama terimi en az 2 karakter olmalı"}
+        limit = max(1, min(data.get('limit', 25), 50))
+        
+        me = get_session_user(data.get('token'))
+        if not me: return {"status": "error", "message": "Invalid token"}
+        
+        conn = get_db_connection()
+        c = conn.cursor()
+        other_id = None
+        if data.get('username'):
+            c.execute("SELECT id FROM users WHERE username = ?", (data.get('username'),))
+            other = c.fetchone()
+            if not other:
+                conn.close()
+                return {"status": "error", "message": "Kullanıcı bulunamadı"}
+            other_id = other['id']
+        
+        rows = search_dms(c, q, me['id'], other_id, limit)
+        conn.close()
+        results = [{
+            "id": r['id'], "sender": r['sender'], "receiver": r['receiver'],
+            "content": r['content'], "snippet": r['snippet'], "timestamp": r['timestamp']
+        } for r in rows]
+        return {"status": "success", "results": results, "query": q}
     except Exception as e:
         return safe_error(e)
 
 @router.post("/dm/edit")
 async def edit_dm(data: dict):
     """Edit a DM message (sender only)."""
+    result = await run_db(_edit_dm, data)
+    await _notify_lobby(result.pop("_notify", None))
+    return result
+
+def _edit_dm(data: dict):
     try:
         token = data.get('token')
         message_id = data.get('message_id')
@@ -410,8 +458,7 @@ async def edit_dm(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -436,22 +483,25 @@ async def edit_dm(data: dict):
         conn.close()
 
         # Broadcast dm_edited to receiver if online
-        if receiver_row and receiver_row['username'] in lobby.active_connections:
-            try:
-                await lobby.active_connections[receiver_row['username']].send_text(json.dumps({
-                    "type": "dm_edited",
-                    "message_id": message_id,
-                    "new_content": new_content
-                }))
-            except: pass
-
-        return {"status": "success"}
+        result = {"status": "success"}
+        if receiver_row:
+            result["_notify"] = (receiver_row['username'], {
+                "type": "dm_edited",
+                "message_id": message_id,
+                "new_content": new_content
+            })
+        return result
     except Exception as e:
         return safe_error(e)
 
 @router.post("/dm/delete")
 async def delete_dm(data: dict):
     """Delete a DM message (sender only)."""
+    result = await run_db(_delete_dm, data)
+    await _notify_lobby(result.pop("_notify", None))
+    return result
+
+def _delete_dm(data: dict):
     try:
         token = data.get('token')
         message_id = data.get('message_id')
@@ -459,8 +509,7 @@ async def delete_dm(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -484,15 +533,13 @@ async def delete_dm(data: dict):
         conn.close()
 
         # Broadcast dm_deleted to receiver if online
-        if receiver_row and receiver_row['username'] in lobby.active_connections:
-            try:
-                await lobby.active_connections[receiver_row['username']].send_text(json.dumps({
-                    "type": "dm_deleted",
-                    "message_id": message_id
-                }))
-            except: pass
-
-        return {"status": "success"}
+        result = {"status": "success"}
+        if receiver_row:
+            result["_notify"] = (receiver_row['username'], {
+                "type": "dm_deleted",
+                "message_id": message_id
+            })
+        return result
     except Exception as e:
         return safe_error(e)
 
@@ -506,24 +553,16 @@ async def dm_typing(data: dict):
         if not token or not receiver_username:
             return {"status": "error", "message": "Missing fields"}
 
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT username FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
-        conn.close()
-
+        user = await session_user(token)
         if not user:
             return {"status": "error", "message": "Invalid token"}
 
         # Broadcast to receiver if online
-        if receiver_username in lobby.active_connections:
-            try:
-                await lobby.active_connections[receiver_username].send_text(json.dumps({
-                    "type": "dm_typing",
-                    "sender": user['username']
-                }))
-            except: pass
+        await _notify_lobby((receiver_username, {
+            "type": "dm_typing",
+            "sender": user['username']
+        }))
 
         return {"status": "success"}
     except Exception as e:
-        return safe_error(e)
+        return safe_error(e)
\ No newline at end of file
@@ -1,7 +1,13 @@
-from fastapi import APIRouter, UploadFile, File, Form
+from fastapi import APIRouter, UploadFile, File, Form, Query
 from models import ServerCreate, ServerJoin, RoleCreate
-from database import get_db_connection
-from utils import log_event, check_permission, get_user_permissions, create_audit_log, safe_error, PERM_MANAGE_ROLES, PERM_KICK_MEMBERS, PERM_BAN_MEMBERS, PERM_MANAGE_CHANNELS, PERM_MANAGE_SERVER, check_server_membership, validate_upload, ALLOWED_IMAGE_EXTS
+from database import get_db_connection, run_db, db_offload
+from utils import log_event, check_permission, create_audit_log, safe_error, PERM_MANAGE_ROLES, PERM_KICK_MEMBERS, PERM_BAN_MEMBERS, PERM_MANAGE_CHANNELS, PERM_MANAGE_SERVER, PERM_VIEW_CHANNELS, check_server_membership, ALLOWED_IMAGE_EXTS, get_session_user, get_permissions_bulk, invalidate_permissions
+from state import membership_changed, server_removed
+from pagination import keyset_page, CursorError, encode_cursor, decode_cursor, PAGE_OLDER
+from search import search_messages_page, message_filters
+from uploads import save_upload, UploadRejected
+from message_cache import message_cache
+from thumbnails import avatar_variants, avatar_thumbs, with_avatar_thumbs, AVATAR_VARIANTS_SQL
 import uuid
 import secrets
 import sqlite3
@@ -11,14 +17,14 @@ import datetime
 router = APIRouter(prefix="/server", tags=["server"])
 
 @router.post("/create")
-async def create_server(data: ServerCreate):
+@db_offload
+def create_server(data: ServerCreate):
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
         # 1. Validate Token
-        c.execute("SELECT id FROM users WHERE token = ?", (data.token,))
-        user = c.fetchone()
+        user = get_session_user(data.token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -42,6 +48,8 @@ async def create_server(data: ServerCreate):
                  
         conn.commit()
         conn.close()
+        invalidate_permissions(user_id=user['id'], server_id=server_id)
+        membership_changed(server_id, user['id'], joined=True)
         
         log_event("SERVER", f"Server created: {data.name} ({server_id}) by user {user['id']}")
         return {"status": "success", "server_id": server_id, "invite_code": invite_code}
@@ -50,19 +58,21 @@ async def create_server(data: ServerCreate):
         return safe_error(e)
 
 @router.get("/list")
-async def list_user_servers(token: str):
+@db_offload
+def list_user_servers(token: str):
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
         # Get User ID
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
             
-        # Get Servers user is a member of
+        # Fixed number of set-based queries regardless of how many servers the
+        # user is in: servers, channels of all those servers, permissions.
+        # 1. Servers user is a member of
         c.execute('''
             SELECT s.id, s.name, s.invite_code, s.owner_id 
             FROM servers s
@@ -71,14 +81,29 @@ async def list_user_servers(token: str):
         ''', (user['id'],))
         
         servers = [dict(row) for row in c.fetchall()]
+        by_id = {}
+        for srv in servers:
+            srv['channels'] = []
+            by_id[srv['id']] = srv
         
-        # For each server, get channels
-        for s in servers:
-            c.execute("SELECT id, name, type FROM channels WHERE server_id = ?", (s['id'],))
-            s['channels'] = [dict(row) for row in c.fetchall()]
-            
-            # Calculate and attach the user's permissions for this server
-            s['my_permissions'] = get_user_permissions(user['id'], s['id'])
+        # 2. Channels of all those servers in one pass
+        c.execute('''
+            SELECT ch.server_id, ch.id, ch.name, ch.type
+            FROM channels ch
+            JOIN members m ON m.server_id = ch.server_id
+            WHERE m.user_id = ?
+            ORDER BY m.server_id, ch.position
+        ''', (user['id'],))
+        for row in c.fetchall():
+            srv = by_id.get(row['server_id'])
+            if srv is not None:
+                srv['channels'].append({"id": row['id'], "name": row['name'], "type": row['type']})
+        
+        # 3. The user's permissions for every server (roles + assignments),
+        #    one query for whatever isn't already cached
+        perms = get_permissions_bulk(user['id'], list(by_id))
+        for srv in servers:
+            srv['my_permissions'] = perms.get(srv['id'], 0)
             
         conn.close()
         return {"status": "success", "servers": servers}
@@ -86,14 +111,14 @@ async def list_user_servers(token: str):
         return safe_error(e)
 
 @router.post("/join")
-async def join_server(data: ServerJoin):
+@db_offload
+def join_server(data: ServerJoin):
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
         # 1. Validate Token
-        c.execute("SELECT id FROM users WHERE token = ?", (data.token,))
-        user = c.fetchone()
+        user = get_session_user(data.token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -123,6 +148,8 @@ async def join_server(data: ServerJoin):
         
         conn.commit()
         conn.close()
+        invalidate_permissions(user_id=user['id'], server_id=server['id'])
+        membership_changed(server['id'], user['id'], joined=True)
         return {"status": "success", "server_id": server['id'], "server_name": "Joined"}
         
     except Exception as e:
@@ -131,14 +158,14 @@ async def join_server(data: ServerJoin):
 # --- MEMBER & ROLE MANAGEMENT ---
 
 @router.get("/{server_id}/members")
-async def get_server_members(server_id: str, token: str):
+@db_offload
+def get_server_members(server_id: str, token: str):
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
         # Validate Token
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -149,13 +176,14 @@ async def get_server_members(server_id: str, token: str):
         conn = get_db_connection()
         c = conn.cursor()
         # 1. Fetch Members with Details
-        c.execute('''
-            SELECT m.user_id, u.username, u.display_name, u.discriminator, u.avatar_url, u.avatar_color, u.status, m.role as legacy_role
+        c.execute(f'''
+            SELECT m.user_id, u.username, u.display_name, u.discriminator, u.avatar_url, u.avatar_color, u.status, m.role as legacy_role,
+                   {AVATAR_VARIANTS_SQL}
             FROM members m
             JOIN users u ON m.user_id = u.id
             WHERE m.server_id = ?
         ''', (server_id,))
-        members_raw = [dict(row) for row in c.fetchall()]
+        members_raw = [with_avatar_thumbs(row) for row in c.fetchall()]
 
         # 2. Fetch all Server Roles
         c.execute("SELECT * FROM roles WHERE server_id = ?", (server_id,))
@@ -206,7 +234,8 @@ async def get_server_members(server_id: str, token: str):
         return safe_error(e)
 
 @router.get("/{server_id}/roles")
-async def get_server_roles(server_id: str):
+@db_offload
+def get_server_roles(server_id: str):
     try:
         conn = get_db_connection()
         c = conn.cursor()
@@ -218,14 +247,14 @@ async def get_server_roles(server_id: str):
         return safe_error(e)
 
 @router.post("/{server_id}/roles")
-async def create_role(server_id: str, data: RoleCreate):
+@db_offload
+def create_role(server_id: str, data: RoleCreate):
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
         # Auth
-        c.execute("SELECT id FROM users WHERE token = ?", (data.token,))
-        user = c.fetchone()
+        user = get_session_user(data.token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -243,6 +272,7 @@ async def create_role(server_id: str, data: RoleCreate):
         c.execute("INSERT INTO roles (server_id, name, color, position, permissions) VALUES (?, ?, ?, ?, ?)",
                   (server_id, data.name, data.color, new_pos, data.permissions))
         conn.commit()
+        invalidate_permissions(server_id=server_id)
         
         # Get ID of inserted role
         new_role_id = c.lastrowid
@@ -262,8 +292,25 @@ async def create_role(server_id: str, data: RoleCreate):
     except Exception as e:
         return safe_error(e)
 
+def _delete_server_rows(c, server_id: str) -> list:
+    """
+    Delete a server and everything in it (uncommitted). Returns the ids of its
+    channels, whose cached messages the caller drops after the commit.
+    """
+    c.execute("SELECT id FROM channels WHERE server_id = ?", (server_id,))
+    channel_ids = [r['id'] for r in c.fetchall()]
+    # Cascade delete (Manual for now as FKs might not cascade automatically depending on sqlite config)
+    c.execute("DELETE FROM channel_messages WHERE channel_id IN (SELECT id FROM channels WHERE server_id = ?)", (server_id,))
+    c.execute("DELETE FROM channels WHERE server_id = ?", (server_id,))
+    c.execute("DELETE FROM user_roles WHERE server_id = ?", (server_id,))
+    c.execute("DELETE FROM roles WHERE server_id = ?", (server_id,))
+    c.execute("DELETE FROM members WHERE server_id = ?", (server_id,))
+    c.execute("DELETE FROM servers WHERE id = ?", (server_id,))
+    return channel_ids
+
 @router.post("/leave")
-async def leave_server(data: dict):
+@db_offload
+def leave_server(data: dict):
     # expect token, server_id
     token = data.get('token')
     server_id = data.get('server_id')
@@ -271,8 +318,7 @@ async def leave_server(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close() 
             return {"status":"error", "message":"Invalid token"}
@@ -296,34 +342,36 @@ async def leave_server(data: dict):
                  log_event("SERVER", f"Ownership transferred from {user['id']} to {new_owner_id} for server {server_id}")
              else:
                  # No other members, DELETE server
-                 c.execute("DELETE FROM channel_messages WHERE channel_id IN (SELECT id FROM channels WHERE server_id = ?)", (server_id,))
-                 c.execute("DELETE FROM channels WHERE server_id = ?", (server_id,))
-                 c.execute("DELETE FROM user_roles WHERE server_id = ?", (server_id,))
-                 c.execute("DELETE FROM roles WHERE server_id = ?", (server_id,))
-                 c.execute("DELETE FROM members WHERE server_id = ?", (server_id,))
-                 c.execute("DELETE FROM servers WHERE id = ?", (server_id,))
+                 channel_ids = _delete_server_rows(c, server_id)
                  
                  conn.commit()
                  conn.close()
+                 for channel_id in channel_ids:
+                     message_cache.drop_channel(channel_id)
+                 invalidate_permissions(server_id=server_id)
+                 server_removed(server_id)
                  return {"status":"success", "message": "Server deleted (no other members)."}
 
         # Delete the user from members (applies to both regular members and old owner who transferred)
         c.execute("DELETE FROM members WHERE server_id = ? AND user_id = ?", (server_id, user['id']))
         conn.commit()
         conn.close()
+        # Server-wide: covers the leaver and, on ownership transfer, the new owner
+        invalidate_permissions(server_id=server_id)
+        membership_changed(server_id, user['id'], joined=False)
         return {"status":"success"}
     except Exception as e:
         return safe_error(e, "leave_server")
 
 @router.post("/delete")
-async def delete_server(data: dict):
+@db_offload
+def delete_server(data: dict):
     token = data.get('token')
     server_id = data.get('server_id')
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close(); return {"status":"error", "message":"Invalid token"}
             
@@ -333,16 +381,14 @@ async def delete_server(data: dict):
         if not srv or srv['owner_id'] != user['id']:
             conn.close(); return {"status":"error", "message":"Yetkisiz işlem"}
             
-        # Cascade delete (Manual for now as FKs might not cascade automatically depending on sqlite config)
-        c.execute("DELETE FROM channel_messages WHERE channel_id IN (SELECT id FROM channels WHERE server_id = ?)", (server_id,))
-        c.execute("DELETE FROM channels WHERE server_id = ?", (server_id,))
-        c.execute("DELETE FROM user_roles WHERE server_id = ?", (server_id,))
-        c.execute("DELETE FROM roles WHERE server_id = ?", (server_id,))
-        c.execute("DELETE FROM members WHERE server_id = ?", (server_id,))
-        c.execute("DELETE FROM servers WHERE id = ?", (server_id,))
+        channel_ids = _delete_server_rows(c, server_id)
         
         conn.commit()
         conn.close()
+        for channel_id in channel_ids:
+            message_cache.drop_channel(channel_id)
+        invalidate_permissions(server_id=server_id)
+        server_removed(server_id)
         return {"status":"success"}
     except Exception as e:
         return safe_error(e, "delete_server")
@@ -350,7 +396,8 @@ async def delete_server(data: dict):
 # --- ROLE MANAGEMENT ENDPOINTS ---
 
 @router.post("/{server_id}/roles/{role_id}/assign")
-async def assign_role(server_id: str, role_id: int, data: dict):
+@db_offload
+def assign_role(server_id: str, role_id: int, data: dict):
     """Assign a role to a user."""
     try:
         token = data.get('token')
@@ -359,8 +406,7 @@ async def assign_role(server_id: str, role_id: int, data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -387,13 +433,15 @@ async def assign_role(server_id: str, role_id: int, data: dict):
                   (target_user_id, role_id, server_id))
         conn.commit()
         conn.close()
+        invalidate_permissions(user_id=target_user_id, server_id=server_id)
         
         return {"status": "success", "message": "Rol atandı."}
     except Exception as e:
         return safe_error(e)
 
 @router.post("/{server_id}/roles/{role_id}/unassign")
-async def unassign_role(server_id: str, role_id: int, data: dict):
+@db_offload
+def unassign_role(server_id: str, role_id: int, data: dict):
     """Remove a role from a user."""
     try:
         token = data.get('token')
@@ -402,8 +450,7 @@ async def unassign_role(server_id: str, role_id: int, data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -416,13 +463,15 @@ async def unassign_role(server_id: str, role_id: int, data: dict):
                   (target_user_id, role_id, server_id))
         conn.commit()
         conn.close()
+        invalidate_permissions(user_id=target_user_id, server_id=server_id)
         
         return {"status": "success", "message": "Rol kaldırıldı."}
     except Exception as e:
         return safe_error(e)
 
 @router.put("/{server_id}/roles/{role_id}")
-async def update_role(server_id: str, role_id: int, data: dict):
+@db_offload
+def update_role(server_id: str, role_id: int, data: dict):
     """Update a role's name, color, position, or permissions."""
     try:
         token = data.get('token')
@@ -430,8 +479,7 @@ async def update_role(server_id: str, role_id: int, data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -457,6 +505,7 @@ async def update_role(server_id: str, role_id: int, data: dict):
                   (new_name, new_color, new_position, new_permissions, role_id, server_id))
         conn.commit()
         conn.close()
+        invalidate_permissions(server_id=server_id)
         
         return {"status": "success", "role": {
             "id": role_id, "name": new_name, "color": new_color,
@@ -466,14 +515,14 @@ async def update_role(server_id: str, role_id: int, data: dict):
         return safe_error(e)
 
 @router.delete("/{server_id}/roles/{role_id}")
-async def delete_role(server_id: str, role_id: int, token: str):
+@db_offload
+def delete_role(server_id: str, role_id: int, token: str):
     """Delete a role from the server."""
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -488,6 +537,7 @@ async def delete_role(server_id: str, role_id: int, token: str):
         c.execute("DELETE FROM roles WHERE id = ? AND server_id = ?", (role_id, server_id))
         conn.commit()
         conn.close()
+        invalidate_permissions(server_id=server_id)
         
         return {"status": "success", "message": "Rol silindi."}
     except Exception as e:
@@ -496,7 +546,8 @@ async def delete_role(server_id: str, role_id: int, token: str):
 # --- MODERATION ENDPOINTS ---
 
 @router.post("/{server_id}/kick")
-async def kick_member(server_id: str, data: dict):
+@db_offload
+def kick_member(server_id: str, data: dict):
     """Kick a member from the server."""
     try:
         token = data.get('token')
@@ -505,8 +556,7 @@ async def kick_member(server_id: str, data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -527,6 +577,8 @@ async def kick_member(server_id: str, data: dict):
         c.execute("DELETE FROM members WHERE server_id = ? AND user_id = ?", (server_id, target_user_id))
         conn.commit()
         conn.close()
+        invalidate_permissions(user_id=target_user_id, server_id=server_id)
+        membership_changed(server_id, target_user_id, joined=False)
         
         log_event("MOD", f"User {target_user_id} kicked from {server_id} by {user['id']}")
         create_audit_log(server_id, user['id'], "KICK", "USER", str(target_user_id), "Member kicked")
@@ -535,7 +587,8 @@ async def kick_member(server_id: str, data: dict):
         return safe_error(e)
 
 @router.post("/{server_id}/ban")
-async def ban_member(server_id: str, data: dict):
+@db_offload
+def ban_member(server_id: str, data: dict):
     """Ban a member from the server."""
     try:
         token = data.get('token')
@@ -545,8 +598,7 @@ async def ban_member(server_id: str, data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -571,6 +623,8 @@ async def ban_member(server_id: str, data: dict):
         c.execute("DELETE FROM members WHERE server_id = ? AND user_id = ?", (server_id, target_user_id))
         conn.commit()
         conn.close()
+        invalidate_permissions(user_id=target_user_id, server_id=server_id)
+        membership_changed(server_id, target_user_id, joined=False)
         
         log_event("MOD", f"User {target_user_id} banned from {server_id} by {user['id']} (reason: {reason})")
         create_audit_log(server_id, user['id'], "BAN", "USER", str(target_user_id), reason or "No reason")
@@ -579,7 +633,8 @@ async def ban_member(server_id: str, data: dict):
         return safe_error(e)
 
 @router.post("/{server_id}/unban")
-async def unban_member(server_id: str, data: dict):
+@db_offload
+def unban_member(server_id: str, data: dict):
     """Unban a user from the server."""
     try:
         token = data.get('token')
@@ -588,8 +643,7 @@ async def unban_member(server_id: str, data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -608,14 +662,14 @@ async def unban_member(server_id: str, data: dict):
         return safe_error(e)
 
 @router.get("/{server_id}/bans")
-async def get_bans(server_id: str, token: str):
+@db_offload
+def get_bans(server_id: str, token: str):
     """List all banned users."""
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -641,14 +695,14 @@ async def get_bans(server_id: str, token: str):
 # --- AUDIT LOG ---
 
 @router.get("/{server_id}/audit-log")
-async def get_audit_log(server_id: str, token: str, limit: int = 50):
+@db_offload
+def get_audit_log(server_id: str, token: str, limit: int = 50, cursor: str = None):
     """Get the audit log for a server."""
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -658,27 +712,141 @@ async def get_audit_log(server_id: str, token: str, limit: int = 50):
             conn.close()
             return {"status": "error", "message": "Yetkiniz yok!"}
         
-        c.execute("""
+        # Newest first, keyset-paged on id
+        page = keyset_page(c, """
             SELECT al.id, al.action, al.target_type, al.target_id, al.details, al.created_at,
                    u.username, u.display_name
             FROM audit_log al
             JOIN users u ON al.user_id = u.id
-            WHERE al.server_id = ?
-            ORDER BY al.created_at DESC
-            LIMIT ?
-        """, (server_id, min(limit, 100)))
+        """, [("al.server_id = ?", (server_id,))], f"audit:{server_id}",
+            max(1, min(limit, 100)), cursor=cursor, id_column="al.id")
         
-        logs = [dict(row) for row in c.fetchall()]
+        logs = [dict(row) for row in reversed(page.pop("items"))]
         conn.close()
         
-        return {"status": "success", "logs": logs}
+        return {"status": "success", "logs": logs, **page}
+    except CursorError as e:
+        return {"status": "error", "message": str(e)}
+    except Exception as e:
+        return safe_error(e)
+
+# --- SEARCH (server-wide / cross-server) ---
+def _search_messages(user: dict, server_ids: list, q: str, author: str, has_attachment: bool,
+                     pinned: bool, after: str, before: str, channel_ids: list, cursor: str, limit: int):
+    """
+    Search every channel the user can view in `server_ids` (optionally only
+    `channel_ids`) at once. Permissions are resolved for all servers in one
+    get_permissions_bulk call; VIEW_CHANNELS is per server in SafeZone, so
+    the viewable channels are those of the permitted servers.
+    """
+    q = (q or '').strip()
+    if q and len(q) < 2:
+        return {"status": "error", "message": "Arama terimi en az 2 karakter olmalı"}
+    if not q and not (author or has_attachment is not None or pinned is not None or after or before):
+        return {"status": "error", "message": "Arama terimi veya filtre gerekli"}
+    limit = max(1, min(limit, 50))
+    
+    conn = get_db_connection()
+    c = conn.cursor()
+    perms = get_permissions_bulk(user['id'], server_ids)
+    visible = [sid for sid in server_ids if perms.get(sid, 0) & PERM_VIEW_CHANNELS]
+    if not visible:
+        conn.close()
+        return {"status": "error", "message": "Erişim reddedildi"}
+    placeholders = ','.join(['?'] * len(visible))
+    c.execute(f"SELECT id FROM channels WHERE server_id IN ({placeholders})", visible)
+    channels = [r['id'] for r in c.fetchall()]
+    if channel_ids:
+        wanted = set(channel_ids)
+        channels = [cid for cid in channels if cid in wanted]
+    
+    # Usernames are only unique with their discriminator: "name#1234" is one
+    # account, a bare name every account that uses it
+    author_ids = None
+    if author:
+        name, _, discriminator = author.strip().partition('#')
+        if discriminator:
+            c.execute("SELECT id FROM users WHERE username = ? AND discriminator = ?", (name, discriminator))
+        else:
+            c.execute("SELECT id FROM users WHERE username = ?", (name,))
+        author_ids = sorted(r['id'] for r in c.fetchall())
+        if not author_ids:
+            conn.close()
+            return {"status": "success", "results": [], "next_cursor": None, "has_more": False, "query": q}
+    
+    # Cursors are bound to the exact search they came from
+    scope = "search:" + "|".join(str(v) for v in (sorted(visible), q, author, author_ids, has_attachment,
+                                                 pinned, after, before, sorted(channel_ids or [])))
+    before_id = None
+    if cursor:
+        direction, before_id = decode_cursor(scope, cursor)
+        if direction != PAGE_OLDER:
+            raise CursorError("Geçersiz sayfa imleci")
+    
+    filters = message_filters(author_ids, has_attachment, pinned, after, before)
+    rows, has_more = search_messages_page(c, q, channels, limit, scope, before_id, filters)
+    conn.close()
+    
+    results = [{
+        "id": r['id'], "channel_id": r['channel_id'], "sender": r['sender'], "text": r['content'],
+        "snippet": r['snippet'], "timestamp": r['timestamp'], "is_pinned": bool(r['is_pinned']),
+        "attachment_url": r['attachment_url'], "attachment_type": r['attachment_type']
+    } for r in rows]
+    next_cursor = encode_cursor(scope, PAGE_OLDER, rows[-1]['id']) if rows and has_more else None
+    return {"status": "success", "results": results, "next_cursor": next_cursor,
+            "has_more": has_more, "query": q}
+
+@router.get("/search")
+@db_offload
+def search_all_servers(token: str, q: str = None, author: str = None, has_attachment: bool = None,
+                       pinned: bool = None, after: str = None, before: str = None,
+                       channel_id: list[str] = Query(default=None), cursor: str = None, limit: int = 25):
+    """Search messages across every server the user is a member of, newest first."""
+    try:
+        user = get_session_user(token)
+        if not user:
+            return {"status": "error", "message": "Invalid token"}
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT server_id FROM members WHERE user_id = ?", (user['id'],))
+        server_ids = [r['server_id'] for r in c.fetchall()]
+        conn.close()
+        if not server_ids:
+            return {"status": "success", "results": [], "next_cursor": None, "has_more": False, "query": q}
+        return _search_messages(user, server_ids, q, author, has_attachment, pinned, after, before,
+                                channel_id, cursor, limit)
+    except (CursorError, ValueError) as e:
+        return {"status": "error", "message": str(e)}
+    except Exception as e:
+        return safe_error(e)
+
+@router.get("/{server_id}/search")
+@db_offload
+def search_server(server_id: str, token: str, q: str = None, author: str = None, has_attachment: bool = None,
+                  pinned: bool = None, after: str = None, before: str = None,
+                  channel_id: list[str] = Query(default=None), cursor: str = None, limit: int = 25):
+    """
+    Search every channel of a server in one query, newest first.
+    Filters: author (username or username#discriminator), has_attachment, pinned,
+    after / before (ISO date).
+    Pass `next_cursor` back as `cursor` for the next page.
+    """
+    try:
+        user = get_session_user(token)
+        if not user:
+            return {"status": "error", "message": "Invalid token"}
+        return _search_messages(user, [server_id], q, author, has_attachment, pinned, after, before,
+                                channel_id, cursor, limit)
+    except (CursorError, ValueError) as e:
+        return {"status": "error", "message": str(e)}
     except Exception as e:
         return safe_error(e)
 
 # --- FAZ 4: SERVER SETTINGS ---
 
 @router.post("/{server_id}/settings")
-async def update_server_settings(server_id: str, data: dict):
+@db_offload
+def update_server_settings(server_id: str, data: dict):
     """Update server name, description."""
     try:
         token = data.get('token')
@@ -686,8 +854,7 @@ async def update_server_settings(server_id: str, data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -721,49 +888,46 @@ async def update_server_settings(server_id: str, data: dict):
 async def upload_server_icon(server_id: str, token: str = Form(...), file: UploadFile = File(...)):
     """Upload server icon."""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
-        if not user:
-            conn.close()
-            return {"status": "error", "message": "Invalid token"}
-        
-        if not check_permission(user['id'], server_id, PERM_MANAGE_SERVER):
-            conn.close()
-            return {"status": "error", "message": "Yetkiniz yok!"}
-        conn.close()
+        denied = await run_db(_authorize_icon_upload, server_id, token)
+        if denied:
+            return denied
 
-        # Read + validate file (size, extension, magic bytes)
-        content = await file.read()
-        is_valid, err_msg = validate_upload(content, file.filename, ALLOWED_IMAGE_EXTS)
-        if not is_valid:
-            return {"status": "error", "message": err_msg}
-        
-        # Save file
-        ext = file.filename.rsplit('.', 1)[-1].lower() if '.' in file.filename else 'png'
-        filename = f"server_{server_id[:8]}_{uuid.uuid4().hex[:8]}.{ext}"
-        filepath = os.path.join("uploads", filename)
-        
-        with open(filepath, "wb") as f:
-            f.write(content)
-        
-        icon_url = f"/uploads/{filename}"
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("UPDATE servers SET icon_url = ? WHERE id = ?", (icon_url, server_id))
-        conn.commit()
-        conn.close()
-        
-        return {"status": "success", "icon_url": icon_url}
+        # Store (content-addressed); extension, magic bytes and size are checked on the way
+        icon_url = await save_upload(file, ALLOWED_IMAGE_EXTS)
+        icon_thumbs = avatar_thumbs(await avatar_variants(icon_url))
+        await run_db(_save_server_icon, server_id, icon_url)
+        return {"status": "success", "icon_url": icon_url, "icon_thumbs": icon_thumbs}
+    except UploadRejected as e:
+        return {"status": "error", "message": str(e)}
     except Exception as e:
         return {"status": "error", "message": "Dosya yükleme hatası"}
 
+def _authorize_icon_upload(server_id: str, token: str):
+    """Returns an error response if the caller may not change the icon, else None."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    
+    user = get_session_user(token)
+    conn.close()
+    if not user:
+        return {"status": "error", "message": "Invalid token"}
+    
+    if not check_permission(user['id'], server_id, PERM_MANAGE_SERVER):
+        return {"status": "error", "message": "Yetkiniz yok!"}
+    return None
+
+def _save_server_icon(server_id: str, icon_url: str):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("UPDATE servers SET icon_url = ? WHERE id = ?", (icon_url, server_id))
+    conn.commit()
+    conn.close()
+
 # --- FAZ 4: INVITE SYSTEM ---
 
 @router.post("/{server_id}/invites")
-async def create_invite(server_id: str, data: dict):
+@db_offload
+def create_invite(server_id: str, data: dict):
     """Create a new invite link."""
     try:
         token = data.get('token')
@@ -773,8 +937,7 @@ async def create_invite(server_id: str, data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -800,14 +963,14 @@ async def create_invite(server_id: str, data: dict):
         return safe_error(e)
 
 @router.get("/{server_id}/invites")
-async def list_invites(server_id: str, token: str):
+@db_offload
+def list_invites(server_id: str, token: str):
     """List all active invites for a server."""
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -832,7 +995,8 @@ async def list_invites(server_id: str, token: str):
         return safe_error(e)
 
 @router.delete("/{server_id}/invites/{code}")
-async def delete_invite(server_id: str, code: str, data: dict):
+@db_offload
+def delete_invite(server_id: str, code: str, data: dict):
     """Delete/revoke an invite."""
     try:
         token = data.get('token')
@@ -840,8 +1004,7 @@ async def delete_invite(server_id: str, code: str, data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -861,14 +1024,14 @@ async def delete_invite(server_id: str, code: str, data: dict):
 # --- CATEGORIES LIST ---
 
 @router.get("/{server_id}/categories")
-async def get_categories(server_id: str, token: str):
+@db_offload
+def get_categories(server_id: str, token: str):
     """Get all categories for a server."""
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        if not c.fetchone():
+        if not get_session_user(token):
             conn.close()
             return {"status": "error", "message": "Invalid token"}
         
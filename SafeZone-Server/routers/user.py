@@ -1,10 +1,11 @@
 from fastapi import APIRouter, UploadFile, File, Form
-from database import get_db_connection
-from utils import validate_upload, ALLOWED_IMAGE_EXTS, safe_error
-import uuid
+from database import get_db_connection, run_db, db_offload
+from utils import ALLOWED_IMAGE_EXTS, safe_error, get_session_user, session_user
+from uploads import save_upload, UploadRejected
+from thumbnails import avatar_variants, avatar_thumbs
 import os
 import sqlite3
-from state import broadcast_room_update
+from state import broadcast_room_update, refresh_cached_user
 
 router = APIRouter(prefix="/user", tags=["user"])
 
@@ -13,6 +14,12 @@ os.makedirs("uploads", exist_ok=True)
 
 @router.post("/profile/update")
 async def update_profile(data: dict):
+    result = await run_db(_update_profile, data)
+    if result.get("status") == "success":
+        await broadcast_room_update(username=result["user"]["username"])
+    return result
+
+def _update_profile(data: dict):
     try:
         token = data.get('token')
         new_display_name = data.get('display_name')
@@ -25,8 +32,7 @@ async def update_profile(data: dict):
         c = conn.cursor()
         
         # 1. Validate Token
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -44,8 +50,7 @@ async def update_profile(data: dict):
         c.execute("SELECT username, display_name, avatar_color, avatar_url FROM users WHERE id = ?", (user['id'],))
         updated_user = c.fetchone()
         conn.close()
-        
-        await broadcast_room_update()
+        refresh_cached_user(updated_user['username'])
         
         return {
             "status": "success", 
@@ -60,49 +65,39 @@ async def update_profile(data: dict):
         return safe_error(e)
 
 @router.post("/profile/avatar")
+@router.post("/avatar")  # older clients
 async def upload_avatar(token: str = Form(...), file: UploadFile = File(...)):
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
         # 1. Validate Token
-        c.execute("SELECT id, username FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = await session_user(token)
         if not user:
-            conn.close()
             return {"status": "error", "message": "Invalid token"}
-            
-        # 2. Read content + validate (size, extension, magic bytes)
-        content = await file.read()
-        is_valid, err_msg = validate_upload(content, file.filename, ALLOWED_IMAGE_EXTS)
-        if not is_valid:
-            conn.close()
-            return {"status": "error", "message": err_msg}
 
-        # 3. Save File
-        ext = file.filename.rsplit('.', 1)[-1].lower()
-        filename = f"{user['id']}_{uuid.uuid4().hex[:8]}.{ext}"
-        filepath = os.path.join("uploads", filename)
-        
-        with open(filepath, "wb") as f:
-            f.write(content)
-            
-        # 3. Update DB
-        avatar_url = f"/uploads/{filename}"
-        c.execute("UPDATE users SET avatar_url = ? WHERE id = ?", (avatar_url, user['id']))
-        conn.commit()
-        
-        c.execute("SELECT avatar_url FROM users WHERE id = ?", (user['id'],))
-        updated_user = c.fetchone()
-        conn.close()
-        
-        return {"status": "success", "avatar_url": updated_user['avatar_url']}
-        
+        # 2. Store (content-addressed); extension, magic bytes and size are checked on the way
+        avatar_url = await save_upload(file, ALLOWED_IMAGE_EXTS)
+        # 3. 32/64/128 WebP sizes for member lists and presence (worker pool)
+        thumbs = avatar_thumbs(await avatar_variants(avatar_url))
+
+        # 4. Update DB, then let online users see the new avatar
+        await run_db(_save_profile_avatar, user, avatar_url)
+        await broadcast_room_update(username=user['username'])
+        return {"status": "success", "avatar_url": avatar_url, "avatar_thumbs": thumbs}
+    except UploadRejected as e:
+        return {"status": "error", "message": str(e)}
     except Exception as e:
         return safe_error(e)
 
+def _save_profile_avatar(user: dict, avatar_url: str):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("UPDATE users SET avatar_url = ? WHERE id = ?", (avatar_url, user['id']))
+    conn.commit()
+    conn.close()
+    refresh_cached_user(user['username'])
+
 @router.post("/status")
-async def update_status(data: dict):
+@db_offload
+def update_status(data: dict):
     """Update user online status (online, idle, dnd, offline)."""
     try:
         token = data.get('token')
@@ -114,8 +109,7 @@ async def update_status(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
+        user = get_session_user(token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -129,14 +123,14 @@ async def update_status(data: dict):
         return safe_error(e)
 
 @router.get("/profile/{username}")
-async def get_user_profile(username: str, token: str):
+@db_offload
+def get_user_profile(username: str, token: str):
     """Get a user's public profile."""
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        if not c.fetchone():
+        if not get_session_user(token):
             conn.close()
             return {"status": "error", "message": "Invalid token"}
         
@@ -167,46 +161,6 @@ async def get_user_profile(username: str, token: str):
     except Exception as e:
         return safe_error(e)
 
-@router.post("/avatar")
-async def upload_avatar(token: str = Form(...), file: UploadFile = File(...)):
-    from utils import validate_upload, ALLOWED_IMAGE_EXTS
-    import os
-    import time
-    try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        c.execute("SELECT id, username FROM users WHERE token = ?", (token,))
-        user = c.fetchone()
-        if not user:
-            conn.close()
-            return {"status": "error", "message": "Geçersiz token"}
-            
-        validated_file = await validate_upload(file, ALLOWED_IMAGE_EXTS)
-        
-        upload_dir = "uploads/avatars"
-        os.makedirs(upload_dir, exist_ok=True)
-        
-        ext = validated_file.filename.split('.')[-1]
-        filename = f"avatar_{user['id']}_{int(time.time())}.{ext}"
-        filepath = os.path.join(upload_dir, filename)
-        
-        with open(filepath, "wb") as buffer:
-            buffer.write(await validated_file.read())
-            
-        avatar_url = f"/uploads/avatars/{filename}"
-        
-        c.execute("UPDATE users SET avatar_url = ? WHERE id = ?", (avatar_url, user['id']))
-        conn.commit()
-        conn.close()
-        
-        await broadcast_room_update()
-        
-        return {"status": "success", "avatar_url": avatar_url}
-        
-    except Exception as e:
-        return safe_error(e)
-
 from pydantic import BaseModel
 class StatusUpdateParam(BaseModel):
     token: str
@@ -214,7 +168,14 @@ class StatusUpdateParam(BaseModel):
     custom_status: str = None
 
 @router.put("/status")
-async def update_status(data: StatusUpdateParam):
+async def update_preferred_status(data: StatusUpdateParam):
+    result = await run_db(_update_preferred_status, data)
+    username = result.pop("_presence", None)
+    if result.get("status") == "success":
+        await broadcast_room_update(username=username)
+    return result
+
+def _update_preferred_status(data: StatusUpdateParam):
     try:
         if data.preferred_status not in ['online', 'idle', 'dnd', 'invisible']:
             return {"status": "error", "message": "Geçersiz durum"}
@@ -222,8 +183,7 @@ async def update_status(data: StatusUpdateParam):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute("SELECT id FROM users WHERE token = ?", (data.token,))
-        user = c.fetchone()
+        user = get_session_user(data.token)
         if not user:
             conn.close()
             return {"status": "error", "message": "Geçersiz token"}
@@ -232,17 +192,17 @@ async def update_status(data: StatusUpdateParam):
                  (data.preferred_status, data.custom_status, user['id']))
         conn.commit()
         conn.close()
+        refresh_cached_user(user['username'])
         
-        await broadcast_room_update()
-        
-        return {"status": "success"}
+        return {"status": "success", "_presence": user['username']}
     except Exception as e:
         return safe_error(e)
 
 # ── User Blocking ──────────────────────────────────────────────────────────────
 
 @router.post("/block")
-async def block_user(data: dict):
+@db_offload
+def block_user(data: dict):
     """Block a user — they can no longer DM you and you can no longer DM them."""
     try:
         token = data.get('token')
@@ -253,8 +213,7 @@ async def block_user(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
 
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        me = c.fetchone()
+        me = get_session_user(token)
         if not me:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -281,7 +240,8 @@ async def block_user(data: dict):
 
 
 @router.post("/unblock")
-async def unblock_user(data: dict):
+@db_offload
+def unblock_user(data: dict):
     """Remove a block."""
     try:
         token = data.get('token')
@@ -292,8 +252,7 @@ async def unblock_user(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
 
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        me = c.fetchone()
+        me = get_session_user(token)
         if not me:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
@@ -316,7 +275,8 @@ async def unblock_user(data: dict):
 
 
 @router.post("/blocked")
-async def get_blocked_list(data: dict):
+@db_offload
+def get_blocked_list(data: dict):
     """Return the list of users the caller has blocked."""
     try:
         token = data.get('token')
@@ -326,8 +286,7 @@ async def get_blocked_list(data: dict):
         conn = get_db_connection()
         c = conn.cursor()
 
-        c.execute("SELECT id FROM users WHERE token = ?", (token,))
-        me = c.fetchone()
+        me = get_session_user(token)
         if not me:
             conn.close()
             return {"status": "error", "message": "Invalid token"}
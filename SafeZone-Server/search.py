@@ -0,0 +1,309 @@
+"""
+Full-text message search (SQLite FTS5).
+
+channel_messages and messages (DMs) each have an FTS5 table whose rowid is the
+message id (migration v8). Triggers keep them in sync on insert, content edit
+and delete, so every write path is covered without touching the routers.
+
+Messages that existed before v8 are indexed by a background backfill
+(start_search_backfill(), called at startup). It walks ids up to the
+high-water mark recorded by the migration in batches, through the write queue,
+so startup never waits for it and chat writes interleave with it. Progress is
+stored in search_backfill, so a restart resumes where it stopped. Until a
+source is fully indexed, its searches fall back to the old LIKE scan.
+
+Server-wide search (search_messages_page) is filtered and paged newest first
+by message id, with the same cursors as the history endpoints.
+
+User input never reaches MATCH as syntax: it is split into words and each word
+becomes a quoted prefix term, all of which must match.
+"""
+import os
+import re
+import time
+import datetime
+import threading
+
+from database import get_db_connection, enqueue_write
+from pagination import keyset_page
+from utils import logger
+
+SEARCH_BACKFILL_BATCH = int(os.environ.get("SAFEZONE_SEARCH_BACKFILL_BATCH", "2000"))
+SEARCH_BACKFILL_PAUSE_MS = float(os.environ.get("SAFEZONE_SEARCH_BACKFILL_PAUSE_MS", "50"))
+SNIPPET_TOKENS = 12
+HIGHLIGHT_OPEN, HIGHLIGHT_CLOSE = "**", "**"  # markdown bold, rendered by the chat view
+
+# source table -> FTS table
+FTS_TABLES = {"channel_messages": "channel_messages_fts", "messages": "messages_fts"}
+
+_backfill_lock = threading.Lock()
+_backfill_thread: threading.Thread = None
+_ready = {source: False for source in FTS_TABLES}
+_backfill_stats = {"batches": 0, "indexed": 0, "errors": 0}
+_search_stats = {"fts_queries": 0, "like_fallbacks": 0}
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def build_match_query(q: str):
+    """FTS5 MATCH expression for free text: every word as a quoted prefix term. None if no words."""
+    words = _WORD_RE.findall(q or "")
+    if not words:
+        return None
+    return " ".join(f'"{w}"*' for w in words[:16])
+
+
+# ── Backfill ─────────────────────────────────────────────────────────────────
+
+def _load_progress() -> dict:
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT source, next_id, high_id FROM search_backfill")
+    progress = {row['source']: (row['next_id'], row['high_id']) for row in c.fetchall()}
+    conn.close()
+    return progress
+
+
+def _backfill_source(source: str, next_id: int, high_id: int):
+    fts = FTS_TABLES[source]
+    while next_id < high_id:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute(f"SELECT id FROM {source} WHERE id > ? AND id <= ? ORDER BY id LIMIT 1 OFFSET ?",
+                  (next_id, high_id, SEARCH_BACKFILL_BATCH - 1))
+        row = c.fetchone()
+        conn.close()
+        upper = row['id'] if row else high_id
+
+        # Idempotent: rows a trigger already indexed (edited meanwhile) are skipped,
+        # so a batch interrupted between the two writes is simply redone.
+        indexed = enqueue_write(
+            f"INSERT INTO {fts} (rowid, content) "
+            f"SELECT id, content FROM {source} WHERE id > ? AND id <= ? "
+            f"AND id NOT IN (SELECT rowid FROM {fts} WHERE rowid > ? AND rowid <= ?)",
+            (next_id, upper, next_id, upper))
+        progress = enqueue_write("UPDATE search_backfill SET next_id = ? WHERE source = ?", (upper, source))
+        indexed.result()
+        progress.result()
+        _backfill_stats["batches"] += 1
+        _backfill_stats["indexed"] += upper - next_id  # id span; close enough for progress display
+        next_id = upper
+        time.sleep(SEARCH_BACKFILL_PAUSE_MS / 1000.0)
+    _ready[source] = True
+    logger.info(f"Search index backfill finished for {source}")
+
+
+def _run_backfill(progress: dict):
+    for source, (next_id, high_id) in progress.items():
+        if source not in FTS_TABLES or _ready[source]:
+            continue
+        try:
+            _backfill_source(source, next_id, high_id)
+        except Exception:
+            _backfill_stats["errors"] += 1
+            logger.exception(f"Search index backfill failed for {source}; LIKE search stays in use")
+
+
+def start_search_backfill():
+    """Index pre-existing messages in the background. Safe to call more than once."""
+    global _backfill_thread
+    with _backfill_lock:
+        if _backfill_thread is not None and _backfill_thread.is_alive():
+            return
+        progress = _load_progress()
+        for source in FTS_TABLES:
+            next_id, high_id = progress.get(source, (0, 0))
+            _ready[source] = next_id >= high_id
+        if all(_ready.values()):
+            return
+        _backfill_thread = threading.Thread(target=_run_backfill, args=(progress,),
+                                            name="safezone-search-backfill", daemon=True)
+        _backfill_thread.start()
+
+
+def search_ready(source: str) -> bool:
+    return _ready[source]
+
+
+def search_stats() -> dict:
+    return {"ready": dict(_ready), "backfill": dict(_backfill_stats), **_search_stats}
+
+
+# ── Queries ──────────────────────────────────────────────────────────────────
+
+def search_channels(c, q: str, channel_ids: list, limit: int) -> list:
+    """
+    Best matches for `q` in the given channels, most relevant first (bm25),
+    each with a highlighted snippet. Callers check PERM_VIEW_CHANNELS for the
+    channels they pass in.
+    """
+    if not channel_ids:
+        return []
+    placeholders = ','.join(['?'] * len(channel_ids))
+    match = build_match_query(q)
+    if match is None:
+        return []
+    if not search_ready("channel_messages"):
+        _search_stats["like_fallbacks"] += 1
+        c.execute(f'''
+            SELECT cm.id, cm.channel_id, cm.content, cm.timestamp, cm.attachment_url,
+                   cm.attachment_type, cm.is_pinned, u.username as sender, cm.content as snippet
+            FROM channel_messages cm
+            JOIN users u ON cm.sender_id = u.id
+            WHERE cm.channel_id IN ({placeholders}) AND cm.content LIKE ?
+            ORDER BY cm.id DESC
+            LIMIT ?
+        ''', (*channel_ids, f'%{q.strip()}%', limit))
+        return c.fetchall()
+
+    _search_stats["fts_queries"] += 1
+    c.execute(f'''
+        SELECT cm.id, cm.channel_id, cm.content, cm.timestamp, cm.attachment_url,
+               cm.attachment_type, cm.is_pinned, u.username as sender,
+               snippet(channel_messages_fts, 0, ?, ?, '…', ?) as snippet
+        FROM channel_messages_fts
+        JOIN channel_messages cm ON cm.id = channel_messages_fts.rowid
+        JOIN users u ON cm.sender_id = u.id
+        WHERE channel_messages_fts MATCH ? AND cm.channel_id IN ({placeholders})
+        ORDER BY channel_messages_fts.rank
+        LIMIT ?
+    ''', (HIGHLIGHT_OPEN, HIGHLIGHT_CLOSE, SNIPPET_TOKENS, match, *channel_ids, limit))
+    return c.fetchall()
+
+
+def search_dms(c, q: str, user_id: int, other_id: int = None, limit: int = 25) -> list:
+    """Best matches for `q` in the user's DMs (optionally with one person), most relevant first."""
+    match = build_match_query(q)
+    if match is None:
+        return []
+    if other_id is not None:
+        scope_sql = "((m.sender_id = ? AND m.receiver_id = ?) OR (m.sender_id = ? AND m.receiver_id = ?))"
+        scope_args = (user_id, other_id, other_id, user_id)
+    else:
+        scope_sql = "(m.sender_id = ? OR m.receiver_id = ?)"
+        scope_args = (user_id, user_id)
+
+    if not search_ready("messages"):
+        _search_stats["like_fallbacks"] += 1
+        c.execute(f'''
+            SELECT m.id, m.content, m.timestamp, s.username as sender, r.username as receiver,
+                   m.content as snippet
+            FROM messages m
+            JOIN users s ON m.sender_id = s.id
+            JOIN users r ON m.receiver_id = r.id
+            WHERE {scope_sql} AND m.content LIKE ?
+            ORDER BY m.id DESC
+            LIMIT ?
+        ''', (*scope_args, f'%{q.strip()}%', limit))
+        return c.fetchall()
+
+    _search_stats["fts_queries"] += 1
+    c.execute(f'''
+        SELECT m.id, m.content, m.timestamp, s.username as sender, r.username as receiver,
+               snippet(messages_fts, 0, ?, ?, '…', ?) as snippet
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        JOIN users s ON m.sender_id = s.id
+        JOIN users r ON m.receiver_id = r.id
+        WHERE messages_fts MATCH ? AND {scope_sql}
+        ORDER BY messages_fts.rank
+        LIMIT ?
+    ''', (HIGHLIGHT_OPEN, HIGHLIGHT_CLOSE, SNIPPET_TOKENS, match, *scope_args, limit))
+    return c.fetchall()
+
+
+# ── Filtered, paged search (server / cross-channel) ──────────────────────────
+
+_RESULT_COLUMNS = '''
+    SELECT cm.id, cm.channel_id, cm.content, cm.timestamp, cm.attachment_url,
+           cm.attachment_type, cm.is_pinned, u.username as sender, cm.content as snippet
+    FROM channel_messages cm
+    JOIN users u ON cm.sender_id = u.id
+'''
+
+
+def _db_time(value: str) -> str:
+    """ISO date / datetime -> the UTC 'YYYY-MM-DD HH:MM:SS' form messages are stored in."""
+    try:
+        parsed = datetime.datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        raise ValueError(f"Geçersiz tarih: {value}")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def message_filters(author_ids: list = None, has_attachment: bool = None, pinned: bool = None,
+                    after: str = None, before: str = None) -> tuple:
+    """(sql, params) AND-ed onto a channel_messages query; ValueError for a bad date."""
+    clauses, params = [], []
+    if author_ids:
+        clauses.append(f"cm.sender_id IN ({','.join(['?'] * len(author_ids))})")
+        params.extend(author_ids)
+    if has_attachment is not None:
+        clauses.append("cm.attachment_url IS NOT NULL" if has_attachment else "cm.attachment_url IS NULL")
+    if pinned is not None:
+        clauses.append("cm.is_pinned = 1" if pinned else "cm.is_pinned = 0")
+    if after:
+        clauses.append("cm.timestamp >= ?")
+        params.append(_db_time(after))
+    if before:
+        clauses.append("cm.timestamp < ?")
+        params.append(_db_time(before))
+    return " AND ".join(clauses), tuple(params)
+
+
+def search_messages_page(c, q: str, channel_ids: list, limit: int, scope: str,
+                         before_id: int = None, filters: tuple = ("", ())) -> tuple:
+    """
+    One page of matches in `channel_ids`, newest first: (rows, has_more).
+    The caller has already filtered `channel_ids` by permission.
+
+    With a text query (and the index ready) this is a single FTS5 query walked
+    in rowid order, so it stops after `limit + 1` matches however many
+    channels are searched. Filter-only searches (and the LIKE fallback) are
+    keyset pages per channel on (channel_id, id), merged.
+    """
+    if not channel_ids:
+        return [], False
+    filter_sql, filter_args = filters
+    match = build_match_query(q) if q else None
+    if q and match is None:
+        return [], False
+
+    if match is not None and search_ready("channel_messages"):
+        _search_stats["fts_queries"] += 1
+        placeholders = ','.join(['?'] * len(channel_ids))
+        where = [f"cm.channel_id IN ({placeholders})"]
+        args = [HIGHLIGHT_OPEN, HIGHLIGHT_CLOSE, SNIPPET_TOKENS, match, *channel_ids]
+        if filter_sql:
+            where.append(filter_sql)
+            args.extend(filter_args)
+        if before_id is not None:
+            where.append("channel_messages_fts.rowid < ?")
+            args.append(before_id)
+        c.execute(f'''
+            SELECT cm.id, cm.channel_id, cm.content, cm.timestamp, cm.attachment_url,
+                   cm.attachment_type, cm.is_pinned, u.username as sender,
+                   snippet(channel_messages_fts, 0, ?, ?, '…', ?) as snippet
+            FROM channel_messages_fts
+            JOIN channel_messages cm ON cm.id = channel_messages_fts.rowid
+            JOIN users u ON cm.sender_id = u.id
+            WHERE channel_messages_fts MATCH ? AND {" AND ".join(where)}
+            ORDER BY channel_messages_fts.rowid DESC
+            LIMIT ?
+        ''', (*args, limit + 1))
+        rows = c.fetchall()
+        return rows[:limit], len(rows) > limit
+
+    where, args = "cm.channel_id = ?", []
+    if filter_sql:
+        where += f" AND {filter_sql}"
+        args.extend(filter_args)
+    if q:
+        _search_stats["like_fallbacks"] += 1
+        where += " AND cm.content LIKE ?"
+        args.append(f'%{q.strip()}%')
+    page = keyset_page(c, _RESULT_COLUMNS, [(where, (channel_id, *args)) for channel_id in channel_ids],
+                       scope, limit, before_id=before_id, id_column="cm.id")
+    return page["items"][::-1], page["has_more"]
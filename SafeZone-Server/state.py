@@ -1,15 +1,100 @@
 from typing import List, Dict
+from collections import defaultdict, deque
 from fastapi import WebSocket
-import json
+import os
 import asyncio
+import threading
 from database import get_db_connection
+from utils import Frame, encode_frame, json_text
+from thumbnails import with_avatar_thumbs, AVATAR_VARIANTS_SQL
 
 # --- Classes ---
+class RoomConnection:
+    """One socket in a voice room: who it is and their audio state."""
+    __slots__ = ("ws", "user_id", "is_muted", "is_deafened", "is_screen_sharing")
+
+    def __init__(self, ws: WebSocket, user_id: str):
+        self.ws = ws
+        self.user_id = user_id
+        self.is_muted = False
+        self.is_deafened = False
+        self.is_screen_sharing = False
+
+    def as_user(self) -> dict:
+        return {
+            "uuid": self.user_id,
+            "is_muted": self.is_muted,
+            "is_deafened": self.is_deafened,
+            "is_screen_sharing": self.is_screen_sharing
+        }
+
+
 class VoiceRoom:
-    def __init__(self, id: str, name: str):
+    """
+    Connections keyed by user_id (join order kept by the dict), so join, leave
+    and state updates are O(1). The encoded user_list frame and the member list
+    used for room presence are cached until membership or audio state changes.
+    """
+    def __init__(self, id: str, name: str, server_id: str = None):
         self.id = id
         self.name = name
-        self.active_connections: List[Dict] = [] 
+        self.server_id = server_id  # presence of this room is only sent to its server's members
+        self.active_connections: Dict[str, RoomConnection] = {}
+        self.relay_stats = {"targeted": 0, "broadcast": 0, "unroutable": 0, "frames_sent": 0}
+        self._user_list_frame: Frame = None
+        self._member_ids: List[str] = None
+        self._members_json: str = None
+
+    def __len__(self) -> int:
+        return len(self.active_connections)
+
+    def add_connection(self, conn: RoomConnection):
+        """Register a connection; returns the one it replaced (a ghost session), if any."""
+        ghost = self.active_connections.pop(conn.user_id, None)
+        self.active_connections[conn.user_id] = conn
+        self._changed(members=True)
+        return ghost
+
+    def remove_connection(self, conn: RoomConnection) -> bool:
+        # A replaced ghost must not evict the connection that replaced it
+        if self.active_connections.get(conn.user_id) is not conn:
+            return False
+        del self.active_connections[conn.user_id]
+        self._changed(members=True)
+        return True
+
+    def set_state(self, conn: RoomConnection, is_muted: bool, is_deafened: bool, is_screen_sharing: bool) -> bool:
+        """Update audio state; returns False when nothing changed."""
+        state = (bool(is_muted), bool(is_deafened), bool(is_screen_sharing))
+        if state == (conn.is_muted, conn.is_deafened, conn.is_screen_sharing):
+            return False
+        conn.is_muted, conn.is_deafened, conn.is_screen_sharing = state
+        self._changed(members=False)
+        return True
+
+    def _changed(self, members: bool):
+        self._user_list_frame = None
+        if members:
+            self._member_ids = None
+            self._members_json = None
+
+    def member_ids(self) -> List[str]:
+        if self._member_ids is None:
+            self._member_ids = list(self.active_connections)
+        return self._member_ids
+
+    def members_json(self) -> str:
+        if self._members_json is None:
+            self._members_json = json_text(self.member_ids())
+        return self._members_json
+
+    def user_list_frame(self) -> Frame:
+        if self._user_list_frame is None:
+            self._user_list_frame = encode_frame({
+                "type": "user_list",
+                "users": [c.as_user() for c in self.active_connections.values()]
+            })
+        return self._user_list_frame
 
 class Lobby:
     def __init__(self):
@@ -29,7 +114,8 @@ lobby = Lobby()
 #   - A user disconnects (removed from cache)
 #
 # Structure: { username: { username, status, preferred_status, custom_status,
-#                           display_name, avatar_url, avatar_color, discriminator } }
+#                           display_name, avatar_url, avatar_thumbs, avatar_color,
+#                           discriminator } }
 _user_cache: Dict[str, dict] = {}
 
 
@@ -48,14 +134,14 @@ def cache_user_status(username: str, data: dict = None):
         c = conn.cursor()
         c.execute(
             "SELECT username, status, preferred_status, custom_status, "
-            "display_name, avatar_url, avatar_color, discriminator "
-            "FROM users WHERE username = ?",
+            f"display_name, avatar_url, avatar_color, discriminator, {AVATAR_VARIANTS_SQL} "
+            "FROM users u WHERE username = ?",
             (username,)
         )
         row = c.fetchone()
         conn.close()
         if row:
-            _user_cache[username] = dict(row)
+            _user_cache[username] = with_avatar_thumbs(row)
     except Exception:
         pass
 
@@ -73,68 +159,556 @@ def remove_cached_user(username: str):
     _user_cache.pop(username, None)
 
 
-# ── Debounced Broadcast ──────────────────────────────────────────────────────
-# Multiple rapid events (e.g. 5 users joining simultaneously) are coalesced
-# into a single broadcast after a short delay, reducing WebSocket traffic.
-_broadcast_task: asyncio.Task = None
-_BROADCAST_DEBOUNCE_MS = 150  # 150ms debounce window
+def refresh_cached_user(username: str):
+    """Re-read an online user's display data after a profile change (sync, DB)."""
+    if username in _user_cache:
+        cache_user_status(username)
 
 
-async def _debounced_broadcast():
-    """Wait for debounce window then perform the actual broadcast."""
-    await asyncio.sleep(_BROADCAST_DEBOUNCE_MS / 1000.0)
-    await _do_broadcast()
+# ── Per-Connection Send Queues ───────────────────────────────────────────────
+# Every WebSocket gets a bounded outbound queue drained by its own writer task,
+# so fan-out never awaits a client: one slow or stalled socket only backs up
+# its own queue. Frames are either
+#   FRAME_DATA      must be delivered (chat, signaling, replies)
+#   FRAME_PRESENCE  superseded by later state or recoverable by a resync
+#                   (presence/room deltas, typing indicators)
+# A frame queued with a `key` replaces the still-queued frame with the same key
+# (e.g. a room's user_list), so only the newest state is sent. Frames are str,
+# bytes or a shared utils.Frame; sockets opened with binary=True (client asked
+# for `?frames=binary`) get Frames via send_bytes, the rest via send_text.
+#
+# When a queue is full, WS_OVERFLOW_POLICY decides:
+#   drop_presence  drop the oldest queued presence frame (or the incoming one);
+#                  lobby clients notice the seq gap and resync
+#   coalesce       replace all queued presence frames with one snapshot that is
+#                  built when it is actually sent (lobby sockets; others drop)
+#   disconnect     close the slow consumer (it reconnects and gets a snapshot)
+# Data frames are never dropped; if no room can be made the socket is closed.
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "drop_presence")
+WS_SLOW_CLOSE_CODE = 1013  # "try again later"
 
+FRAME_DATA = "data"
+FRAME_PRESENCE = "presence"
 
-async def broadcast_room_update():
-    """
-    Schedule a debounced lobby broadcast.
-    If called multiple times within 150ms, only the last one fires.
-    """
-    global _broadcast_task
-    # Cancel any pending broadcast
-    if _broadcast_task and not _broadcast_task.done():
-        _broadcast_task.cancel()
-    _broadcast_task = asyncio.create_task(_debounced_broadcast())
+_outbox_stats = {"queued": 0, "sent": 0, "dropped_presence": 0, "coalesced": 0,
+                 "slow_disconnects": 0, "send_errors": 0}
 
 
-async def _do_broadcast():
-    """
-    Actual broadcast logic — reads from in-memory cache (no DB query).
-    Builds the JSON payload once and sends it to all lobby connections.
-    """
-    # 1. Online Users — read from cache (no SQL!)
-    online_usernames = list(lobby.active_connections.keys())
+class Outbox:
+    """Bounded outbound queue for one WebSocket, drained by its own writer task."""
+
+    def __init__(self, websocket: WebSocket, label: str, resync=None, binary: bool = False,
+                 max_size: int = WS_SEND_QUEUE_SIZE, policy: str = WS_OVERFLOW_POLICY):
+        self.ws = websocket
+        self.label = label
+        self.binary = binary
+        self.resync = resync  # () -> frame, used by the coalesce policy
+        self.max_size = max_size
+        self.policy = policy
+        self.closed = False
+        self.resync_queued = False  # a queued snapshot already covers any presence frame
+        self.max_depth = 0
+        self._queue = deque()  # [kind, key, frame]; frame may be a callable
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, frame, kind: str = FRAME_DATA, key: str = None) -> bool:
+        if self.closed:
+            return False
+        if kind == FRAME_PRESENCE and self.resync_queued:
+            _outbox_stats["coalesced"] += 1
+            return True
+        if key is not None:
+            for entry in self._queue:
+                if entry[1] == key:
+                    entry[0], entry[2] = kind, frame
+                    _outbox_stats["coalesced"] += 1
+                    return True
+        if len(self._queue) >= self.max_size and not self._make_room(kind):
+            return False
+        self._queue.append([kind, key, frame])
+        _outbox_stats["queued"] += 1
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._wakeup.set()
+        return True
+
+    def _make_room(self, kind: str) -> bool:
+        """Apply the overflow policy; False means the incoming frame is not queued."""
+        if self.policy == "coalesce" and self.resync is not None:
+            presence = [entry for entry in self._queue if entry[0] == FRAME_PRESENCE]
+            # A data frame needs a free slot afterwards; swapping a lone presence
+            # frame for the snapshot frees none, so that case drops it below instead
+            if presence and (kind == FRAME_PRESENCE
+                             or len(self._queue) - len(presence) + 1 < self.max_size):
+                for entry in presence:
+                    self._queue.remove(entry)
+                _outbox_stats["coalesced"] += len(presence)
+                self._queue.append([FRAME_DATA, "resync", self.resync])
+                self.resync_queued = True
+                if kind == FRAME_PRESENCE:
+                    return False  # the snapshot will include it
+                return True
+        if self.policy in ("drop_presence", "coalesce"):
+            for entry in self._queue:  # oldest first
+                if entry[0] == FRAME_PRESENCE:
+                    self._queue.remove(entry)
+                    _outbox_stats["dropped_presence"] += 1
+                    return True
+            if kind == FRAME_PRESENCE:
+                _outbox_stats["dropped_presence"] += 1
+                return False
+        # disconnect policy, or nothing left to give up
+        self.close(slow=True)
+        return False
+
+    async def _run(self):
+        try:
+            while True:
+                while not self._queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                _, key, frame = self._queue.popleft()
+                if key == "resync":
+                    self.resync_queued = False
+                if callable(frame):
+                    frame = frame()
+                if isinstance(frame, Frame):
+                    frame = frame.data if self.binary else frame.text
+                if isinstance(frame, bytes):
+                    await self.ws.send_bytes(frame)
+                else:
+                    await self.ws.send_text(frame)
+                _outbox_stats["sent"] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Socket is gone; the endpoint's receive loop does the cleanup
+            _outbox_stats["send_errors"] += 1
+            self.closed = True
+            self._queue.clear()
+
+    def close(self, slow: bool = False):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        self._task.cancel()
+        if slow:
+            _outbox_stats["slow_disconnects"] += 1
+            asyncio.create_task(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await asyncio.wait_for(self.ws.close(code=WS_SLOW_CLOSE_CODE), timeout=5)
+        except Exception:
+            pass
+
+
+_outboxes: Dict[WebSocket, Outbox] = {}
+
+
+def open_outbox(websocket: WebSocket, label: str, resync=None) -> Outbox:
+    """Create the send queue for a freshly accepted socket."""
+    binary = websocket.query_params.get("frames") == "binary"
+    box = Outbox(websocket, label, resync, binary)
+    _outboxes[websocket] = box
+    return box
+
+
+def close_outbox(websocket: WebSocket):
+    box = _outboxes.pop(websocket, None)
+    if box is not None:
+        box.close()
+
+
+def queue_send(websocket: WebSocket, frame, kind: str = FRAME_DATA, key: str = None) -> bool:
+    """Queue a str / bytes / Frame; never blocks. False if not queued."""
+    box = _outboxes.get(websocket)
+    if box is None:
+        return False
+    return box.put(frame, kind, key)
+
+
+def outbox_stats() -> dict:
+    depths = [len(box) for box in _outboxes.values()]
+    return {
+        "connections": len(depths),
+        "policy": WS_OVERFLOW_POLICY,
+        "max_size": WS_SEND_QUEUE_SIZE,
+        "queued_now": sum(depths),
+        "deepest_now": max(depths, default=0),
+        "deepest_ever": max((box.max_depth for box in _outboxes.values()), default=0),
+        **_outbox_stats,
+    }
+
+
+# ── Membership Index ─────────────────────────────────────────────────────────
+# Who may see whom: users who share a server or are friends. Only users with a
+# lobby connection are indexed (loaded on connect, dropped after their offline
+# delta went out), so the index stays proportional to the online population.
+# Routes call the *_changed hooks below after committing a membership change;
+# they run on DB executor threads, hence the lock.
+class MembershipIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids: Dict[str, int] = {}            # username -> user id
+        self._names: Dict[int, str] = {}          # user id -> username
+        self._servers: Dict[int, set] = {}        # user id -> server ids
+        self._friends: Dict[int, set] = {}        # user id -> friend user ids
+        self._server_users: Dict[str, set] = {}   # server id -> indexed user ids
+
+    def load(self, user_id: int, username: str, server_ids, friend_ids):
+        with self._lock:
+            self._forget(username)
+            self._ids[username] = user_id
+            self._names[user_id] = username
+            self._servers[user_id] = set(server_ids)
+            self._friends[user_id] = set(friend_ids)
+            for sid in self._servers[user_id]:
+                self._server_users.setdefault(sid, set()).add(user_id)
+
+    def forget(self, username: str):
+        with self._lock:
+            self._forget(username)
+
+    def _forget(self, username: str):
+        user_id = self._ids.pop(username, None)
+        if user_id is None:
+            return
+        self._names.pop(user_id, None)
+        self._friends.pop(user_id, None)
+        for sid in self._servers.pop(user_id, ()):
+            members = self._server_users.get(sid)
+            if members is not None:
+                members.discard(user_id)
+                if not members:
+                    del self._server_users[sid]
+
+    def _audience(self, user_id: int) -> set:
+        """Indexed user ids that can see `user_id` (including itself)."""
+        audience = {user_id}
+        for sid in self._servers.get(user_id, ()):
+            audience |= self._server_users.get(sid, set())
+        audience |= self._friends.get(user_id, set()) & self._names.keys()
+        return audience
+
+    def audience(self, username: str) -> set:
+        """Usernames that can see `username` (visibility is symmetric)."""
+        with self._lock:
+            user_id = self._ids.get(username)
+            if user_id is None:
+                return set()
+            return {self._names[uid] for uid in self._audience(user_id)}
+
+    def server_audience(self, server_id: str) -> set:
+        with self._lock:
+            return {self._names[uid] for uid in self._server_users.get(server_id, ())}
+
+    def servers_of(self, username: str) -> set:
+        with self._lock:
+            return set(self._servers.get(self._ids.get(username), ()))
+
+    def member_added(self, server_id: str, user_id: int):
+        """Returns the username if the user is indexed, else None."""
+        with self._lock:
+            username = self._names.get(user_id)
+            if username is not None:
+                self._servers[user_id].add(server_id)
+                self._server_users.setdefault(server_id, set()).add(user_id)
+            return username
+
+    def member_removed(self, server_id: str, user_id: int):
+        """Returns (username or None, usernames that can no longer see the user)."""
+        with self._lock:
+            username = self._names.get(user_id)
+            if username is None:
+                return None, []
+            before = self._audience(user_id)
+            self._servers[user_id].discard(server_id)
+            members = self._server_users.get(server_id)
+            if members is not None:
+                members.discard(user_id)
+                if not members:
+                    del self._server_users[server_id]
+            lost = before - self._audience(user_id)
+            return username, [self._names[uid] for uid in lost]
+
+    def server_removed(self, server_id: str) -> list:
+        """Drops a deleted server; returns the usernames that were its members."""
+        with self._lock:
+            members = self._server_users.pop(server_id, set())
+            for uid in members:
+                self._servers[uid].discard(server_id)
+            return [self._names[uid] for uid in members]
+
+    def friend_added(self, user_a: int, user_b: int) -> list:
+        """Returns the indexed usernames among the two."""
+        with self._lock:
+            for me, other in ((user_a, user_b), (user_b, user_a)):
+                if me in self._friends:
+                    self._friends[me].add(other)
+            return [self._names[uid] for uid in (user_a, user_b) if uid in self._names]
+
+    def friend_removed(self, user_a: int, user_b: int) -> list:
+        """Returns (viewer, subject) username pairs that lost sight of each other."""
+        with self._lock:
+            for me, other in ((user_a, user_b), (user_b, user_a)):
+                if me in self._friends:
+                    self._friends[me].discard(other)
+            if user_a not in self._names or user_b not in self._names:
+                return []
+            if user_b in self._audience(user_a):
+                return []  # still share a server
+            a, b = self._names[user_a], self._names[user_b]
+            return [(a, b), (b, a)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._ids),
+                "servers": len(self._server_users),
+                "memberships": sum(len(m) for m in self._server_users.values()),
+            }
+
+
+membership = MembershipIndex()
+
+
+def load_membership(username: str):
+    """Index a user's servers and friends (sync, DB) — called on lobby connect."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT id FROM users WHERE username = ?", (username,))
+    row = c.fetchone()
+    if not row:
+        conn.close()
+        return
+    user_id = row['id']
+    c.execute("SELECT server_id FROM members WHERE user_id = ?", (user_id,))
+    server_ids = [r['server_id'] for r in c.fetchall()]
+    c.execute("SELECT friend_id FROM friends WHERE user_id = ?", (user_id,))
+    friend_ids = [r['friend_id'] for r in c.fetchall()]
+    conn.close()
+    membership.load(user_id, username, server_ids, friend_ids)
+
+
+def membership_changed(server_id: str, user_id: int, joined: bool):
+    """Hook for joins / leaves / kicks / bans (safe to call from DB threads)."""
+    user_id = int(user_id)
+    if joined:
+        username = membership.member_added(server_id, user_id)
+        if username:
+            _mark_dirty(users=[username], snapshots=[username])
+    else:
+        username, lost = membership.member_removed(server_id, user_id)
+        if username:
+            _mark_dirty(snapshots=[username], removes=[(viewer, username) for viewer in lost])
+
+
+def server_removed(server_id: str):
+    """Hook for server deletion: former members get a fresh snapshot."""
+    _mark_dirty(snapshots=membership.server_removed(server_id))
+
+
+def friendship_changed(user_a: int, user_b: int, added: bool):
+    """Hook for accepted / removed friendships (safe to call from DB threads)."""
+    if added:
+        _mark_dirty(users=membership.friend_added(int(user_a), int(user_b)))
+    else:
+        _mark_dirty(removes=membership.friend_removed(int(user_a), int(user_b)))
+
+
+# ── Presence Deltas ──────────────────────────────────────────────────────────
+# Lobby clients receive one full snapshot (`lobby_update`) when they connect and
+# after that only what changed:
+#   presence_delta  {seq, total_online, upsert: [user, ...], remove: [username, ...]}
+#   room_delta      {seq, rooms: {room_id: [user_id, ...]}}   ([] = room is empty)
+# Everything is scoped through the membership index: a client only hears about
+# users it shares a server (or friendship) with and voice rooms of its servers.
+# Each lobby connection has its own sequence counter. A client that sees a gap
+# sends {"type": "presence_resync"} and gets a fresh snapshot (see send_presence_snapshot).
+#
+# Changes are collected as dirty usernames / room ids and flushed once per
+# debounce window. Every delta entry carries the subject's current state, so
+# several changes to the same user or room inside one window merge into one
+# entry, and each entry is JSON-encoded once no matter how many clients get it.
+_conn_seq: Dict[str, int] = {}
+_dirty_lock = threading.Lock()
+_dirty_users: set = set()
+_dirty_rooms: set = set()
+_dirty_snapshots: set = set()           # viewers whose visible set changed wholesale
+_dirty_removes: set = set()             # (viewer, subject) pairs that lost visibility
+_flush_task: asyncio.Task = None
+_loop: asyncio.AbstractEventLoop = None
+_BROADCAST_DEBOUNCE_MS = 150  # 150ms debounce window
+_presence_stats = {"snapshots": 0, "resyncs": 0, "deltas": 0, "bytes_sent": 0}
+
+
+def _next_seq(username: str) -> int:
+    seq = _conn_seq.get(username, 0) + 1
+    _conn_seq[username] = seq
+    return seq
+
+
+def build_presence_snapshot(username: str) -> dict:
+    """Everything `username` may see, at its current sequence number (no SQL)."""
+    visible = membership.audience(username) or {username}
     users_with_status = []
-    for uname in online_usernames:
+    for uname in visible:
         cached = _user_cache.get(uname)
-        if cached:
+        if cached and uname in lobby.active_connections:
             users_with_status.append(cached)
 
-    # 2. Room Details (Who is in which room)
+    my_servers = membership.servers_of(username)
     room_details = {}
     for r_id, r in rooms.items():
-        if r.active_connections:  # Skip empty rooms
-            room_details[r_id] = [u['user_id'] for u in r.active_connections]
+        if r.active_connections and (r.server_id is None or r.server_id in my_servers):
+            room_details[r_id] = r.member_ids()
 
-    # 3. Build JSON once, send to all
-    message = json.dumps({
+    return {
         "type": "lobby_update",
-        "total_online": len(online_usernames),
+        "seq": _conn_seq.setdefault(username, 0),
+        "total_online": len(lobby.active_connections),
         "online_users": users_with_status,
         "room_details": room_details
-    })
-    
-    to_remove = []
-    for user_id, ws in lobby.active_connections.items():
-        try:
-            await ws.send_text(message)
-        except Exception:
-            to_remove.append(user_id)
-    
-    for user_id in to_remove:
-        lobby.active_connections.pop(user_id, None)
-        remove_cached_user(user_id)
+    }
+
+
+def presence_resync_frame(username: str):
+    """Deferred snapshot for the coalesce overflow policy (built when sent)."""
+    def build():
+        _presence_stats["resyncs"] += 1
+        frame = encode_frame(build_presence_snapshot(username))
+        _presence_stats["bytes_sent"] += len(frame)
+        return frame
+    return build
+
+
+async def send_presence_snapshot(username: str, websocket: WebSocket, resync: bool = False):
+    """Queue the full snapshot for one lobby connection (on connect or on resync)."""
+    global _loop
+    _loop = asyncio.get_running_loop()
+    frame = encode_frame(build_presence_snapshot(username))
+    _presence_stats["resyncs" if resync else "snapshots"] += 1
+    _presence_stats["bytes_sent"] += len(frame)
+    # Never dropped: deltas are useless to a client without its snapshot
+    queue_send(websocket, frame, FRAME_DATA, key="snapshot")
+
+
+def _mark_dirty(users=(), rooms_=(), snapshots=(), removes=()):
+    """Record pending changes; callable from the event loop or a DB thread."""
+    if not (users or rooms_ or snapshots or removes):
+        return
+    with _dirty_lock:
+        _dirty_users.update(users)
+        _dirty_rooms.update(rooms_)
+        _dirty_snapshots.update(snapshots)
+        _dirty_removes.update(removes)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        if _loop is not None and not _loop.is_closed():
+            _loop.call_soon_threadsafe(_schedule_flush)
+        return
+    _schedule_flush()
+
+
+def _schedule_flush():
+    """Start the debounce window unless one is already open; later changes join it."""
+    global _flush_task
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.create_task(_debounced_flush())
+
+
+async def _debounced_flush():
+    """Wait for debounce window then send the merged deltas."""
+    global _flush_task
+    await asyncio.sleep(_BROADCAST_DEBOUNCE_MS / 1000.0)
+    _flush_task = None  # changes made while we send open the next window
+    await _flush_presence()
+
+
+async def broadcast_room_update(room_id: str = None, username: str = None):
+    """
+    Mark a voice room and/or a user's presence as changed and schedule a
+    debounced delta broadcast. Without arguments it only flushes what is
+    already pending.
+    """
+    _mark_dirty(users=[username] if username is not None else (),
+                rooms_=[room_id] if room_id is not None else ())
+    _schedule_flush()
+
+
+async def _flush_presence():
+    """Build the pending deltas once and send each client the part it may see."""
+    global _dirty_users, _dirty_rooms, _dirty_snapshots, _dirty_removes
+    with _dirty_lock:
+        users, room_ids = _dirty_users, _dirty_rooms
+        snapshots, removes = _dirty_snapshots, _dirty_removes
+        _dirty_users, _dirty_rooms, _dirty_snapshots, _dirty_removes = set(), set(), set(), set()
+
+    upserts, gone = defaultdict(list), defaultdict(list)
+    offline = []
+    for uname in users:
+        cached = _user_cache.get(uname)
+        audience = membership.audience(uname)
+        if cached and uname in lobby.active_connections:
+            encoded = json_text(cached)
+            for viewer in audience:
+                upserts[viewer].append(encoded)
+        else:
+            offline.append(uname)
+            for viewer in audience:
+                gone[viewer].append(uname)
+    for viewer, subject in removes:
+        gone[viewer].append(subject)
+
+    room_parts = defaultdict(list)
+    for r_id in room_ids:
+        room = rooms.get(r_id)
+        encoded = f"{json_text(r_id)}:{room.members_json() if room is not None else '[]'}"
+        if room is not None and room.server_id is not None:
+            audience = membership.server_audience(room.server_id)
+        else:
+            audience = lobby.active_connections.keys()
+        for viewer in audience:
+            room_parts[viewer].append(encoded)
+
+    total_online = len(lobby.active_connections)
+    for viewer in set(upserts) | set(gone) | set(room_parts) | snapshots:
+        ws = lobby.active_connections.get(viewer)
+        if ws is None:
+            continue
+        if viewer in snapshots:
+            # Visible set changed wholesale (joined/left a server): resend everything
+            await send_presence_snapshot(viewer, ws, resync=True)
+            continue
+        messages = []
+        if viewer in upserts or viewer in gone:
+            messages.append(
+                f'{{"type": "presence_delta", "seq": {_next_seq(viewer)}, '
+                f'"total_online": {total_online}, '
+                f'"upsert": [{", ".join(upserts.get(viewer, ()))}], '
+                f'"remove": {json_text(gone.get(viewer, []))}}}'
+            )
+        if viewer in room_parts:
+            messages.append(
+                f'{{"type": "room_delta", "seq": {_next_seq(viewer)}, '
+                f'"rooms": {{{", ".join(room_parts[viewer])}}}}}'
+            )
+        for message in messages:
+            if queue_send(ws, Frame.from_text(message), FRAME_PRESENCE):
+                _presence_stats["bytes_sent"] += len(message)
+        _presence_stats["deltas"] += len(messages)
+
+    for uname in offline:
+        if uname not in lobby.active_connections:
+            membership.forget(uname)
+            _conn_seq.pop(uname, None)
 
 
 async def broadcast_lobby_update():
@@ -142,25 +716,30 @@ async def broadcast_lobby_update():
     await broadcast_room_update()
 
 
+def voice_relay_stats() -> dict:
+    """Signaling relay counters of the voice rooms currently in memory."""
+    return {
+        r_id: {"name": r.name, "connections": len(r.active_connections), **r.relay_stats}
+        for r_id, r in list(rooms.items())
+    }
+
+
+def presence_stats() -> dict:
+    return {
+        "online": len(lobby.active_connections),
+        "pending_users": len(_dirty_users),
+        "pending_rooms": len(_dirty_rooms),
+        "membership_index": membership.stats(),
+        **_presence_stats,
+    }
+
+
 async def broadcast_user_list(room_id: str):
     """Notifies users IN a specific room about who is with them."""
     room = rooms.get(room_id)
     if not room: return
-    
-    # Send detailed user info
-    users = []
-    for conn in room.active_connections:
-        users.append({
-            "uuid": conn['user_id'],
-            "is_muted": conn.get('is_muted', False),
-            "is_deafened": conn.get('is_deafened', False),
-            "is_screen_sharing": conn.get('is_screen_sharing', False)
-        })
-
-    message = json.dumps({ "type": "user_list", "users": users })
-    
-    for conn in room.active_connections:
-        try:
-            await conn['ws'].send_text(message)
-        except Exception:
-            pass
+
+    message = room.user_list_frame()  # re-encoded only after a join, leave or state change
+    for conn in room.active_connections.values():
+        # Full room state every time: a still-queued older list is replaced
+        queue_send(conn.ws, message, FRAME_DATA, key="user_list")
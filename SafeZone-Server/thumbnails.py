@@ -0,0 +1,236 @@
+"""
+Image thumbnails and avatar sizes.
+
+After an image is stored (uploads.save_upload), WebP variants are generated on
+a small worker pool and recorded in attachments.variants (migration v11) as
+{variant: {"url", "width", "height"}}:
+  - chat attachments   "thumb"            fits in THUMBNAIL_MAX_SIZE, aspect kept
+  - avatars / icons    "32", "64", "128"  square, center-cropped
+Variant files sit next to the original (<sha256>_<variant>.webp) and, like the
+original, exist once per distinct content: a re-uploaded image reuses them.
+
+Payloads reference them as `attachment_thumb` (messages) and `avatar_thumbs`
+(members, presence); clients fall back to the original while one is missing.
+Animated and already small images get no chat thumbnail ("thumb": null), so
+the original is shown as is.
+
+Pillow is optional: without it (or without WebP support) nothing is generated
+and payloads simply carry no variants.
+"""
+import os
+import json
+import asyncio
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from database import get_db_connection, enqueue_write
+from utils import logger
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # optional dependency
+    Image = None
+
+THUMBNAIL_MAX_SIZE = int(os.environ.get("SAFEZONE_THUMBNAIL_MAX_SIZE", "400"))
+THUMBNAIL_QUALITY = int(os.environ.get("SAFEZONE_THUMBNAIL_QUALITY", "80"))
+THUMBNAIL_WORKERS = int(os.environ.get("SAFEZONE_THUMBNAIL_WORKERS", "2"))
+THUMBNAIL_MAX_PIXELS = 40_000_000  # refuse decompression bombs
+AVATAR_SIZES = (32, 64, 128)
+AVATAR_WAIT_SECONDS = 5.0  # upload_avatar waits this long for its sizes, then returns without them
+
+KIND_ATTACHMENT = "attachment"
+KIND_AVATAR = "avatar"  # also used for server icons
+
+THUMBNAILS_ENABLED = Image is not None and features.check("webp")
+if Image is not None:
+    Image.MAX_IMAGE_PIXELS = THUMBNAIL_MAX_PIXELS
+
+_executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix="safezone-thumb")
+_lock = threading.Lock()
+_pending: dict = {}                       # (url, kind) -> Future of a running generation
+_known: "OrderedDict[str, dict]" = OrderedDict()  # url -> variants, recently generated
+_KNOWN_MAX = 2048
+_stats = {"generated": 0, "reused": 0, "skipped": 0, "failed": 0, "variants_written": 0}
+_ready_callbacks = []
+
+
+def on_variants_ready(callback):
+    """Register callback(url, variants), called on the worker after new variants are recorded."""
+    _ready_callbacks.append(callback)
+
+
+# ── Payload helpers ──────────────────────────────────────────────────────────
+
+def parse_variants(raw) -> dict:
+    """attachments.variants column -> dict ({} for NULL / bad data)."""
+    if not raw:
+        return {}
+    try:
+        return json.loads(raw)
+    except (TypeError, ValueError):
+        return {}
+
+
+def attachment_thumb(variants: dict):
+    """The `attachment_thumb` payload field: {"url", "width", "height"} or None."""
+    return variants.get("thumb")
+
+
+def avatar_thumbs(variants: dict) -> dict:
+    """The `avatar_thumbs` payload field: {"32": url, "64": url, "128": url} (may be empty)."""
+    return {str(size): variants[str(size)]["url"] for size in AVATAR_SIZES if str(size) in variants}
+
+
+def with_avatar_thumbs(row) -> dict:
+    """dict(row) with its `avatar_variants` column turned into `avatar_thumbs`."""
+    user = dict(row)
+    user["avatar_thumbs"] = avatar_thumbs(parse_variants(user.pop("avatar_variants", None)))
+    return user
+
+
+# SELECT-list item for queries on `users u` that should carry avatar_thumbs
+AVATAR_VARIANTS_SQL = "(SELECT variants FROM attachments WHERE url = u.avatar_url) AS avatar_variants"
+
+
+def known_variants(url: str):
+    """Variants generated by this process for `url`, without touching the DB (None if unknown)."""
+    with _lock:
+        return _known.get(url)
+
+
+# ── Generation ───────────────────────────────────────────────────────────────
+
+def _disk_path(url: str) -> str:
+    return os.path.join("uploads", url[len("/uploads/"):])
+
+
+def _save_webp(image, dest_path: str):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), prefix=".thumb-", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            image.save(out, "WEBP", quality=THUMBNAIL_QUALITY, method=4)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _render(url: str, kind: str) -> dict:
+    """Write the variants of one stored image; returns {variant: {url, width, height}}."""
+    base_url = url.rsplit(".", 1)[0]
+    src_path = _disk_path(url)
+    variants = {}
+    with Image.open(src_path) as im:
+        if kind == KIND_ATTACHMENT and getattr(im, "is_animated", False):
+            return {"thumb": None}
+        box = THUMBNAIL_MAX_SIZE if kind == KIND_ATTACHMENT else max(AVATAR_SIZES)
+        im.draft("RGB", (box, box))  # JPEG: decode at reduced scale
+        im = ImageOps.exif_transpose(im)
+        im = im.convert("RGBA" if im.mode in ("RGBA", "LA", "P") else "RGB")
+
+        if kind == KIND_ATTACHMENT:
+            if im.width <= THUMBNAIL_MAX_SIZE and im.height <= THUMBNAIL_MAX_SIZE:
+                return {"thumb": None}  # already small; the original is the thumbnail
+            im.thumbnail((THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE), Image.LANCZOS)
+            targets = [("thumb", im)]
+        else:
+            square = ImageOps.fit(im, (max(AVATAR_SIZES),) * 2, Image.LANCZOS)
+            targets = [(str(size), square.resize((size, size), Image.LANCZOS)) for size in AVATAR_SIZES]
+
+        for name, image in targets:
+            variant_url = f"{base_url}_{name}.webp"
+            _save_webp(image, _disk_path(variant_url))
+            variants[name] = {"url": variant_url, "width": image.width, "height": image.height}
+            with _lock:
+                _stats["variants_written"] += 1
+    return variants
+
+
+def _generate(url: str, kind: str) -> dict:
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT variants FROM attachments WHERE url = ?", (url,))
+        row = c.fetchone()
+        conn.close()
+        if row is None:
+            return {}  # not a content-addressed upload
+        existing = parse_variants(row['variants'])
+        wanted = {"thumb"} if kind == KIND_ATTACHMENT else {str(s) for s in AVATAR_SIZES}
+        if wanted <= existing.keys():
+            # Same content uploaded before; its files are already there
+            with _lock:
+                _stats["reused"] += 1
+            variants = existing
+        else:
+            rendered = _render(url, kind)
+            variants = {**existing, **rendered}
+            # "thumb": None is recorded too, so small / animated images aren't re-examined
+            enqueue_write("UPDATE attachments SET variants = ? WHERE url = ?",
+                          (json.dumps(variants), url)).result()
+            with _lock:
+                _stats["generated" if any(rendered.values()) else "skipped"] += 1
+        with _lock:
+            _known[url] = variants
+            _known.move_to_end(url)
+            while len(_known) > _KNOWN_MAX:
+                _known.popitem(last=False)
+        for callback in _ready_callbacks:
+            callback(url, variants)
+        return variants
+    except (OSError, Image.DecompressionBombError) as e:
+        # Passed the magic-byte check but isn't decodable (truncated, corrupt, too many pixels)
+        with _lock:
+            _stats["failed"] += 1
+        logger.warning(f"Thumbnail skipped for {url}: {e}")
+        return {}
+    except Exception:
+        with _lock:
+            _stats["failed"] += 1
+        logger.exception(f"Thumbnail generation failed for {url}")
+        return {}
+    finally:
+        with _lock:
+            _pending.pop((url, kind), None)
+
+
+def schedule_variants(url: str, kind: str):
+    """
+    Start generating the variants of a stored image on the worker pool.
+    Returns a concurrent Future of the variants dict, or None if nothing will
+    be generated (Pillow missing, not an image upload). Concurrent calls for
+    the same URL share one job.
+    """
+    if not THUMBNAILS_ENABLED or not url.startswith("/uploads/cas/"):
+        return None
+    with _lock:
+        future = _pending.get((url, kind))
+        if future is None:
+            future = _executor.submit(_generate, url, kind)
+            _pending[(url, kind)] = future
+    return future
+
+
+async def avatar_variants(url: str) -> dict:
+    """Generate avatar / icon sizes and wait (up to AVATAR_WAIT_SECONDS) for them."""
+    future = schedule_variants(url, KIND_AVATAR)
+    if future is None:
+        return {}
+    try:
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), AVATAR_WAIT_SECONDS)
+    except asyncio.TimeoutError:
+        return {}  # finishes in the background; later payloads pick it up
+
+
+def thumbnail_stats() -> dict:
+    with _lock:
+        return {"enabled": THUMBNAILS_ENABLED, "pending": len(_pending), **_stats}
+
+
+def shutdown_thumbnail_executor():
+    _executor.shutdown(wait=True)
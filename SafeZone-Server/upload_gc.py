@@ -0,0 +1,286 @@
+"""
+Orphaned-upload collector.
+
+Deletes upload files nothing points at any more, in bounded batches on a
+background thread:
+  1. attachments rows (content-addressed files, migration v10) whose
+     ref_count dropped to zero: a deleted message, a replaced avatar or icon,
+     a server deleted with its channels. The row is deleted first, guarded so
+     a reference added meanwhile keeps it; then the file and its thumbnails.
+  2. a walk over uploads/ for files without any row or reference:
+       cas/...         content whose row is gone (crash between writing and
+                       recording it) and leftover temp files
+       uploads/<name>  pre-v10 uploads, cross-referenced with users.avatar_url,
+                       servers.icon_url and channel_messages.attachment_url
+Only files older than UPLOAD_GC_GRACE_SECONDS are candidates: an upload is
+referenced by the message / profile it was made for within seconds, and a
+repeated upload of the same content refreshes attachments.uploaded_at.
+
+With UPLOAD_GC_DRY_RUN (or a dry-run pass from the admin API) nothing is
+deleted; candidates are only counted and reported.
+"""
+import os
+import time
+import datetime
+import threading
+
+from database import get_db_connection, enqueue_write
+from uploads import UPLOAD_DIR, CAS_DIR, CAS_NAME_RE, claim_collect, release_collect
+from utils import logger
+
+UPLOAD_GC_INTERVAL = int(os.environ.get("SAFEZONE_UPLOAD_GC_INTERVAL", "21600"))  # seconds; 0 disables the thread
+UPLOAD_GC_GRACE_SECONDS = int(os.environ.get("SAFEZONE_UPLOAD_GC_GRACE_SECONDS", "86400"))
+UPLOAD_GC_BATCH = int(os.environ.get("SAFEZONE_UPLOAD_GC_BATCH", "200"))
+UPLOAD_GC_PAUSE_MS = int(os.environ.get("SAFEZONE_UPLOAD_GC_PAUSE_MS", "50"))  # between batches
+UPLOAD_GC_DRY_RUN = os.environ.get("SAFEZONE_UPLOAD_GC_DRY_RUN", "0") == "1"
+UPLOAD_GC_START_DELAY = 60  # first pass this long after startup
+UPLOAD_GC_SAMPLE = 20       # candidate paths listed in a pass report
+
+_TEMP_PREFIXES = (".upload-", ".thumb-")
+
+_run_lock = threading.Lock()  # one pass at a time (background thread or admin API)
+_stop = threading.Event()
+_thread = None
+_stats_lock = threading.Lock()
+_stats = {"passes": 0, "rows_deleted": 0, "files_deleted": 0, "bytes_reclaimed": 0, "errors": 0,
+          "last_pass_at": None, "last_pass_ms": 0, "last_report": None}
+
+
+def _pause():
+    _stop.wait(UPLOAD_GC_PAUSE_MS / 1000.0)
+
+
+def _new_report(dry_run: bool) -> dict:
+    return {"dry_run": dry_run, "rows": 0, "files": 0, "bytes": 0, "scanned": 0,
+            "skipped_in_use": 0, "sample": []}
+
+
+def _remove_file(rel_path: str, size: int, report: dict, dry_run: bool):
+    """Delete one file under UPLOAD_DIR (or just count it in a dry run)."""
+    if not dry_run:
+        try:
+            os.unlink(os.path.join(UPLOAD_DIR, rel_path))
+        except FileNotFoundError:
+            return
+    report["files"] += 1
+    report["bytes"] += size
+    if len(report["sample"]) < UPLOAD_GC_SAMPLE:
+        report["sample"].append(rel_path)
+
+
+def _remove_content(url: str, report: dict, dry_run: bool):
+    """Delete a stored file and every variant of it (<sha256>.<ext>, <sha256>_<variant>.webp)."""
+    rel_path = url[len("/uploads/"):]
+    shard = os.path.dirname(rel_path)
+    digest = os.path.basename(rel_path).split(".", 1)[0]
+    try:
+        with os.scandir(os.path.join(UPLOAD_DIR, shard)) as it:
+            entries = [e for e in it if e.name.startswith(digest)]
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        match = CAS_NAME_RE.match(entry.name)
+        if match and match.group(1) == digest:
+            _remove_file(f"{shard}/{entry.name}", entry.stat().st_size, report, dry_run)
+
+
+def _existing_hashes(c, digests: list) -> set:
+    if not digests:
+        return set()
+    placeholders = ','.join(['?'] * len(digests))
+    c.execute(f"SELECT hash FROM attachments WHERE hash IN ({placeholders})", digests)
+    return {r['hash'] for r in c.fetchall()}
+
+
+def _referenced_urls(c, urls: list) -> set:
+    """The given (pre-v10) upload URLs that an avatar, server icon or message still uses."""
+    placeholders = ','.join(['?'] * len(urls))
+    used = set()
+    c.execute(f"SELECT avatar_url FROM users WHERE avatar_url IN ({placeholders})", urls)
+    used.update(r[0] for r in c.fetchall())
+    c.execute(f"SELECT icon_url FROM servers WHERE icon_url IN ({placeholders})", urls)
+    used.update(r[0] for r in c.fetchall())
+    c.execute(f"SELECT attachment_url FROM channel_messages WHERE attachment_url IN ({placeholders})", urls)
+    used.update(r[0] for r in c.fetchall())
+    return used
+
+
+# ── Pass 1: unreferenced attachments rows ────────────────────────────────────
+
+def _collect_rows(report: dict, cutoff_ts: str, dry_run: bool):
+    after = ("", "")
+    while not _stop.is_set():
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''
+            SELECT hash, url, uploaded_at FROM attachments
+            WHERE ref_count <= 0 AND uploaded_at < ? AND (uploaded_at, hash) > (?, ?)
+            ORDER BY uploaded_at, hash
+            LIMIT ?
+        ''', (cutoff_ts, *after, UPLOAD_GC_BATCH))
+        rows = c.fetchall()
+        conn.close()
+        if not rows:
+            return
+        after = (rows[-1]['uploaded_at'], rows[-1]['hash'])
+        report["scanned"] += len(rows)
+
+        claimed = claim_collect(r['hash'] for r in rows)
+        try:
+            candidates = [r for r in rows if r['hash'] in claimed]
+            if not dry_run and candidates:
+                # Re-checked inside the DELETE: a reference or re-upload since the SELECT keeps the row
+                futures = [enqueue_write(
+                    "DELETE FROM attachments WHERE hash = ? AND ref_count <= 0 AND uploaded_at < ?",
+                    (r['hash'], cutoff_ts)) for r in candidates]
+                for future in futures:
+                    future.result()
+                conn = get_db_connection()
+                kept = _existing_hashes(conn.cursor(), [r['hash'] for r in candidates])
+                conn.close()
+                candidates = [r for r in candidates if r['hash'] not in kept]
+            report["rows"] += len(candidates)
+            report["skipped_in_use"] += len(rows) - len(candidates)
+            for r in candidates:
+                _remove_content(r['url'], report, dry_run)
+        finally:
+            release_collect(claimed)
+        _pause()
+
+
+# ── Pass 2: files on disk without a row or reference ─────────────────────────
+
+def _walk_batches():
+    """Lists of (rel_path, stat) of the files under UPLOAD_DIR, UPLOAD_GC_BATCH at a time."""
+    batch = []
+    pending = [""]
+    while pending:
+        rel_dir = pending.pop()
+        try:
+            with os.scandir(os.path.join(UPLOAD_DIR, rel_dir)) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                # Top level: only the content store; below it, its shard directories
+                if rel_dir or entry.name == CAS_DIR:
+                    pending.append(rel_path)
+            elif entry.is_file(follow_symlinks=False):
+                batch.append((rel_path, entry.stat()))
+                if len(batch) >= UPLOAD_GC_BATCH:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
+
+
+def _collect_files(batch: list, report: dict, cutoff_time: float, dry_run: bool):
+    report["scanned"] += len(batch)
+    orphans = []
+    stored = {}  # digest -> [(rel_path, stat)], original and variants
+    legacy = []
+    for rel_path, st in batch:
+        if st.st_mtime >= cutoff_time:
+            continue
+        name = os.path.basename(rel_path)
+        if name.startswith(_TEMP_PREFIXES):
+            orphans.append((rel_path, st))
+        elif rel_path.startswith(CAS_DIR + "/"):
+            match = CAS_NAME_RE.match(name)
+            if match:
+                stored.setdefault(match.group(1), []).append((rel_path, st))
+        else:
+            legacy.append((rel_path, st))
+
+    claimed = claim_collect(stored)
+    try:
+        report["skipped_in_use"] += len(stored) - len(claimed)
+        conn = get_db_connection()
+        c = conn.cursor()
+        recorded = _existing_hashes(c, list(claimed))
+        for digest in claimed - recorded:
+            orphans.extend(stored[digest])
+        if legacy:
+            used = _referenced_urls(c, ["/uploads/" + rel_path for rel_path, _ in legacy])
+            orphans.extend((rel_path, st) for rel_path, st in legacy if "/uploads/" + rel_path not in used)
+        conn.close()
+        for rel_path, st in orphans:
+            _remove_file(rel_path, st.st_size, report, dry_run)
+    finally:
+        release_collect(claimed)
+
+
+# ── Passes ───────────────────────────────────────────────────────────────────
+
+def collect_orphaned_uploads(dry_run: bool = UPLOAD_GC_DRY_RUN):
+    """
+    One full collection pass (sync; call via run_db or from the GC thread).
+    Returns its report, or None if another pass is already running.
+    """
+    if not _run_lock.acquire(blocking=False):
+        return None
+    started = time.monotonic()
+    report = _new_report(dry_run)
+    try:
+        cutoff_time = time.time() - UPLOAD_GC_GRACE_SECONDS
+        cutoff_ts = (datetime.datetime.utcnow()
+                     - datetime.timedelta(seconds=UPLOAD_GC_GRACE_SECONDS)).strftime("%Y-%m-%d %H:%M:%S")
+        _collect_rows(report, cutoff_ts, dry_run)
+        for batch in _walk_batches():
+            if _stop.is_set():
+                break
+            _collect_files(batch, report, cutoff_time, dry_run)
+            _pause()
+    except Exception:
+        with _stats_lock:
+            _stats["errors"] += 1
+        logger.exception("Upload GC pass failed")
+    finally:
+        _run_lock.release()
+
+    elapsed_ms = int((time.monotonic() - started) * 1000)
+    with _stats_lock:
+        _stats["passes"] += 1
+        if not dry_run:
+            _stats["rows_deleted"] += report["rows"]
+            _stats["files_deleted"] += report["files"]
+            _stats["bytes_reclaimed"] += report["bytes"]
+        _stats["last_pass_at"] = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        _stats["last_pass_ms"] = elapsed_ms
+        _stats["last_report"] = report
+    verb = "would delete" if dry_run else "deleted"
+    logger.info(f"Upload GC: {verb} {report['files']} file(s), {report['bytes']} bytes "
+                f"({report['rows']} row(s), {report['scanned']} scanned, {elapsed_ms} ms)")
+    return report
+
+
+def _run_forever():
+    delay = min(UPLOAD_GC_START_DELAY, UPLOAD_GC_INTERVAL)
+    while not _stop.wait(delay):
+        collect_orphaned_uploads()
+        delay = UPLOAD_GC_INTERVAL
+
+
+def start_upload_gc():
+    """Start the periodic collector thread (no-op if disabled or already running)."""
+    global _thread
+    if UPLOAD_GC_INTERVAL <= 0 or (_thread is not None and _thread.is_alive()):
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_run_forever, name="safezone-upload-gc", daemon=True)
+    _thread.start()
+
+
+def stop_upload_gc():
+    """Stop the collector after its current batch (called on server shutdown)."""
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=10)
+
+
+def upload_gc_stats() -> dict:
+    with _stats_lock:
+        return {**_stats, "interval": UPLOAD_GC_INTERVAL, "grace_seconds": UPLOAD_GC_GRACE_SECONDS,
+                "batch": UPLOAD_GC_BATCH, "dry_run": UPLOAD_GC_DRY_RUN, "running": _run_lock.locked()}
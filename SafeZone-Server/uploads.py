@@ -0,0 +1,320 @@
+"""
+Streaming file uploads.
+
+Upload handlers never hold a whole file in memory:
+  1. UploadSizeLimitMiddleware rejects a multipart request whose body is larger
+     than MAX_UPLOAD_SIZE (plus room for the form fields) with 413: up front
+     from Content-Length, or mid-stream as soon as the received bytes pass the
+     limit, so an oversized upload is never spooled to disk in full.
+  2. save_upload() reads the first chunk and runs utils.validate_upload on it
+     (extension + magic bytes), then hashes the file chunk by chunk on the
+     upload I/O pool, aborting once MAX_UPLOAD_SIZE is exceeded.
+  3. Files are content-addressed: stored once as
+         uploads/cas/<h[0:2]>/<h[2:4]>/<sha256>.<ext>
+     and recorded in the `attachments` table (migration v10). If that content
+     is already stored, the existing URL is returned and nothing is written.
+     Otherwise the file is copied into a temp file next to its destination
+     and renamed into place when complete, so a half-written upload is never
+     served.
+Peak memory per upload is one chunk, whatever the file size.
+
+attachments.ref_count counts the messages, avatars and server icons using a
+file; triggers keep it current, so handlers only ever store the URL. Files at
+zero references are left for the orphan collector (upload_gc.py); the two
+coordinate per content hash through claim_store / claim_collect, so a file is
+never deleted while an upload of the same content is being recorded.
+
+UploadFiles serves /uploads. A content-addressed file never changes under its
+name, so it gets its hash as a strong ETag and a year-long immutable
+Cache-Control; clients don't even revalidate. Older, randomly named uploads
+keep Starlette's stat-based ETag and are revalidated daily (304s). Range
+requests (video seeking) are answered with 206 by Starlette's FileResponse.
+"""
+import os
+import re
+import asyncio
+import hashlib
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse, FileResponse
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse
+
+from database import run_db, get_db_connection, write_async
+from utils import MAX_UPLOAD_SIZE, validate_upload, logger
+
+UPLOAD_DIR = "uploads"
+CAS_DIR = "cas"  # content-addressed files, under UPLOAD_DIR
+UPLOAD_CHUNK_SIZE = int(os.environ.get("SAFEZONE_UPLOAD_CHUNK_SIZE", str(64 * 1024)))
+UPLOAD_IO_WORKERS = int(os.environ.get("SAFEZONE_UPLOAD_IO_WORKERS", "4"))
+UPLOAD_FORM_OVERHEAD = 64 * 1024  # multipart boundaries, headers and the token field
+
+_upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_IO_WORKERS, thread_name_prefix="safezone-upload")
+_stats_lock = threading.Lock()
+_stats = {"saved": 0, "deduplicated": 0, "rejected_type": 0, "rejected_size": 0, "rejected_request": 0,
+          "bytes_saved": 0, "bytes_deduplicated": 0}
+
+# Per-hash coordination with the orphan collector
+_claims = threading.Condition()
+_storing: "Counter[str]" = Counter()  # digest -> save_upload calls between hashing and recording it
+_collecting: set = set()              # digests the collector is deleting right now
+
+
+def _count(key: str, n: int = 1):
+    with _stats_lock:
+        _stats[key] += n
+
+
+def _too_large_message() -> str:
+    return f"Dosya çok büyük! Maksimum {MAX_UPLOAD_SIZE // (1024 * 1024)}MB yüklenebilir."
+
+
+class UploadRejected(ValueError):
+    """The upload failed validation; the message is safe to show to the user."""
+
+
+class UploadTooLarge(HTTPException):
+    """Raised from the request stream once a multipart body passes the limit."""
+
+    def __init__(self):
+        super().__init__(status_code=413, detail=_too_large_message())
+
+
+async def upload_too_large_handler(request, exc: UploadTooLarge):
+    return JSONResponse({"status": "error", "message": exc.detail}, status_code=413)
+
+
+# ── Request body limit ───────────────────────────────────────────────────────
+
+class UploadSizeLimitMiddleware:
+    """ASGI middleware capping the body size of multipart/form-data requests."""
+
+    def __init__(self, app, max_body: int = MAX_UPLOAD_SIZE + UPLOAD_FORM_OVERHEAD):
+        self.app = app
+        self.max_body = max_body
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        if not headers.get(b"content-type", b"").startswith(b"multipart/form-data"):
+            return await self.app(scope, receive, send)
+
+        length = headers.get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_body:
+            _count("rejected_request")
+            response = JSONResponse({"status": "error", "message": _too_large_message()}, status_code=413)
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body:
+                    _count("rejected_request")
+                    raise UploadTooLarge()
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+# ── Claims ───────────────────────────────────────────────────────────────────
+
+def _try_claim_store(digest: str) -> bool:
+    with _claims:
+        if digest in _collecting:
+            return False
+        _storing[digest] += 1
+        return True
+
+
+def claim_store(digest: str):
+    """Mark `digest` as being stored, waiting out a collection of it (blocking)."""
+    with _claims:
+        while digest in _collecting:
+            _claims.wait()
+        _storing[digest] += 1
+
+
+def release_store(digest: str):
+    with _claims:
+        _storing[digest] -= 1
+        if _storing[digest] <= 0:
+            del _storing[digest]
+
+
+def claim_collect(digests) -> set:
+    """Claim the given digests for deletion; returns those not being stored (release them after)."""
+    with _claims:
+        claimed = {d for d in digests if d not in _storing and d not in _collecting}
+        _collecting.update(claimed)
+        return claimed
+
+
+def release_collect(digests):
+    with _claims:
+        _collecting.difference_update(digests)
+        _claims.notify_all()
+
+
+# ── Content-addressed store ──────────────────────────────────────────────────
+
+def upload_extension(filename: str) -> str:
+    return filename.rsplit('.', 1)[-1].lower() if filename and '.' in filename else ''
+
+
+def cas_relpath(digest: str, ext: str) -> str:
+    """Path of a stored file relative to UPLOAD_DIR (two levels of 256-way sharding)."""
+    return "/".join((CAS_DIR, digest[:2], digest[2:4], f"{digest}.{ext}"))
+
+
+def _hash_stream(src, first_chunk: bytes) -> tuple:
+    """sha256 hex digest and size of first_chunk + the rest of `src`."""
+    digest = hashlib.sha256()
+    size = 0
+    chunk = first_chunk
+    while chunk:
+        size += len(chunk)
+        if size > MAX_UPLOAD_SIZE:
+            raise UploadRejected(_too_large_message())
+        digest.update(chunk)
+        chunk = src.read(UPLOAD_CHUNK_SIZE)
+    return digest.hexdigest(), size
+
+
+def _copy_to_disk(src, dest_path: str):
+    """Copy `src` from its start to dest_path via a temp file in the same directory."""
+    directory = os.path.dirname(dest_path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".upload-", suffix=".part")
+    try:
+        src.seek(0)
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = src.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _stored_url(digest: str):
+    """URL of already stored content, or None if it isn't on disk."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT url FROM attachments WHERE hash = ?", (digest,))
+    row = c.fetchone()
+    conn.close()
+    if row and os.path.exists(os.path.join(UPLOAD_DIR, row['url'][len("/uploads/"):])):
+        return row['url']
+    return None
+
+
+async def save_upload(file: UploadFile, allowed_exts: set) -> str:
+    """
+    Validate an uploaded file and store it content-addressed. Returns its
+    public URL ("/uploads/cas/..."); identical content always gets the same
+    URL. Raises UploadRejected with a user-facing message if the type or size
+    is not allowed.
+    """
+    first_chunk = await file.read(UPLOAD_CHUNK_SIZE)
+    is_valid, err_msg = validate_upload(first_chunk, file.filename or "", allowed_exts)
+    if not is_valid:
+        _count("rejected_type")
+        raise UploadRejected(err_msg)
+
+    loop = asyncio.get_running_loop()
+    try:
+        digest, size = await loop.run_in_executor(_upload_executor, _hash_stream, file.file, first_chunk)
+    except UploadRejected:
+        _count("rejected_size")
+        raise
+
+    if not _try_claim_store(digest):
+        await loop.run_in_executor(_upload_executor, claim_store, digest)
+    try:
+        url = await run_db(_stored_url, digest)
+        if url is not None:
+            _count("deduplicated")
+            _count("bytes_deduplicated", size)
+            # Refresh uploaded_at so the orphan collector leaves it alone until it is referenced
+            await write_async("UPDATE attachments SET uploaded_at = CURRENT_TIMESTAMP WHERE hash = ?", (digest,))
+            return url
+
+        rel_path = cas_relpath(digest, upload_extension(file.filename))
+        await loop.run_in_executor(_upload_executor, _copy_to_disk, file.file, os.path.join(UPLOAD_DIR, rel_path))
+        url = "/uploads/" + rel_path
+        await write_async(
+            "INSERT INTO attachments (hash, url, size) VALUES (?, ?, ?) "
+            "ON CONFLICT(hash) DO UPDATE SET url = excluded.url, uploaded_at = CURRENT_TIMESTAMP",
+            (digest, url, size))
+    finally:
+        release_store(digest)
+    _count("saved")
+    _count("bytes_saved", size)
+    logger.debug(f"Upload stored: {rel_path} ({size} bytes)")
+    return url
+
+
+# ── Serving ──────────────────────────────────────────────────────────────────
+
+# <sha256>.<ext> originals and <sha256>_<variant>.webp thumbnails
+CAS_NAME_RE = re.compile(r"^([0-9a-f]{64})(?:_(\w+))?\.\w+$")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+LEGACY_CACHE_CONTROL = "public, max-age=86400"
+UPLOAD_HITS_TRACKED = 10000  # distinct files with a hit counter
+
+_serve_stats = {"served": 0, "not_modified": 0, "range": 0}
+_hits: Counter = Counter()
+
+
+class UploadFiles(StaticFiles):
+    """StaticFiles for /uploads with content-hash ETags, cache headers and hit counters."""
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        rel_path = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+        match = CAS_NAME_RE.match(os.path.basename(rel_path))
+        headers = {}
+        if match and rel_path.startswith(CAS_DIR + "/"):
+            digest, variant = match.groups()
+            headers["etag"] = f'"{digest}-{variant}"' if variant else f'"{digest}"'
+            headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            headers["cache-control"] = LEGACY_CACHE_CONTROL
+
+        # Runs on the event loop, so the counters need no lock
+        if rel_path in _hits or len(_hits) < UPLOAD_HITS_TRACKED:
+            _hits[rel_path] += 1
+        request_headers = Headers(scope=scope)
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            _serve_stats["not_modified"] += 1
+            return NotModifiedResponse(response.headers)
+        _serve_stats["range" if "range" in request_headers else "served"] += 1
+        return response
+
+
+def upload_stats() -> dict:
+    with _stats_lock:
+        stats = {**_stats, "chunk_size": UPLOAD_CHUNK_SIZE, "io_workers": UPLOAD_IO_WORKERS}
+    return {**stats, "serving": {**_serve_stats, "files_tracked": len(_hits),
+                                 "top_files": dict(_hits.most_common(10))}}
+
+
+def shutdown_upload_executor():
+    """Let in-flight file writes finish (called on server shutdown)."""
+    _upload_executor.shutdown(wait=True)
@@ -1,8 +1,11 @@
 import sys
+import os
 import datetime
 import sqlite3
+import threading
 import time as _time
-from database import get_db_connection
+from collections import OrderedDict
+from database import get_db_connection, enqueue_write, run_db
 from loguru import logger
 
 # ── Loguru Configuration ──────────────────────────────────────────────────────
@@ -58,6 +61,10 @@ def validate_upload(content: bytes, filename: str, allowed_exts: set) -> tuple[b
     2. Checking the extension is in the allowed set
     3. Reading magic bytes to verify file content matches declared type.
 
+    `content` may be just the first chunk of the file: streaming uploads
+    (uploads.save_upload) validate the first chunk here and enforce the size
+    limit while hashing the rest.
+
     Returns (is_valid: bool, error_message: str | None)
     """
     # 1. Size check
@@ -184,119 +191,310 @@ DEFAULT_PERMISSIONS = (
 # All permissions combined
 ALL_PERMISSIONS = (1 << 16) - 1
 
-def check_permission(user_id: int, server_id: str, permission: int) -> bool:
+# ── Permission Resolver ──────────────────────────────────────────────────────
+# The combined bitmask for (user_id, server_id) is resolved in ONE query
+# (sysadmin flag + owner + membership + role permissions) and cached.
+# Invalidation is by generation counters, so it is O(1) however many entries
+# are affected:
+#   - invalidate_permissions(server_id=...)          role create/update/delete,
+#                                                    ownership transfer, server delete
+#   - invalidate_permissions(user_id=..., server_id=...)  assign/unassign, kick,
+#                                                    ban, join, leave
+#   - invalidate_permissions(user_id=...)            sysadmin flag changed
+# A cached entry is only valid while both generations it was computed under
+# are still current; a resolve that races with an invalidation is therefore
+# never served from cache afterwards.
+PERMISSION_CACHE_SIZE = int(os.environ.get("SAFEZONE_PERMISSION_CACHE_SIZE", "50000"))
+
+
+class PermissionCache:
+    """LRU of (user_id, server_id) -> bitmask, invalidated by generation counters."""
+
+    def __init__(self, max_size: int = PERMISSION_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[tuple, tuple[int, int, int]]" = OrderedDict()
+        self._server_gen: dict = {}
+        self._user_gen: dict = {}
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0, "invalidations": 0}
+
+    def generations(self, user_id: int, server_id: str) -> tuple:
+        with self._lock:
+            return self._user_gen.get(user_id, 0), self._server_gen.get(server_id, 0)
+
+    def get(self, user_id: int, server_id: str):
+        key = (user_id, server_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            ugen, sgen, perms = entry
+            if ugen != self._user_gen.get(user_id, 0) or sgen != self._server_gen.get(server_id, 0):
+                del self._entries[key]
+                self._stats["stale"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return perms
+
+    def put(self, user_id: int, server_id: str, perms: int, gens: tuple):
+        with self._lock:
+            self._entries[(user_id, server_id)] = (gens[0], gens[1], perms)
+            self._entries.move_to_end((user_id, server_id))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidate(self, user_id: int = None, server_id: str = None):
+        with self._lock:
+            self._stats["invalidations"] += 1
+            if user_id is not None and server_id is not None:
+                self._entries.pop((user_id, server_id), None)
+                # Bump the user generation too, so a resolve already in flight
+                # for this pair can't be cached with pre-change data.
+                self._user_gen[user_id] = self._user_gen.get(user_id, 0) + 1
+            elif server_id is not None:
+                self._server_gen[server_id] = self._server_gen.get(server_id, 0) + 1
+            elif user_id is not None:
+                self._user_gen[user_id] = self._user_gen.get(user_id, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+            }
+
+
+_permission_cache = PermissionCache()
+
+
+def _resolve_permissions(user_id: int, server_ids: list) -> dict:
     """
-    Check if a user has a specific permission in a server.
-    Owner always has all permissions.
-    ADMINISTRATOR permission grants everything.
+    Compute the bitmask for every server in `server_ids` with a single query.
+    Rules: SysAdmin / owner -> ALL; non-member -> 0; member -> DEFAULT | roles;
+    ADMINISTRATOR in the combined mask -> ALL.
     """
-    try:
-        conn = get_db_connection()
-        c = conn.cursor()
+    gens = {sid: _permission_cache.generations(user_id, sid) for sid in server_ids}
+    result = {sid: 0 for sid in server_ids}
+    placeholders = ','.join(['?'] * len(server_ids))
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT u.is_sysadmin, s.id AS server_id, s.owner_id,
+               m.user_id IS NOT NULL AS is_member, r.permissions
+        FROM users u
+        LEFT JOIN servers s ON s.id IN ({placeholders})
+        LEFT JOIN members m ON m.server_id = s.id AND m.user_id = u.id
+        LEFT JOIN user_roles ur ON ur.server_id = s.id AND ur.user_id = u.id
+        LEFT JOIN roles r ON r.id = ur.role_id
+        WHERE u.id = ?
+    """, (*server_ids, user_id))
+    rows = c.fetchall()
+    conn.close()
 
-        # 0. Check if user is SysAdmin (Global Override)
-        c.execute("SELECT is_sysadmin FROM users WHERE id = ?", (user_id,))
-        user_row = c.fetchone()
-        if user_row and user_row['is_sysadmin']:
-            conn.close()
-            return True
-        
-        # 1. Check if user is server owner (always has all perms)
-        c.execute("SELECT owner_id FROM servers WHERE id = ?", (server_id,))
-        server = c.fetchone()
-        if not server:
-            conn.close()
-            return False
-        if server['owner_id'] == user_id:
-            conn.close()
-            return True
-        
-        # 2. Check if user is even a member
-        c.execute("SELECT 1 FROM members WHERE server_id = ? AND user_id = ?", (server_id, user_id))
-        if not c.fetchone():
-            conn.close()
-            return False
-        
-        # 3. Get user's roles in this server
-        c.execute("""
-            SELECT r.permissions FROM roles r
-            JOIN user_roles ur ON r.id = ur.role_id
-            WHERE ur.server_id = ? AND ur.user_id = ?
-        """, (server_id, user_id))
-        
-        roles = c.fetchall()
-        conn.close()
-        
-        # 4. Combine all role permissions (OR them together)
-        combined = DEFAULT_PERMISSIONS  # Start with default perms
-        for role in roles:
-            combined |= role['permissions']
-        
-        # 5. ADMINISTRATOR overrides everything
-        if combined & PERM_ADMINISTRATOR:
-            return True
-        
-        # 6. Check specific permission
-        return bool(combined & permission)
-        
+    if rows and rows[0]['is_sysadmin']:
+        # SysAdmin override (applies even to servers that don't exist)
+        result = {sid: ALL_PERMISSIONS for sid in server_ids}
+    else:
+        for row in rows:
+            sid = row['server_id']
+            if sid is None:
+                continue
+            if row['owner_id'] == user_id:
+                result[sid] = ALL_PERMISSIONS
+            elif row['is_member'] and result[sid] != ALL_PERMISSIONS:
+                result[sid] |= DEFAULT_PERMISSIONS | (row['permissions'] or 0)
+        for sid, perms in result.items():
+            if perms & PERM_ADMINISTRATOR:
+                result[sid] = ALL_PERMISSIONS
+
+    for sid, perms in result.items():
+        _permission_cache.put(user_id, sid, perms, gens[sid])
+    return result
+
+
+def get_permissions_bulk(user_id: int, server_ids) -> dict:
+    """
+    Returns {server_id: combined permission integer} for many servers at once.
+    Cached entries are reused; all misses are resolved together in one query.
+    """
+    try:
+        result, missing = {}, []
+        for sid in dict.fromkeys(server_ids):
+            perms = _permission_cache.get(user_id, sid)
+            if perms is None:
+                missing.append(sid)
+            else:
+                result[sid] = perms
+        if missing:
+            result.update(_resolve_permissions(user_id, missing))
+        return result
     except Exception:
-        logger.exception("check_permission error")
-        return False
+        logger.exception("get_permissions_bulk error")
+        return {sid: 0 for sid in server_ids}
+
 
 def get_user_permissions(user_id: int, server_id: str) -> int:
     """
     Returns the combined permission integer for a user in a server.
     """
+    perms = _permission_cache.get(user_id, server_id)
+    if perms is not None:
+        return perms
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-
-        # 0. Check if user is SysAdmin
-        c.execute("SELECT is_sysadmin FROM users WHERE id = ?", (user_id,))
-        user_row = c.fetchone()
-        if user_row and user_row['is_sysadmin']:
-            conn.close()
-            return ALL_PERMISSIONS
-        
-        # 1. Check if user is server owner
-        c.execute("SELECT owner_id FROM servers WHERE id = ?", (server_id,))
-        server = c.fetchone()
-        if not server:
-            conn.close()
-            return 0
-        if server['owner_id'] == user_id:
-            conn.close()
-            return ALL_PERMISSIONS
-        
-        # 2. Check membership
-        c.execute("SELECT 1 FROM members WHERE server_id = ? AND user_id = ?", (server_id, user_id))
-        if not c.fetchone():
-            conn.close()
-            return 0
-        
-        # 3. Get role permissions
-        c.execute("""
-            SELECT r.permissions FROM roles r
-            JOIN user_roles ur ON r.id = ur.role_id
-            WHERE ur.server_id = ? AND ur.user_id = ?
-        """, (server_id, user_id))
-        
-        roles = c.fetchall()
-        conn.close()
-        
-        combined = DEFAULT_PERMISSIONS
-        for role in roles:
-            combined |= role['permissions']
-        
-        if combined & PERM_ADMINISTRATOR:
-            return ALL_PERMISSIONS
-            
-        return combined
-        
+        return _resolve_permissions(user_id, [server_id])[server_id]
     except Exception:
         logger.exception("get_user_permissions error")
         return 0
 
+
+def check_permission(user_id: int, server_id: str, permission: int) -> bool:
+    """
+    Check if a user has a specific permission in a server.
+    Owner always has all permissions.
+    ADMINISTRATOR permission grants everything.
+    """
+    return bool(get_user_permissions(user_id, server_id) & permission)
+
+
+def invalidate_permissions(user_id: int = None, server_id: str = None):
+    """Invalidate cached permission bitmasks (see the list above for which form to use)."""
+    if user_id is not None:
+        user_id = int(user_id)  # request bodies may carry ids as strings
+    _permission_cache.invalidate(user_id=user_id, server_id=server_id)
+
+
+def permission_cache_stats() -> dict:
+    return _permission_cache.stats()
+
+# ── Session Cache (token → user) ─────────────────────────────────────────────
+# Nearly every endpoint starts by resolving its token to a user. Resolved
+# sessions are kept in a bounded LRU with a TTL, so a hit costs no SQL at all.
+# Entries hold only what auth needs: id, username, is_sysadmin.
+# Anything that changes a user's token or identity MUST call
+# invalidate_user_sessions(user_id): login / admin-login (token rotation),
+# password reset, admin user updates, and user deletion.
+SESSION_CACHE_SIZE = int(os.environ.get("SAFEZONE_SESSION_CACHE_SIZE", "10000"))
+SESSION_CACHE_TTL = float(os.environ.get("SAFEZONE_SESSION_CACHE_TTL", "300"))
+
+
+class SessionCache:
+    """Thread-safe LRU + TTL map of token -> {id, username, is_sysadmin}."""
+
+    def __init__(self, max_size: int = SESSION_CACHE_SIZE, ttl: float = SESSION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+        # Bumped on every invalidation. A loader that read the DB before an
+        # invalidation must not re-insert what it read (see put()).
+        self.generation = 0
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, token: str):
+        now = _time.monotonic()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            expires_at, user = entry
+            if expires_at <= now:
+                del self._entries[token]
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(token)
+            self._stats["hits"] += 1
+            return user
+
+    def put(self, token: str, user: dict, generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return  # an invalidation raced with this load; don't cache
+            self._entries[token] = (_time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            stale = [t for t, (_, u) in self._entries.items() if u["id"] == user_id]
+            for t in stale:
+                del self._entries[t]
+            self.generation += 1
+            self._stats["invalidations"] += len(stale)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+            }
+
+
+_session_cache = SessionCache()
+
+
+def get_session_user(token: str):
+    """
+    Resolve a token to {id, username, is_sysadmin}, or None if invalid.
+    Served from the session cache when possible; on a miss, one indexed
+    lookup on users.token. Blocking on a miss — from async code use
+    `await session_user(token)` instead.
+    """
+    if not token:
+        return None
+    user = _session_cache.get(token)
+    if user is not None:
+        return user
+    return _load_session(token)
+
+
+async def session_user(token: str):
+    """Async variant of get_session_user: a cache hit never leaves the event loop."""
+    if not token:
+        return None
+    user = _session_cache.get(token)
+    if user is not None:
+        return user
+    return await run_db(_load_session, token)
+
+
+def _load_session(token: str):
+    generation = _session_cache.generation
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT id, username, is_sysadmin FROM users WHERE token = ?", (token,))
+    row = c.fetchone()
+    conn.close()
+    if not row:
+        return None
+    user = {"id": row['id'], "username": row['username'], "is_sysadmin": bool(row['is_sysadmin'])}
+    _session_cache.put(token, user, generation)
+    return user
+
+
+def invalidate_user_sessions(user_id: int):
+    """Drop every cached session of `user_id` (see the invalidation list above)."""
+    _session_cache.invalidate_user(user_id)
+
+
+def session_cache_stats() -> dict:
+    return _session_cache.stats()
+
+
 def get_user_by_token(token: str):
     """Helper to validate token and return user row."""
     conn = get_db_connection()
@@ -310,24 +508,10 @@ def check_server_membership(user_id: int, server_id: str) -> bool:
     """
     Returns True if the user is a member of the given server, or is a SysAdmin.
     Use this to guard any endpoint that reads server-specific data.
+    Answered from the permission resolver: members always hold at least
+    DEFAULT_PERMISSIONS, non-members resolve to 0.
     """
-    try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        # SysAdmins have global access
-        c.execute("SELECT is_sysadmin FROM users WHERE id = ?", (user_id,))
-        row = c.fetchone()
-        if row and row['is_sysadmin']:
-            conn.close()
-            return True
-        # Check membership
-        c.execute("SELECT 1 FROM members WHERE server_id = ? AND user_id = ?", (server_id, user_id))
-        result = c.fetchone()
-        conn.close()
-        return result is not None
-    except Exception:
-        logger.exception("check_server_membership error")
-        return False
+    return get_user_permissions(user_id, server_id) != 0
 
 def check_channel_membership(user_id: int, channel_id: str) -> bool:
     """
@@ -358,14 +542,108 @@ def create_audit_log(server_id: str, user_id: int, action: str,
              CHANNEL_DELETE, MESSAGE_DELETE, MESSAGE_PIN, MESSAGE_UNPIN
     
     Target types: USER, ROLE, CHANNEL, MESSAGE
+
+    Queued on the batched writer: the entry is committed with the next group
+    commit rather than synchronously.
     """
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("""INSERT INTO audit_log (server_id, user_id, action, target_type, target_id, details) 
-                     VALUES (?, ?, ?, ?, ?, ?)""",
-                  (server_id, user_id, action, target_type, target_id, details))
-        conn.commit()
-        conn.close()
+        enqueue_write("""INSERT INTO audit_log (server_id, user_id, action, target_type, target_id, details) 
+                         VALUES (?, ?, ?, ?, ?, ?)""",
+                      (server_id, user_id, action, target_type, target_id, details))
     except Exception:
         logger.exception("create_audit_log error")
+
+
+# ── JSON Frames (encode once, send to many) ──────────────────────────────────
+# WebSocket fan-out serializes a payload once into a Frame and hands the same
+# object to every recipient's send queue. orjson is used when installed
+# (JSON_BACKEND=json forces the stdlib). Binary-mode sockets get the bytes view
+# via send_bytes (the web client asks for them). Text-mode sockets get a str
+# that the socket layer UTF-8 encodes again on every send; that is a plain copy
+# for an ASCII str but a full transcode otherwise, so non-ASCII payloads get a
+# \u-escaped text view. It is derived from the bytes the first time a
+# text-mode socket needs it, so binary-only fan-out never pays for it.
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+import json as _json
+import re as _re
+
+# backslashreplace (done in C) writes \xNN and \UNNNNNNNN where JSON needs
+# \u00NN and a surrogate pair; escaped backslashes (\\) are matched as a
+# unit so text that merely looks like an escape is left alone
+_PY_ESCAPE_RE = _re.compile(r"\\(?:\\|x([0-9a-f]{2})|U([0-9a-f]{8}))")
+
+
+def _json_escape(match) -> str:
+    if match.group(1):
+        return "\\u00" + match.group(1)
+    if match.group(2):
+        code = int(match.group(2), 16) - 0x10000
+        return f"\\u{0xD800 | (code >> 10):04x}\\u{0xDC00 | (code & 0x3FF):04x}"
+    return match.group()
+
+
+def _ascii_json(data: bytes) -> str:
+    """UTF-8 JSON bytes as equivalent ASCII-only JSON text (non-ASCII \\u-escaped)."""
+    text = data.decode("utf-8").encode("ascii", "backslashreplace").decode("ascii")
+    if "\\x" in text or "\\U" in text:
+        text = _PY_ESCAPE_RE.sub(_json_escape, text)
+    return text
+
+
+JSON_BACKEND = os.getenv("JSON_BACKEND", "orjson" if orjson else "json")
+if JSON_BACKEND == "orjson" and orjson is None:
+    JSON_BACKEND = "json"
+
+
+def json_bytes(payload) -> bytes:
+    """Serialize to UTF-8 JSON bytes with the configured backend."""
+    if JSON_BACKEND == "orjson":
+        try:
+            return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass  # something orjson can't encode; let json decide
+    return _json.dumps(payload, separators=(",", ":"), default=str).encode("ascii")
+
+
+def json_text(payload) -> str:
+    return json_bytes(payload).decode("utf-8")
+
+
+class Frame:
+    """A payload serialized once; every recipient shares its text / bytes views."""
+    __slots__ = ("_data", "_text")
+
+    def __init__(self, data: bytes = None, text: str = None):
+        self._data = data
+        self._text = text
+
+    @classmethod
+    def from_text(cls, text: str) -> "Frame":
+        return cls(text=text)
+
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            self._data = self._text.encode("utf-8")
+        return self._data
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            if self._data.isascii():
+                self._text = self._data.decode("ascii")
+            else:
+                # Valid JSON has non-ASCII only inside strings, where \u escapes mean the same
+                self._text = _ascii_json(self._data)
+        return self._text
+
+    def __len__(self):
+        return len(self._data) if self._data is not None else len(self._text)
+
+
+def encode_frame(payload) -> Frame:
+    return Frame(json_bytes(payload))
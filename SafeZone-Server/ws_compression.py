@@ -0,0 +1,125 @@
+"""
+WebSocket compression (permessage-deflate) with a size threshold.
+
+uvicorn already negotiates permessage-deflate, but compresses every outgoing
+message. Small frames (pongs, typing, presence deltas) barely shrink and still
+cost a zlib call, so messages below WS_COMPRESS_MIN_BYTES are sent as plain
+frames (RSV1 unset, which permessage-deflate allows per message). Each socket
+keeps its own compression context; skipped messages never touch it.
+
+Used by main.py as uvicorn's WebSocket protocol:
+
+    uvicorn main:app --ws ws_compression:CompressedWebSocketProtocol
+"""
+import os
+import time
+import threading
+
+from uvicorn.protocols.websockets.websockets_sansio_impl import WebSocketsSansIOProtocol
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import CONT, CTRL_OPCODES, Frame
+from websockets.server import ServerProtocol
+
+WS_COMPRESSION = os.getenv("WS_COMPRESSION", "1") not in ("0", "false", "off")
+WS_COMPRESS_MIN_BYTES = int(os.getenv("WS_COMPRESS_MIN_BYTES", "512"))
+WS_COMPRESS_LEVEL = int(os.getenv("WS_COMPRESS_LEVEL", "6"))
+WS_COMPRESS_WINDOW_BITS = int(os.getenv("WS_COMPRESS_WINDOW_BITS", "12"))  # 4 KiB window per socket
+WS_COMPRESS_MEM_LEVEL = int(os.getenv("WS_COMPRESS_MEM_LEVEL", "5"))
+
+_stats_lock = threading.Lock()
+_stats = {
+    "negotiated": 0,          # connections that accepted permessage-deflate
+    "compressed_messages": 0,
+    "skipped_messages": 0,    # below threshold, sent uncompressed
+    "bytes_in": 0,            # payload bytes of compressed messages before deflate
+    "bytes_out": 0,           # ... and after
+    "bytes_uncompressed": 0,  # payload bytes of skipped messages
+    "cpu_seconds": 0.0,       # time spent in deflate
+}
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """permessage-deflate that leaves messages below the threshold uncompressed."""
+
+    def __init__(self, *args, min_bytes: int = WS_COMPRESS_MIN_BYTES, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_bytes = min_bytes
+        self._skipping = False  # continuation frames follow their first frame
+
+    def encode(self, frame: Frame) -> Frame:
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        if frame.opcode is not CONT:
+            self._skipping = frame.fin and len(frame.data) < self.min_bytes
+        if self._skipping:
+            with _stats_lock:
+                _stats["skipped_messages"] += 1
+                _stats["bytes_uncompressed"] += len(frame.data)
+            return frame
+
+        start = time.perf_counter()
+        encoded = super().encode(frame)
+        elapsed = time.perf_counter() - start
+        with _stats_lock:
+            if frame.opcode is not CONT:
+                _stats["compressed_messages"] += 1
+            _stats["bytes_in"] += len(frame.data)
+            _stats["bytes_out"] += len(encoded.data)
+            _stats["cpu_seconds"] += elapsed
+        return encoded
+
+
+class ThresholdPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+    """Negotiates like the stock factory, then hands out the threshold variant."""
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, ext = super().process_request_params(params, accepted_extensions)
+        with _stats_lock:
+            _stats["negotiated"] += 1
+        return response_params, ThresholdPerMessageDeflate(
+            ext.remote_no_context_takeover,
+            ext.local_no_context_takeover,
+            ext.remote_max_window_bits,
+            ext.local_max_window_bits,
+            ext.compress_settings,
+        )
+
+
+class CompressedWebSocketProtocol(WebSocketsSansIOProtocol):
+    """uvicorn's websockets (sans-I/O) protocol with the threshold extension."""
+
+    def __init__(self, config, *args, **kwargs):
+        super().__init__(config, *args, **kwargs)
+        extensions = []
+        if WS_COMPRESSION and config.ws_per_message_deflate:
+            extensions = [
+                ThresholdPerMessageDeflateFactory(
+                    server_max_window_bits=WS_COMPRESS_WINDOW_BITS,
+                    client_max_window_bits=WS_COMPRESS_WINDOW_BITS,
+                    compress_settings={"level": WS_COMPRESS_LEVEL, "memLevel": WS_COMPRESS_MEM_LEVEL},
+                )
+            ]
+        # Handshake hasn't happened yet, so the connection can still be swapped
+        self.conn = ServerProtocol(
+            extensions=extensions,
+            max_size=config.ws_max_size,
+            logger=self.logger,
+        )
+
+
+def compression_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    saved = stats["bytes_in"] - stats["bytes_out"]
+    return {
+        "enabled": WS_COMPRESSION,
+        "min_bytes": WS_COMPRESS_MIN_BYTES,
+        "level": WS_COMPRESS_LEVEL,
+        "window_bits": WS_COMPRESS_WINDOW_BITS,
+        **stats,
+        "cpu_seconds": round(stats["cpu_seconds"], 4),
+        "bytes_saved": saved,
+        "ratio": round(stats["bytes_out"] / stats["bytes_in"], 4) if stats["bytes_in"] else None,
+        # Bytes saved per millisecond of deflate: the number to tune the threshold with
+        "saved_per_cpu_ms": round(saved / (stats["cpu_seconds"] * 1000), 1) if stats["cpu_seconds"] else None,
+    }
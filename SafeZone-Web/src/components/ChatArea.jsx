@@ -137,29 +137,21 @@ const ChatArea = ({
     React.useEffect(() => { if (showPins) fetchPins(); }, [showPins, selectedChannel]);
 
     // --- Reaction Handler ---
-    const handleReaction = React.useCallback(async (msgId, emoji, currentReactions) => {
+    const handleReaction = React.useCallback(async (msgId, emoji, myReactions) => {
         if (!authToken) return;
-        const myName = currentUser?.username;
-        const hasReacted = currentReactions[emoji]?.includes(myName);
+        const hasReacted = myReactions.includes(emoji);
         const method = hasReacted ? 'DELETE' : 'POST';
         try {
             const res = await fetch(getUrl(`/message/${msgId}/react?token=${authToken}&emoji=${encodeURIComponent(emoji)}`), { method });
             const data = await res.json();
             if (data.status === 'success') {
-                setMessages && setMessages(prev => prev.map(m => {
-                    if (m.id !== msgId) return m;
-                    const updatedReactions = { ...m.reactions };
-                    if (hasReacted) {
-                        updatedReactions[emoji] = (updatedReactions[emoji] || []).filter(u => u !== myName);
-                        if (!updatedReactions[emoji].length) delete updatedReactions[emoji];
-                    } else {
-                        updatedReactions[emoji] = [...(updatedReactions[emoji] || []), myName];
-                    }
-                    return { ...m, reactions: updatedReactions };
-                }));
+                // The response carries the message's reactions after the change, ours included
+                setMessages && setMessages(prev => prev.map(m => m.id === msgId
+                    ? { ...m, reactions: data.reactions, reaction_counts: data.reaction_counts, my_reactions: data.my_reactions }
+                    : m));
             }
         } catch (e) { console.error(e); }
-    }, [authToken, currentUser, setMessages]);
+    }, [authToken, setMessages]);
 
     return (
         <div style={{ flex: 1, display: 'flex', flexDirection: 'column', minWidth: 0, overflow: 'hidden' }}>
@@ -266,7 +258,7 @@ const ChatArea = ({
                                 const msgId = activeEmojiPickerId;
                                 const currentMsg = (messages || []).find(m => m.id === msgId);
                                 setActiveEmojiPickerId(null);
-                                handleReaction(msgId, emojiObj.emoji, currentMsg?.reactions || {});
+                                handleReaction(msgId, emojiObj.emoji, currentMsg?.my_reactions || []);
                             }}
                         />
                     </div>
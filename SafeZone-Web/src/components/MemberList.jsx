@@ -159,7 +159,7 @@ const MemberList = ({ members, onlineUserIds, userStatuses, colors, width, onRes
                                         fontSize: '14px'
                                     }}>
                                         {member.avatar_url ? (
-                                            <img src={getUrl(member.avatar_url)} style={{ width: '100%', height: '100%', borderRadius: '50%', objectFit: 'cover' }} />
+                                            <img src={getUrl(member.avatar_thumbs?.['64'] || member.avatar_url)} style={{ width: '100%', height: '100%', borderRadius: '50%', objectFit: 'cover' }} />
                                         ) : (
                                             member.username.substring(0, 2).toUpperCase()
                                         )}
@@ -237,7 +237,7 @@ const MemberList = ({ members, onlineUserIds, userStatuses, colors, width, onRes
                                     filter: 'grayscale(100%)' // Grayscale for offline
                                 }}>
                                     {member.avatar_url ? (
-                                        <img src={getUrl(member.avatar_url)} style={{ width: '100%', height: '100%', borderRadius: '50%', objectFit: 'cover' }} />
+                                        <img src={getUrl(member.avatar_thumbs?.['64'] || member.avatar_url)} style={{ width: '100%', height: '100%', borderRadius: '50%', objectFit: 'cover' }} />
                                     ) : (
                                         member.username.substring(0, 2).toUpperCase()
                                     )}
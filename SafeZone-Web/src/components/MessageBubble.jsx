@@ -211,7 +211,9 @@ const MessageBubble = ({
                     {msg.attachment_url && (
                         <div style={{ marginTop: '6px' }}>
                             {msg.attachment_type === 'image' ? (
-                                <img src={getUrl(msg.attachment_url)} alt="attachment" style={{ maxWidth: '350px', maxHeight: '300px', borderRadius: '8px', cursor: 'pointer', border: '1px solid rgba(255,255,255,0.06)', transition: 'transform 0.2s' }}
+                                <img src={getUrl(msg.attachment_thumb?.url || msg.attachment_url)} alt="attachment"
+                                    width={msg.attachment_thumb?.width} height={msg.attachment_thumb?.height} loading="lazy"
+                                    style={{ maxWidth: '350px', maxHeight: '300px', borderRadius: '8px', cursor: 'pointer', border: '1px solid rgba(255,255,255,0.06)', transition: 'transform 0.2s' }}
                                     onClick={() => window.open(getUrl(msg.attachment_url), '_blank')}
                                     onMouseEnter={e => e.target.style.transform = 'scale(1.02)'}
                                     onMouseLeave={e => e.target.style.transform = 'scale(1)'}
@@ -238,7 +240,10 @@ const MessageBubble = ({
                         <div style={{ display: 'flex', flexWrap: 'wrap', gap: '4px', marginTop: '6px' }}>
                             {Object.entries(msg.reactions).map(([emoji, userUuids]) => {
                                 if (!userUuids.length) return null;
-                                const hasReacted = userUuids.includes(currentUser.uuid || currentUser.username);
+                                // The server lists only the first reactors; the total is in reaction_counts
+                                const count = msg.reaction_counts?.[emoji] ?? userUuids.length;
+                                // userUuids is truncated; the server says which emojis are ours
+                                const hasReacted = (msg.my_reactions || []).includes(emoji);
                                 return (
                                     <div
                                         key={emoji}
@@ -253,7 +258,7 @@ const MessageBubble = ({
                                                 if (res.ok) {
                                                     const data = await res.json();
                                                     if (data.reactions !== undefined) {
-                                                        setMessages && setMessages(prev => prev.map(m => m.id === msg.id ? { ...m, reactions: data.reactions } : m));
+                                                        setMessages && setMessages(prev => prev.map(m => m.id === msg.id ? { ...m, reactions: data.reactions, reaction_counts: data.reaction_counts, my_reactions: data.my_reactions } : m));
                                                     }
                                                 }
                                             } catch (err) { console.error(err); }
@@ -261,10 +266,10 @@ const MessageBubble = ({
                                         style={{ background: hasReacted ? 'rgba(88, 101, 242, 0.15)' : (colors?.card || '#2b2d31'), border: `1px solid ${hasReacted ? '#5865F2' : 'transparent'}`, borderRadius: '8px', padding: '2px 8px', display: 'flex', alignItems: 'center', gap: '4px', cursor: 'pointer', fontSize: '1rem', userSelect: 'none', transition: 'transform 0.1s, background 0.1s' }}
                                         onMouseEnter={e => { e.currentTarget.style.transform = 'scale(1.05)'; if (!hasReacted) e.currentTarget.style.background = '#313338'; }}
                                         onMouseLeave={e => { e.currentTarget.style.transform = 'scale(1)'; if (!hasReacted) e.currentTarget.style.background = (colors?.card || '#2b2d31'); }}
-                                        title={`${userUuids.length} kişi tepki bıraktı`}
+                                        title={`${count} kişi tepki bıraktı`}
                                     >
                                         <span style={{ display: 'flex', alignItems: 'center', fontFamily: '"Segoe UI Emoji", "Apple Color Emoji", "Noto Color Emoji", sans-serif' }}>{emoji}</span>
-                                        <span style={{ color: hasReacted ? '#fff' : '#b5bac1', fontWeight: 600, fontSize: '12px' }}>{userUuids.length}</span>
+                                        <span style={{ color: hasReacted ? '#fff' : '#b5bac1', fontWeight: 600, fontSize: '12px' }}>{count}</span>
                                     </div>
                                 );
                             })}
@@ -1,5 +1,5 @@
 import { useState, useRef, useEffect } from 'react';
-import { getUrl, getWsTicket } from '../utils/api';
+import { getUrl, getWsTicket, openJsonSocket, parseWsFrame } from '../utils/api';
 import SoundManager from '../utils/SoundManager';
 import toast from '../utils/toast';
 
@@ -41,6 +41,7 @@ export const useChat = (authState, uuid, chatWs, roomWs, onUnreadMessage) => {
     const [hasMore, setHasMore] = useState(false);
     const [isLoadingMore, setIsLoadingMore] = useState(false);
     const currentChannelId = useRef(null);
+    const olderCursor = useRef(null); // opaque cursor from the last page; null = page by id
 
     // --- CONNECTION ---
     const connectToChannel = async (channel) => {
@@ -55,11 +56,11 @@ export const useChat = (authState, uuid, chatWs, roomWs, onUnreadMessage) => {
         // Get short-lived ticket instead of sending persistent token in URL
         const ticket = await getWsTicket(authState.token);
         const wsUrl = getUrl(`/ws/room/${channel.id}/${userId}?token=${encodeURIComponent(ticket)}`, 'ws');
-        chatWs.current = new WebSocket(wsUrl);
+        chatWs.current = openJsonSocket(wsUrl);
 
         const connectedChannelId = channel.id; // capture at connection time
         chatWs.current.onmessage = (event) => {
-            const msg = JSON.parse(event.data);
+            const msg = parseWsFrame(event);
             // Discard events from a previous channel's WS if we've moved on
             if (currentChannelId.current !== connectedChannelId) return;
             handleIncomingMessage(msg);
@@ -103,15 +104,22 @@ export const useChat = (authState, uuid, chatWs, roomWs, onUnreadMessage) => {
                 attachment_url: msg.attachment_url,
                 attachment_type: msg.attachment_type,
                 attachment_name: msg.attachment_name,
+                attachment_thumb: msg.attachment_thumb || null,
                 timestamp: msg.timestamp || new Date().toISOString(),
                 reply_to: msg.reply_to || null,
                 reactions: msg.reactions || {},
+                reaction_counts: msg.reaction_counts || {},
                 _new: true // flag for animation
             }]);
         } else if (msg.type === 'history') {
             const msgs = msg.messages || [];
             setMessages(msgs);
+            olderCursor.current = null;
             setHasMore(msgs.length >= PAGE_SIZE);
+        } else if (msg.type === 'my_reactions') {
+            // Follows the (shared) history frame: which of its reactions are ours
+            const mine = msg.reactions || {};
+            setMessages(prev => prev.map(m => mine[m.id] ? { ...m, my_reactions: mine[m.id] } : m));
         } else if (msg.type === 'typing') {
             setTypingUsers(prev => {
                 const newSet = new Set(prev);
@@ -128,7 +136,7 @@ export const useChat = (authState, uuid, chatWs, roomWs, onUnreadMessage) => {
         } else if (msg.type === 'message_react') {
             setMessages(prev => prev.map(m => {
                 if (m.id === msg.message_id) {
-                    return { ...m, reactions: msg.reactions };
+                    return { ...m, reactions: msg.reactions, reaction_counts: msg.reaction_counts };
                 }
                 return m;
             }));
@@ -155,7 +163,8 @@ export const useChat = (authState, uuid, chatWs, roomWs, onUnreadMessage) => {
             const data = await res.json();
             if (data.status === 'success') {
                 setMessages(data.messages);
-                setHasMore(data.messages.length >= PAGE_SIZE);
+                olderCursor.current = data.older_cursor || null;
+                setHasMore(data.has_more ?? data.messages.length >= PAGE_SIZE);
             }
         } catch (e) { console.error(e); }
     }
@@ -166,14 +175,17 @@ export const useChat = (authState, uuid, chatWs, roomWs, onUnreadMessage) => {
         if (!channelId || isLoadingMore || !hasMore) return;
         setIsLoadingMore(true);
         try {
-            const firstMsg = messages[0];
-            const beforeId = firstMsg?.id;
-            const url = `${getUrl(`/channel/${channelId}/messages`)}?token=${authState.token}&limit=${PAGE_SIZE}${beforeId ? `&before_id=${beforeId}` : ''}`;
+            const beforeId = messages[0]?.id;
+            const page = olderCursor.current
+                ? `&cursor=${encodeURIComponent(olderCursor.current)}`
+                : (beforeId ? `&before_id=${beforeId}` : '');
+            const url = `${getUrl(`/channel/${channelId}/messages`)}?token=${authState.token}&limit=${PAGE_SIZE}${page}`;
             const res = await fetch(url);
             const data = await res.json();
             if (data.status === 'success' && data.messages.length > 0) {
                 setMessages(prev => [...data.messages, ...prev]);
-                setHasMore(data.messages.length >= PAGE_SIZE);
+                olderCursor.current = data.older_cursor || null;
+                setHasMore(data.has_more ?? data.messages.length >= PAGE_SIZE);
             } else {
                 setHasMore(false);
             }
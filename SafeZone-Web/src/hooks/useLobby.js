@@ -1,5 +1,5 @@
 import { useState, useRef, useEffect } from 'react';
-import { getUrl, getWsTicket } from '../utils/api';
+import { getUrl, getWsTicket, openJsonSocket, parseWsFrame } from '../utils/api';
 import SoundManager from '../utils/SoundManager';
 
 export const useLobby = (authState, uuid, fetchServers, onFriendRequest, onUnreadDM, onOnlineUsersUpdate) => {
@@ -10,6 +10,10 @@ export const useLobby = (authState, uuid, fetchServers, onFriendRequest, onUnrea
     const [roomDetails, setRoomDetails] = useState({});
     const [ping, setPing] = useState(null);
 
+    // Presence protocol: one `lobby_update` snapshot, then seq-numbered deltas
+    const presenceSeq = useRef(null); // null = waiting for a snapshot
+    const presenceUsers = useRef(new Map()); // username -> user object
+
     // DM State
     const [dmHistory, setDmHistory] = useState([]);
     const [selectedDM, setSelectedDM] = useState(null);
@@ -17,12 +21,57 @@ export const useLobby = (authState, uuid, fetchServers, onFriendRequest, onUnrea
     const [dmHasMore, setDmHasMore] = useState(false);
     const [dmIsLoadingMore, setDmIsLoadingMore] = useState(false);
     const dmTypingTimer = useRef(null);
+    const dmOlderCursor = useRef(null);
 
     // Reconnect state
     const reconnectTimer = useRef(null);
     const reconnectDelay = useRef(1000); // starts at 1s, max 30s
     const shouldReconnect = useRef(true);
 
+    // Returns true if a delta with this seq should be applied; requests a
+    // fresh snapshot when one was missed.
+    const acceptSeq = (seq) => {
+        if (presenceSeq.current === null) return false; // snapshot still on its way
+        if (seq <= presenceSeq.current) return false;    // already covered by the snapshot
+        if (seq !== presenceSeq.current + 1) {
+            console.warn(`[useLobby] Presence gap (${presenceSeq.current} -> ${seq}), resyncing.`);
+            presenceSeq.current = null;
+            if (lobbyWs.current?.readyState === WebSocket.OPEN) {
+                lobbyWs.current.send(JSON.stringify({ type: 'presence_resync' }));
+            }
+            return false;
+        }
+        presenceSeq.current = seq;
+        return true;
+    };
+
+    const applyOnlineUsers = () => {
+        const ids = [];
+        const statuses = {};
+        presenceUsers.current.forEach(u => {
+            if (u.status === 'invisible' && u.username !== uuid.current) return;
+            ids.push(u.username);
+            if (u.status) statuses[u.username] = u.status;
+        });
+        setOnlineUserIds(ids);
+        setUserStatuses(prev => ({ ...prev, ...statuses }));
+    };
+
+    const applyRoomDetails = (update) => {
+        setRoomDetails(prev => {
+            const newRoomDetails = update(prev);
+            const prevStr = JSON.stringify(prev);
+            const newStr = JSON.stringify(newRoomDetails);
+            // Only trigger server refresh if room occupancy actually changed
+            if (prevStr !== newStr && fetchServers) {
+                // Debounce: only fetch after brief settle
+                clearTimeout(lobbyWs.current._serverRefreshTimer);
+                lobbyWs.current._serverRefreshTimer = setTimeout(() => fetchServers(), 2000);
+            }
+            return prevStr !== newStr ? newRoomDetails : prev;
+        });
+    };
+
     // Connect
     const connectToLobby = async () => {
         if (!authState.token || !authState.user?.username) return;
@@ -31,44 +80,43 @@ export const useLobby = (authState, uuid, fetchServers, onFriendRequest, onUnrea
         // Get short-lived ticket instead of sending persistent token in URL
         const ticket = await getWsTicket(authState.token);
         const wsUrl = getUrl(`/ws/lobby/${authState.user.username}?token=${encodeURIComponent(ticket)}`, 'ws');
-        lobbyWs.current = new WebSocket(wsUrl);
+        lobbyWs.current = openJsonSocket(wsUrl);
+        presenceSeq.current = null;
 
         lobbyWs.current.onmessage = (event) => {
             try {
-                const data = JSON.parse(event.data);
+                const data = parseWsFrame(event);
                 if (data.type === 'lobby_update') {
+                    presenceSeq.current = data.seq ?? null;
                     setTotalUsers(data.total_online);
+                    applyRoomDetails(() => data.room_details || {});
 
-                    // Only trigger server refresh if room occupancy actually changed
-                    const newRoomDetails = data.room_details || {};
-                    setRoomDetails(prev => {
-                        const prevStr = JSON.stringify(prev);
-                        const newStr = JSON.stringify(newRoomDetails);
-                        if (prevStr !== newStr && fetchServers) {
-                            // Debounce: only fetch after brief settle
-                            clearTimeout(lobbyWs.current._serverRefreshTimer);
-                            lobbyWs.current._serverRefreshTimer = setTimeout(() => fetchServers(), 2000);
-                        }
-                        return prevStr !== newStr ? newRoomDetails : prev;
+                    presenceUsers.current = new Map();
+                    (data.online_users || []).forEach(u => {
+                        if (typeof u === 'string') u = { username: u }; // Legacy support
+                        presenceUsers.current.set(u.username, u);
                     });
+                    applyOnlineUsers();
+                    if (onOnlineUsersUpdate && data.online_users?.length > 0) onOnlineUsersUpdate(data.online_users);
 
-                    // Parse Online Users
-                    const ids = [];
-                    const statuses = {};
-                    if (data.online_users && data.online_users.length > 0) {
-                        data.online_users.forEach(u => {
-                            if (typeof u === 'string') {
-                                ids.push(u); // Legacy support
-                            } else {
-                                if (u.status === 'invisible' && u.username !== uuid.current) return;
-                                ids.push(u.username);
-                                statuses[u.username] = u.status;
-                            }
+                } else if (data.type === 'presence_delta') {
+                    if (!acceptSeq(data.seq)) return;
+                    setTotalUsers(data.total_online);
+                    (data.remove || []).forEach(name => presenceUsers.current.delete(name));
+                    (data.upsert || []).forEach(u => presenceUsers.current.set(u.username, u));
+                    applyOnlineUsers();
+                    if (onOnlineUsersUpdate && data.upsert?.length > 0) onOnlineUsersUpdate(data.upsert);
+
+                } else if (data.type === 'room_delta') {
+                    if (!acceptSeq(data.seq)) return;
+                    applyRoomDetails(prev => {
+                        const next = { ...prev };
+                        Object.entries(data.rooms || {}).forEach(([roomId, members]) => {
+                            if (members.length > 0) next[roomId] = members;
+                            else delete next[roomId];
                         });
-                        if (onOnlineUsersUpdate) onOnlineUsersUpdate(data.online_users);
-                    }
-                    setOnlineUserIds(ids);
-                    setUserStatuses(prev => ({ ...prev, ...statuses }));
+                        return next;
+                    });
 
                 } else if (data.type === 'dm_received') {
                     if (selectedDM && selectedDM.username === data.sender) {
@@ -175,26 +223,28 @@ export const useLobby = (authState, uuid, fetchServers, onFriendRequest, onUnrea
             const data = await res.json();
             if (data.status === 'success') {
                 setDmHistory(data.messages);
-                setDmHasMore(data.messages.length === 50);
+                dmOlderCursor.current = data.older_cursor || null;
+                setDmHasMore(Boolean(data.older_cursor));
             }
         } catch (e) { console.error(e); }
     }
 
     const loadMoreDMs = async () => {
         if (!selectedDM || dmIsLoadingMore || !dmHasMore) return;
-        const firstId = dmHistory[0]?.id;
-        if (!firstId) return;
+        const cursor = dmOlderCursor.current;
+        if (!cursor) return;
         setDmIsLoadingMore(true);
         try {
             const res = await fetch(getUrl('/dm/history'), {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ token: authState.token, username: selectedDM.username, before_id: firstId, limit: 50 })
+                body: JSON.stringify({ token: authState.token, username: selectedDM.username, cursor, limit: 50 })
             });
             const data = await res.json();
             if (data.status === 'success') {
                 setDmHistory(prev => [...data.messages, ...prev]);
-                setDmHasMore(data.messages.length === 50);
+                dmOlderCursor.current = data.older_cursor || null;
+                setDmHasMore(Boolean(data.older_cursor));
             }
         } catch (e) { console.error(e); }
         finally { setDmIsLoadingMore(false); }
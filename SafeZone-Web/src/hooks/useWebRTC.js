@@ -1,5 +1,5 @@
 import { useRef, useState, useEffect } from 'react';
-import { getUrl, getWsTicket, STUN_SERVERS } from '../utils/api';
+import { getUrl, getWsTicket, openJsonSocket, parseWsFrame, STUN_SERVERS } from '../utils/api';
 import SoundManager from '../utils/SoundManager';
 import toast from '../utils/toast';
 import { NoiseSuppression } from '../audio/NoiseSuppression';
@@ -47,7 +47,7 @@ export const useWebRTC = (authState, uuid, roomWs, onMessageReceived, selectedIn
 
     // --- SIGNAL HANDLING ---
     const handleVoiceMessage = async (event) => {
-        const msg = JSON.parse(event.data);
+        const msg = parseWsFrame(event);
         const myId = authState.user?.username || uuid.current;
         if (msg.target && msg.target !== myId) return;
 
@@ -133,7 +133,7 @@ export const useWebRTC = (authState, uuid, roomWs, onMessageReceived, selectedIn
         // Get short-lived ticket instead of sending persistent token in URL
         const ticket = await getWsTicket(authState.token);
         const wsUrl = getUrl(`/ws/room/${channel.id}/${userId}?token=${encodeURIComponent(ticket)}`, 'ws');
-        roomWs.current = new WebSocket(wsUrl);
+        roomWs.current = openJsonSocket(wsUrl);
 
         setVoiceStates({});
 
@@ -73,6 +73,23 @@ export const getUrl = (endpoint, protocol = 'http') => {
     }
 }
 
+/**
+ * Open a lobby / room WebSocket in binary frame mode: the server serializes
+ * each payload once and sends the same UTF-8 bytes to every recipient.
+ * Read messages with parseWsFrame().
+ */
+export const openJsonSocket = (wsUrl) => {
+    const ws = new WebSocket(`${wsUrl}${wsUrl.includes('?') ? '&' : '?'}frames=binary`);
+    ws.binaryType = 'arraybuffer';
+    return ws;
+}
+
+const frameDecoder = new TextDecoder();
+
+/** JSON payload of a WebSocket message event (binary or text frame). */
+export const parseWsFrame = (event) =>
+    JSON.parse(typeof event.data === 'string' ? event.data : frameDecoder.decode(event.data));
+
 /**
  * Obtain a short-lived, single-use WebSocket ticket from the server.
  * This avoids sending the persistent auth token in WebSocket URLs
@@ -42,7 +42,7 @@ pip install --upgrade pip
 if [ -f "requirements.txt" ]; then
     pip install -r requirements.txt
 else
-    pip install fastapi uvicorn websockets pydantic bcrypt python-multipart
+    pip install fastapi uvicorn websockets pydantic bcrypt python-multipart python-dotenv loguru orjson Pillow
 fi
 
 # 6. Create Service (Systemd)
@@ -55,7 +55,7 @@ After=network.target
 [Service]
 User=root
 WorkingDirectory=/root/SafeZone/SafeZone-Server
-ExecStart=/root/SafeZone/SafeZone-Server/venv/bin/uvicorn main:app --host 0.0.0.0 --port 8000
+ExecStart=/root/SafeZone/SafeZone-Server/venv/bin/uvicorn main:app --host 0.0.0.0 --port 8000 --ws ws_compression:CompressedWebSocketProtocol
 Restart=always
 RestartSec=3
 
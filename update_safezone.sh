@@ -17,11 +17,17 @@ source venv/bin/activate
 if [ -f "requirements.txt" ]; then
     pip install -r requirements.txt --break-system-packages
 else
-    pip install fastapi uvicorn websockets pydantic bcrypt python-multipart --break-system-packages
+    pip install fastapi uvicorn websockets pydantic bcrypt python-multipart python-dotenv loguru orjson Pillow --break-system-packages
 fi
 
 # 3. Restart Service
 echo "🔄 Servis yeniden baslatiliyor..."
+# Units created by older installers start uvicorn without the compressing WebSocket protocol
+SERVICE_FILE=/etc/systemd/system/safezone.service
+if [ -f "$SERVICE_FILE" ] && ! grep -q -- "--ws ws_compression" "$SERVICE_FILE"; then
+    sed -i '/^ExecStart=.*uvicorn main:app/ s/$/ --ws ws_compression:CompressedWebSocketProtocol/' "$SERVICE_FILE"
+    systemctl daemon-reload
+fi
 systemctl restart safezone
 systemctl status safezone --no-pager
 